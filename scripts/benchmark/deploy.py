@@ -3,7 +3,7 @@ def test_benchmark(infer_backend: str) -> None:
     os.environ['CUDA_VISIBLE_DEVICES'] = '0'
     os.environ['TIMEOUT'] = '-1'
     import requests
-    from swift.llm import DeployArguments, get_dataset, get_model_list_client, XRequestConfig, inference_client_async
+    from swift.llm import DeployArguments, get_dataset, get_model_list_client, XRequestConfig, AsyncInferenceClient
     from swift.llm.deploy import llm_deploy
     import multiprocessing
     import time
@@ -34,16 +34,18 @@ def test_benchmark(infer_backend: str) -> None:
     is_multimodal = model_list.data[0].is_multimodal
     print(f'model_type: {model_type}')
 
-    tasks = []
-    for query in query_list:
-        tasks.append(
-            inference_client_async(
-                model_type, query, request_config=request_config, is_chat=is_chat, is_multimodal=is_multimodal))
+    request_list = [{
+        'model_type': model_type,
+        'query': query,
+        'is_chat_request': is_chat,
+        'is_multimodal': is_multimodal
+    } for query in query_list]
 
-    async def _batch_run(tasks):
-        return await asyncio.gather(*tasks)
+    async def _batch_run(request_list):
+        async with AsyncInferenceClient() as client:
+            return await client.infer_batch(request_list, request_config=request_config, use_tqdm=True)
 
-    resp_list = asyncio.run(_batch_run(tasks))
+    resp_list = asyncio.run(_batch_run(request_list))
     logger.info(f'len(resp_list): {len(resp_list)}')
     logger.info(f'resp_list[0]: {resp_list[0]}')
     process.terminate()
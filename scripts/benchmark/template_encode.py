@@ -0,0 +1,46 @@
+# Copyright (c) Alibaba, Inc. and its affiliates.
+"""Benchmark `Template.encode` with and without the token cache of the template fragments.
+
+e.g. python scripts/benchmark/template_encode.py --model_type qwen2-0_5b-instruct
+"""
+import argparse
+import time
+
+from swift.llm import TEMPLATE_MAPPING, get_model_tokenizer, get_template
+
+
+def get_examples(num_examples: int):
+    return [{
+        'system': f'You are a helpful assistant. {i % 4}' if i % 2 == 0 else None,
+        'query': f'Question {i}: ' + '浙江的省会在哪？' * (i % 8 + 1),
+        'response': 'The capital of Zhejiang is Hangzhou. ' * (i % 4 + 1),
+        'history': [('Hello!', 'Hi, how can I help you?')] * (i % 3)
+    } for i in range(num_examples)]
+
+
+def benchmark_template(template_type: str, tokenizer, examples, use_token_cache: bool) -> float:
+    template = get_template(template_type, tokenizer)
+    template.use_token_cache = use_token_cache
+    template.encode(examples[0].copy())  # init the token cache
+    start = time.perf_counter()
+    for example in examples:
+        template.encode(example.copy())
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_type', type=str, default='qwen2-0_5b-instruct')
+    parser.add_argument('--num_examples', type=int, default=1000)
+    args = parser.parse_args()
+    _, tokenizer = get_model_tokenizer(args.model_type, load_model=False)
+    examples = get_examples(args.num_examples)
+    total = [0., 0.]
+    for template_type in TEMPLATE_MAPPING.keys():
+        try:
+            runtime = [benchmark_template(template_type, tokenizer, examples, use_cache) for use_cache in [False, True]]
+        except Exception:
+            continue  # multimodal templates
+        total = [t + r for t, r in zip(total, runtime)]
+        print(f'{template_type}: {runtime[0]:.3f}s -> {runtime[1]:.3f}s, speedup: {runtime[0] / runtime[1]:.2f}x')
+    print(f'total: {total[0]:.3f}s -> {total[1]:.3f}s, speedup: {total[0] / total[1]:.2f}x')
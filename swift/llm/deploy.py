@@ -6,68 +6,134 @@ import re
 import time
 from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict
+from functools import partial
 from http import HTTPStatus
-from threading import Thread
-from typing import Any, Dict, List, Optional, Union
+from threading import Event, Thread
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Literal, Optional, Union
 
 import json
 import torch
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from peft import PeftModel
-from transformers import GenerationConfig
+from transformers import GenerationConfig, PreTrainedModel, StoppingCriteria
 
 from swift.utils import get_logger, get_main, get_seed, seed_everything
 from .agent import split_action_action_input
-from .infer import merge_lora, prepare_model_template
+from .infer import merge_lora, prepare_assistant_model, prepare_model_template
 from .utils import (TEMPLATE_MAPPING, ChatCompletionMessageToolCall, ChatCompletionRequest, ChatCompletionResponse,
                     ChatCompletionResponseChoice, ChatCompletionResponseStreamChoice, ChatCompletionStreamResponse,
                     ChatMessage, CompletionRequest, CompletionResponse, CompletionResponseChoice,
-                    CompletionResponseStreamChoice, CompletionStreamResponse, DeltaMessage, DeployArguments, Function,
-                    Model, ModelList, Template, UsageInfo, compat_openai, inference, inference_stream, is_quant_model,
-                    messages_join_observation, messages_to_history, random_uuid, set_generation_config)
+                    CompletionResponseStreamChoice, CompletionStreamResponse, DeltaMessage, DeployArguments,
+                    DeployMetrics, EncodePool, Function, IncrementalDetokenizer, Model, ModelList, PrefixCache,
+                    PtLoRACache, PtScheduler, RequestStats, Template, UsageInfo, compat_openai, inference,
+                    inference_stream, is_quant_model, messages_join_observation, messages_to_history, random_uuid,
+                    set_generation_config)
 
 logger = get_logger()
 
-global_stats = {}
-default_global_stats = {
-    'num_prompt_tokens': 0,
-    'num_generated_tokens': 0,
-    'num_samples': 0,
-    'runtime': 0.,
-    'samples/s': 0.,
-    'tokens/s': 0.
-}
+_metrics = DeployMetrics()
+_DISCONNECT_POLL_INTERVAL = 0.1  # seconds
+# The pt generation without the scheduler (full and stream) runs off the event loop, one request at a time.
+_pt_executor = ThreadPoolExecutor(1, thread_name_prefix='pt_generate')
 
 
-async def _log_stats_hook(log_interval: int):
-    global global_stats
-    while True:
-        global_stats = default_global_stats.copy()
-        t = time.perf_counter()
-        await asyncio.sleep(log_interval)
-        runtime = time.perf_counter() - t
-        global_stats['runtime'] = runtime
-        global_stats['samples/s'] = global_stats['num_samples'] / runtime
-        global_stats['tokens/s'] = global_stats['num_generated_tokens'] / runtime
-        for k, v in global_stats.items():
-            global_stats[k] = round(v, 8)
-        logger.info(global_stats)
+class _CancelledCriteria(StoppingCriteria):
+    """Stop the pt generation running in another thread once the request is cancelled."""
+
+    def __init__(self, cancelled: Event) -> None:
+        self.cancelled = cancelled
+
+    def __call__(self, input_ids: torch.Tensor, scores: torch.Tensor, **kwargs) -> bool:
+        # A plain bool stops all the rows, with both the per-row (transformers>=4.39) and the older criteria.
+        return self.cancelled.is_set()
 
 
-def _update_stats(response) -> None:
+def _log_stats_hook(log_interval: int):
+    counters = {
+        'num_prompt_tokens': _metrics.prompt_tokens,
+        'num_generated_tokens': _metrics.generation_tokens,
+        'num_samples': _metrics.requests
+    }
+    last_values = {k: v.sum() for k, v in counters.items()}
+    t = time.perf_counter()
+    while True:
+        time.sleep(log_interval)
+        values = {k: v.sum() for k, v in counters.items()}
+        runtime = time.perf_counter() - t
+        t += runtime
+        stats = {k: values[k] - last_values[k] for k in counters.keys()}
+        last_values = values
+        stats['num_requests_in_flight'] = _metrics.requests_in_flight.sum()
+        stats['runtime'] = runtime
+        stats['samples/s'] = stats['num_samples'] / runtime
+        stats['tokens/s'] = stats['num_generated_tokens'] / runtime
+        if _pt_scheduler is not None and _pt_scheduler.prefix_cache is not None:
+            stats['prefix_cache_hit_rate'] = _pt_scheduler.prefix_cache.hit_rate
+        if _args.speculative_model_type is not None:
+            num_draft_tokens = _metrics.spec_decode_draft_tokens.sum()
+            stats['spec_decode_acceptance_rate'] = (
+                _metrics.spec_decode_accepted_tokens.sum() / num_draft_tokens if num_draft_tokens > 0 else 0.)
+        for k, v in stats.items():
+            stats[k] = round(v, 8)
+        logger.info(stats)
+
+
+def _update_stats(request_stats: RequestStats, response) -> None:
     if response is None:
         return
     usage_info = response.usage
-    global_stats['num_prompt_tokens'] += usage_info.prompt_tokens
-    global_stats['num_generated_tokens'] += usage_info.completion_tokens
-    global_stats['num_samples'] += 1
+    request_stats.set_usage(usage_info.prompt_tokens, usage_info.completion_tokens)
+
+
+class _AdmissionController:
+    """Bounds the sequences and the tokens (prompt + max_tokens) of the in-flight requests."""
+
+    def __init__(self, max_concurrent_seqs: Optional[int] = None, max_queued_tokens: Optional[int] = None) -> None:
+        self.max_concurrent_seqs = max_concurrent_seqs
+        self.max_queued_tokens = max_queued_tokens
+        self.num_seqs = 0
+        self.num_tokens = 0
+
+    def acquire_seqs(self, state, num_seqs: int) -> bool:
+        if self.max_concurrent_seqs is not None and self.num_seqs + num_seqs > self.max_concurrent_seqs:
+            return False
+        self.num_seqs += num_seqs
+        state.num_seqs = num_seqs
+        return True
+
+    def acquire_tokens(self, state, num_tokens: int) -> bool:
+        # A request is always admitted if the server is idle, even if it exceeds the limit.
+        if (self.max_queued_tokens is not None and self.num_tokens > 0
+                and self.num_tokens + num_tokens > self.max_queued_tokens):
+            return False
+        self.num_tokens += num_tokens
+        state.num_tokens = num_tokens
+        return True
+
+    def release(self, state) -> None:
+        self.num_seqs -= getattr(state, 'num_seqs', 0)
+        self.num_tokens -= getattr(state, 'num_tokens', 0)
+        state.num_seqs = state.num_tokens = 0
+
+
+_admission = _AdmissionController()
+
+
+def _finish_request(raw_request: Request,
+                    status: Literal['success', 'error', 'aborted', 'timeout'] = 'success') -> None:
+    raw_request.state.request_stats.finish(status)
+    _admission.release(raw_request.state)
+    lora_name = getattr(raw_request.state, 'lora_name', None)
+    if lora_name is not None:
+        raw_request.state.lora_name = None
+        _lora_cache.release(lora_name)
 
 
 def lifespan(app: FastAPI):
     global _args
     if _args.log_interval > 0:
-        thread = Thread(target=lambda: asyncio.run(_log_stats_hook(_args.log_interval)))
+        thread = Thread(target=_log_stats_hook, args=(_args.log_interval, ), daemon=True)
         thread.start()
     yield
 
@@ -77,6 +143,11 @@ _args: Optional[DeployArguments] = None
 model = None
 llm_engine = None
 template: Optional[Template] = None
+_pt_scheduler: Optional[PtScheduler] = None
+_lora_cache: Optional[PtLoRACache] = None
+_assistant_model: Optional[PreTrainedModel] = None  # the draft model of speculative decoding
+_encode_pool: Optional[EncodePool] = None
+_model_list: Optional[ModelList] = None  # static, built at startup
 
 
 def create_error_response(status_code: Union[int, str, HTTPStatus], message: str) -> JSONResponse:
@@ -84,22 +155,28 @@ def create_error_response(status_code: Union[int, str, HTTPStatus], message: str
     return JSONResponse({'message': message, 'object': 'error'}, status_code)
 
 
-@app.get('/v1/models')
-async def get_available_models():
-    global _args
-    model_list = [_args.served_model_name or _args.model_type]
-    if _args.lora_request_list is not None:
-        model_list += [lora_request.lora_name for lora_request in _args.lora_request_list]
+def _get_model_list(args: DeployArguments) -> ModelList:
+    model_list = [args.served_model_name or args.model_type]
+    if args.lora_request_list is not None:
+        model_list += [lora_request.lora_name for lora_request in args.lora_request_list]
     data = [
         Model(
             id=model_id,
-            is_chat=not is_generation_template(_args.template_type),
-            is_multimodal=_args.is_multimodal,
-            owned_by=_args.owned_by) for model_id in model_list
+            is_chat=not is_generation_template(args.template_type),
+            is_multimodal=args.is_multimodal,
+            owned_by=args.owned_by) for model_id in model_list
     ]
     return ModelList(data=data)
 
 
+@app.get('/v1/models')
+async def get_available_models():
+    global _model_list
+    if _model_list is None:
+        _model_list = _get_model_list(_args)
+    return _model_list
+
+
 async def check_length(request: Union[ChatCompletionRequest, CompletionRequest],
                        input_ids: List[int],
                        strict: bool = False) -> Optional[str]:
@@ -130,7 +207,7 @@ async def check_length(request: Union[ChatCompletionRequest, CompletionRequest],
 
 
 async def check_model(request: Union[ChatCompletionRequest, CompletionRequest]) -> Optional[str]:
-    model_list = await get_available_models()
+    model_list = await get_available_models()  # cached
     model_type_list = [model.id for model in model_list.data]
     if request.model in model_type_list:
         return
@@ -157,7 +234,7 @@ def logger_request(request_info: Dict[str, Any]) -> None:
 
 
 async def _prepare_request(request: Union[ChatCompletionRequest, CompletionRequest], raw_request: Request):
-    global template, model, llm_engine, _args
+    global template, model, llm_engine, _args, _encode_pool
     if _args.api_key is not None:
         is_valid = _check_api_key(raw_request, _args.api_key)
         if not is_valid:
@@ -218,17 +295,22 @@ async def _prepare_request(request: Union[ChatCompletionRequest, CompletionReque
         medias = getattr(request, media_key, None)
         if medias:
             example[media_key] = medias
-    executor = ThreadPoolExecutor(max_workers=1)
-    loop = asyncio.get_running_loop()
-    inputs = (await loop.run_in_executor(executor, template.encode, example))[0]
+    (inputs, _), encode_wait_time = await _encode_pool.encode(example)
+    raw_request.state.request_stats.encoded(encode_wait_time)
     request_info = {'request_id': request_id}
     request_info.update(_request)
+    request_info['encode_wait_time'] = round(encode_wait_time, 6)
 
     if 'input_ids' in inputs:
         input_ids = inputs['input_ids']
         error_msg = await check_length(request, input_ids)
         if error_msg is not None:
             return create_error_response(HTTPStatus.BAD_REQUEST, error_msg)
+        num_tokens = (len(input_ids) + request.max_tokens) * (getattr(request, 'n', None) or 1)
+        if not _admission.acquire_tokens(raw_request.state, num_tokens):
+            return create_error_response(
+                HTTPStatus.SERVICE_UNAVAILABLE, f'The server is saturated: the queued tokens exceed '
+                f'max_queued_tokens({_admission.max_queued_tokens}). Please retry later.')
 
     return request_info, inputs, example
 
@@ -261,6 +343,18 @@ def _get_logprobs_vllm(logprobs_list: Optional[List[Dict[int, float]]],
     return {'content': res}
 
 
+async def _abort_on_exit(result_generator: AsyncIterator[Any], request_id: str) -> AsyncIterator[Any]:
+    # Abort the vllm request if the generation is cancelled, e.g. the client is disconnected.
+    is_finished = False
+    try:
+        async for result in result_generator:
+            yield result
+        is_finished = True
+    finally:
+        if not is_finished:
+            await llm_engine.abort(request_id)
+
+
 @torch.inference_mode()
 async def inference_vllm_async(request: Union[ChatCompletionRequest, CompletionRequest], raw_request: Request):
     global llm_engine, template, _args
@@ -273,6 +367,7 @@ async def inference_vllm_async(request: Union[ChatCompletionRequest, CompletionR
 
     request_info, inputs, _ = result
     request_id = request_info['request_id']
+    request_stats: RequestStats = raw_request.state.request_stats
 
     kwargs = {'max_tokens': request.max_tokens}
     for key in ['n', 'best_of', 'frequency_penalty', 'length_penalty', 'presence_penalty', 'num_beams']:
@@ -319,15 +414,16 @@ async def inference_vllm_async(request: Union[ChatCompletionRequest, CompletionR
         assert lora_request is not None
         generate_kwargs['lora_request'] = lora_request
 
-    result_generator = add_vllm_request(
-        llm_engine, inputs, request_id=request_id, generation_config=generation_config, **generate_kwargs)
+    request_stats.submit()
+    result_generator = _abort_on_exit(
+        add_vllm_request(
+            llm_engine, inputs, request_id=request_id, generation_config=generation_config, **generate_kwargs),
+        request_id)
 
     async def _generate_full():
         result = None
         async for result in result_generator:
-            if await raw_request.is_disconnected():
-                await llm_engine.abort(request_id)
-                return create_error_response(HTTPStatus.BAD_REQUEST, 'Client disconnected')
+            request_stats.step(sum(len(output.token_ids) for output in result.outputs))
         assert result is not None
         num_prompt_tokens = len(result.prompt_token_ids)
         num_generated_tokens = sum(len(output.token_ids) for output in result.outputs)
@@ -369,17 +465,16 @@ async def inference_vllm_async(request: Union[ChatCompletionRequest, CompletionR
                 choices.append(choice)
             response = CompletionResponse(
                 model=request.model, choices=choices, usage=usage_info, id=request_id, created=created_time)
-        if _args.log_interval > 0:
-            _update_stats(response)
+        _update_stats(request_stats, response)
         return response
 
     async def _generate_stream():
-        print_idx_list = [[0] for _ in range(request.n)]
-        total_res = ['' for _ in range(request.n)]
+        detokenizer_list = [IncrementalDetokenizer(template) for _ in range(request.n)]
         response = None
         async for result in result_generator:
             num_prompt_tokens = len(result.prompt_token_ids)
             num_generated_tokens = sum(len(output.token_ids) for output in result.outputs)
+            request_stats.step(num_generated_tokens)
             usage_info = UsageInfo(
                 prompt_tokens=num_prompt_tokens,
                 completion_tokens=num_generated_tokens,
@@ -388,9 +483,7 @@ async def inference_vllm_async(request: Union[ChatCompletionRequest, CompletionR
             is_diff = False
             has_finished = False
             for output in result.outputs:
-                output.delta_text = template.generate_ids_to_response(
-                    output.token_ids, output.finished(), return_delta=True, print_idx=print_idx_list[output.index])
-                total_res[output.index] += output.delta_text
+                output.delta_text = detokenizer_list[output.index].step(output.token_ids, output.finished())
                 is_diff |= bool(output.delta_text)
                 has_finished |= output.finish_reason is not None
             if not is_diff and not has_finished:
@@ -400,7 +493,7 @@ async def inference_vllm_async(request: Union[ChatCompletionRequest, CompletionR
                 for output in result.outputs:
                     toolcall = None
                     if output.finish_reason is not None:
-                        action, action_input = split_action_action_input(total_res[output.index])
+                        action, action_input = split_action_action_input(detokenizer_list[output.index].response)
                         if action is not None:
                             toolcall = [
                                 ChatCompletionMessageToolCall(
@@ -424,8 +517,7 @@ async def inference_vllm_async(request: Union[ChatCompletionRequest, CompletionR
                 response = CompletionStreamResponse(
                     model=request.model, choices=choices, usage=usage_info, id=request_id, created=created_time)
             yield f'data:{json.dumps(asdict(response), ensure_ascii=False)}\n\n'
-        if _args.log_interval > 0:
-            _update_stats(response)
+        _update_stats(request_stats, response)
         yield 'data:[DONE]\n\n'
 
     if request.stream:
@@ -468,6 +560,7 @@ async def inference_lmdeploy_async(request: Union[ChatCompletionRequest, Complet
 
     request_info, inputs, _ = result
     request_id = request_info['request_id']
+    request_stats: RequestStats = raw_request.state.request_stats
 
     kwargs = {'max_new_tokens': request.max_tokens}
     for key in ['temperature', 'top_k', 'top_p', 'repetition_penalty']:
@@ -499,6 +592,7 @@ async def inference_lmdeploy_async(request: Union[ChatCompletionRequest, Complet
     if _args.verbose:
         logger_request(request_info)
 
+    request_stats.submit()
     session_id = time.time_ns()
     generator = await llm_engine.get_generator(False, session_id)
     images = inputs.pop('images', None) or []
@@ -546,14 +640,12 @@ async def inference_lmdeploy_async(request: Union[ChatCompletionRequest, Complet
             choices = [CompletionResponseChoice(index=0, text=response, finish_reason=finish_reason, logprobs=logprobs)]
             response = CompletionResponse(
                 model=request.model, choices=choices, usage=usage_info, id=request_id, created=created_time)
-        if _args.log_interval > 0:
-            _update_stats(response)
+        _update_stats(request_stats, response)
         return response
 
     async def _generate_stream():
         num_prompt_tokens = len(inputs['input_ids'])
-        total_response = ''
-        print_idx = [0]
+        detokenizer = IncrementalDetokenizer(template)
         async with llm_engine.safe_run(session_id):
             async_iter = generator.async_stream_infer(
                 session_id=session_id, **inputs, stream_output=True, gen_config=generation_config).__aiter__()
@@ -565,24 +657,23 @@ async def inference_lmdeploy_async(request: Union[ChatCompletionRequest, Complet
                 except StopAsyncIteration:
                     is_finished = True
                 num_generated_tokens = len(output.token_ids)
+                request_stats.step(num_generated_tokens)
                 usage_info = UsageInfo(
                     prompt_tokens=num_prompt_tokens,
                     completion_tokens=num_generated_tokens,
                     total_tokens=num_prompt_tokens + num_generated_tokens,
                 )
-                delta_text = template.generate_ids_to_response(
-                    output.token_ids, is_finished, return_delta=True, print_idx=print_idx)
+                delta_text = detokenizer.step(output.token_ids, is_finished)
 
                 finish_reason = None
                 if output.status.name == 'FINISH':
                     finish_reason = 'stop'
                 if not delta_text and finish_reason != 'stop':
                     continue
-                total_response += delta_text
                 if isinstance(request, ChatCompletionRequest):
                     toolcall = None
                     if finish_reason == 'stop':
-                        action, action_input = split_action_action_input(total_response)
+                        action, action_input = split_action_action_input(detokenizer.response)
                         if action is not None:
                             toolcall = [
                                 ChatCompletionMessageToolCall(
@@ -603,8 +694,7 @@ async def inference_lmdeploy_async(request: Union[ChatCompletionRequest, Complet
                     response = CompletionStreamResponse(
                         model=request.model, choices=choices, usage=usage_info, id=request_id, created=created_time)
                 yield f'data:{json.dumps(asdict(response), ensure_ascii=False)}\n\n'
-            if _args.log_interval > 0:
-                _update_stats(response)
+            _update_stats(request_stats, response)
             yield 'data:[DONE]\n\n'
 
     if request.stream:
@@ -663,14 +753,15 @@ def _get_logprobs_pt(logits_list: Optional[List[torch.Tensor]],
 
 @torch.inference_mode()
 async def inference_pt_async(request: Union[ChatCompletionRequest, CompletionRequest], raw_request: Request):
-    global model, template, _args
+    global model, template, _args, _pt_scheduler, _lora_cache
     created_time = int(time.time())
     result = await _prepare_request(request, raw_request)
     if isinstance(result, JSONResponse):
         return result
 
-    request_info, _, example = result
+    request_info, inputs, example = result
     request_id = request_info['request_id']
+    request_stats: RequestStats = raw_request.state.request_stats
 
     kwargs = {'max_new_tokens': request.max_tokens}
     # not use: 'n', 'best_of', 'frequency_penalty', 'presence_penalty'
@@ -699,6 +790,7 @@ async def inference_pt_async(request: Union[ChatCompletionRequest, CompletionReq
         kwargs['output_logits'] = True
 
     generation_config = _GenerationConfig(**kwargs)
+    generation_config.prompt_lookup_num_tokens = model.generation_config.prompt_lookup_num_tokens
     _old_generation_config = model.generation_config
     set_generation_config(model, generation_config)  # inplace
     model.generation_config = _old_generation_config
@@ -729,27 +821,66 @@ async def inference_pt_async(request: Union[ChatCompletionRequest, CompletionReq
             adapter_kwargs['adapter_names'] = [adapter_names]
         elif isinstance(model, PeftModel):
             adapter_kwargs['adapter_names'] = ['-']  # use base model
-
-    async def _generate_full():
-        generation_info = {}
-        resp = inference(
-            model,
-            template,
-            **example,
-            stop_words=stop,
-            generation_config=generation_config,
-            generation_info=generation_info,
-            **adapter_kwargs)
-        response = resp['response']
-        logprobs = _get_logprobs_pt(resp.get('logits'), resp.get('sequences'), request.top_logprobs)
-
-        num_prompt_tokens = generation_info['num_prompt_tokens']
-        num_generated_tokens = generation_info['num_generated_tokens']
-        usage_info = UsageInfo(
+    if _lora_cache is not None and 'adapter_names' in adapter_kwargs:
+        lora_name = adapter_kwargs['adapter_names'][0]
+        # Loading the adapter blocks until the running step of the scheduler is finished.
+        await asyncio.get_running_loop().run_in_executor(None, _lora_cache.acquire, lora_name)
+        raw_request.state.lora_name = lora_name
+
+    request_stats.submit()
+    use_scheduler = _pt_scheduler is not None and _pt_scheduler.is_supported(inputs, generation_config)
+    if use_scheduler:
+        num_prompt_tokens = len(inputs['input_ids'])
+        gen = _pt_scheduler.generate(
+            inputs['input_ids'],
+            generation_config,
+            stop,
+            adapter_names=adapter_kwargs.get('adapter_names'),
+            seed=request.seed,
+            output_logits=bool(request.logprobs))
+
+    def _get_usage_info(num_prompt_tokens: int, num_generated_tokens: int) -> UsageInfo:
+        return UsageInfo(
             prompt_tokens=num_prompt_tokens,
             completion_tokens=num_generated_tokens,
             total_tokens=num_prompt_tokens + num_generated_tokens,
         )
+
+    async def _generate_full():
+        if use_scheduler:
+            generate_ids, logits_list = [], []
+            async for output in gen:
+                generate_ids += output['token_ids']
+                logits_list += output.get('logits', [])
+                request_stats.step(len(generate_ids))
+            response = template.generate_ids_to_response(generate_ids)
+            response = template.post_process_generate_response(response=response, example=example)
+            logprobs = _get_logprobs_pt(logits_list or None, generate_ids, request.top_logprobs)
+            usage_info = _get_usage_info(num_prompt_tokens, len(generate_ids))
+        else:
+            generation_info = {}
+            cancelled = Event()
+            try:
+                resp = await asyncio.get_running_loop().run_in_executor(
+                    _pt_executor,
+                    partial(
+                        inference,
+                        model,
+                        template,
+                        **example,
+                        stop_words=stop,
+                        generation_config=generation_config,
+                        generation_info=generation_info,
+                        assistant_model=_assistant_model,
+                        stopping_criteria=[_CancelledCriteria(cancelled)],
+                        **adapter_kwargs))
+            finally:
+                cancelled.set()  # the client disconnected or the deadline is exceeded
+            response = resp['response']
+            logprobs = _get_logprobs_pt(resp.get('logits'), resp.get('sequences'), request.top_logprobs)
+            usage_info = _get_usage_info(generation_info['num_prompt_tokens'], generation_info['num_generated_tokens'])
+            if 'num_draft_tokens' in generation_info:
+                request_stats.speculate(generation_info['num_draft_tokens'], generation_info['num_accepted_tokens'])
         if isinstance(request, ChatCompletionRequest):
             action, action_input = split_action_action_input(response)
             toolcall = None
@@ -773,100 +904,226 @@ async def inference_pt_async(request: Union[ChatCompletionRequest, CompletionReq
             choices = [CompletionResponseChoice(index=0, text=response, finish_reason=None, logprobs=logprobs)]
             response = CompletionResponse(
                 model=request.model, choices=choices, usage=usage_info, id=request_id, created=created_time)
-        if _args.log_interval > 0:
-            _update_stats(response)
+        _update_stats(request_stats, response)
         return response
 
-    def _generate_stream():
+    def _get_stream_resp(response: str, delta_text: str, is_finished: bool, usage_info: UsageInfo):
+        if isinstance(request, ChatCompletionRequest):
+            toolcall = None
+            if is_finished:
+                action, action_input = split_action_action_input(response)
+                if action:
+                    toolcall = [
+                        ChatCompletionMessageToolCall(
+                            id=f'toolcall-{random_uuid()}',
+                            type='function',
+                            function=Function(name=action, arguments=action_input))
+                    ]
+            choices = [
+                ChatCompletionResponseStreamChoice(
+                    index=0,
+                    delta=DeltaMessage(role='assistant', content=delta_text, tool_calls=toolcall),
+                    finish_reason=None)
+            ]
+            return ChatCompletionStreamResponse(
+                model=request.model, choices=choices, usage=usage_info, id=request_id, created=created_time)
+        else:
+            choices = [CompletionResponseStreamChoice(index=0, text=delta_text, finish_reason=None)]
+            return CompletionStreamResponse(
+                model=request.model, choices=choices, usage=usage_info, id=request_id, created=created_time)
+
+    async def _generate_stream_async():
+        generate_ids = []
+        detokenizer = IncrementalDetokenizer(template)
+        async for output in gen:
+            generate_ids += output['token_ids']
+            request_stats.step(len(generate_ids))
+            is_finished = output['is_finished']
+            delta_text = detokenizer.step(generate_ids, is_finished)
+            if not delta_text and not is_finished:
+                continue
+            usage_info = _get_usage_info(num_prompt_tokens, len(generate_ids))
+            resp = _get_stream_resp(detokenizer.response, delta_text, is_finished, usage_info)
+            yield f'data:{json.dumps(asdict(resp), ensure_ascii=False)}\n\n'
+        _update_stats(request_stats, resp)
+        yield 'data:[DONE]\n\n'
+
+    async def _generate_stream():
         generation_info = {}
-        gen = inference_stream(
-            model,
-            template,
-            **example,
-            stop_words=stop,
-            generation_config=generation_config,
-            generation_info=generation_info,
-            **adapter_kwargs)
+        cancelled = Event()
+        gen = _iterate_in_pt_executor(
+            partial(
+                inference_stream,
+                model,
+                template,
+                **example,
+                stop_words=stop,
+                generation_config=generation_config,
+                generation_info=generation_info,
+                assistant_model=_assistant_model,
+                stopping_criteria=[_CancelledCriteria(cancelled)],
+                **adapter_kwargs), cancelled)
 
         print_idx = 0
         response = ''
         is_finished = False
-        while not is_finished:
-            try:
-                response = next(gen)['response']
-            except StopIteration:
-                is_finished = True
-            num_prompt_tokens = generation_info['num_prompt_tokens']
-            num_generated_tokens = generation_info['num_generated_tokens']
-            usage_info = UsageInfo(
-                prompt_tokens=num_prompt_tokens,
-                completion_tokens=num_generated_tokens,
-                total_tokens=num_prompt_tokens + num_generated_tokens,
-            )
-            delta_text = response[print_idx:]
-            if not delta_text and not is_finished:
-                continue
-            print_idx = len(response)
-            if isinstance(request, ChatCompletionRequest):
-                toolcall = None
-                if is_finished:
-                    action, action_input = split_action_action_input(response)
-                    if action:
-                        toolcall = [
-                            ChatCompletionMessageToolCall(
-                                id=f'toolcall-{random_uuid()}',
-                                type='function',
-                                function=Function(name=action, arguments=action_input))
-                        ]
-                choices = [
-                    ChatCompletionResponseStreamChoice(
-                        index=0,
-                        delta=DeltaMessage(role='assistant', content=delta_text, tool_calls=toolcall),
-                        finish_reason=None)
-                ]
-                resp = ChatCompletionStreamResponse(
-                    model=request.model, choices=choices, usage=usage_info, id=request_id, created=created_time)
-            else:
-                choices = [CompletionResponseStreamChoice(index=0, text=delta_text, finish_reason=None)]
-                resp = CompletionStreamResponse(
-                    model=request.model, choices=choices, usage=usage_info, id=request_id, created=created_time)
-            yield f'data:{json.dumps(asdict(resp), ensure_ascii=False)}\n\n'
-        if _args.log_interval > 0:
-            _update_stats(resp)
+        try:
+            while not is_finished:
+                try:
+                    response = (await gen.__anext__())['response']
+                except StopAsyncIteration:
+                    is_finished = True
+                request_stats.step(generation_info['num_generated_tokens'])
+                usage_info = _get_usage_info(generation_info['num_prompt_tokens'],
+                                             generation_info['num_generated_tokens'])
+                delta_text = response[print_idx:]
+                if not delta_text and not is_finished:
+                    continue
+                print_idx = len(response)
+                resp = _get_stream_resp(response, delta_text, is_finished, usage_info)
+                yield f'data:{json.dumps(asdict(resp), ensure_ascii=False)}\n\n'
+        finally:
+            cancelled.set()  # the stream is closed: the client disconnected or the deadline is exceeded
+        _update_stats(request_stats, resp)
+        if 'num_draft_tokens' in generation_info:
+            request_stats.speculate(generation_info['num_draft_tokens'], generation_info['num_accepted_tokens'])
         yield 'data:[DONE]\n\n'
 
     if request.stream:
-        return StreamingResponse(_generate_stream())
+        return StreamingResponse(_generate_stream_async() if use_scheduler else _generate_stream())
     else:
         return await _generate_full()
 
 
-@app.post('/v1/chat/completions')
-async def create_chat_completion(request: ChatCompletionRequest, raw_request: Request):
+async def _iterate_in_pt_executor(gen_func: Callable[[], Iterator[Any]], cancelled: Event) -> AsyncIterator[Any]:
+    """Run the whole blocking iteration in `_pt_executor`, so that it does not run concurrently with the other
+    generations on the model, and yield its items on the event loop. The iteration stops once `cancelled` is set."""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    end = object()
+
+    def _run() -> None:
+        try:
+            if not cancelled.is_set():  # cancelled while waiting for the executor
+                for item in gen_func():
+                    loop.call_soon_threadsafe(queue.put_nowait, item)
+                    if cancelled.is_set():
+                        break
+        except BaseException as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, end)
+
+    loop.run_in_executor(_pt_executor, _run)
+    while True:
+        item = await queue.get()
+        if item is end:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+async def _wrap_stream(body_iterator: AsyncIterator[str], raw_request: Request,
+                       deadline: Optional[float]) -> AsyncIterator[str]:
+    status = 'aborted'  # the client disconnected: the generation is cancelled with the iterator.
+    try:
+        while True:
+            timeout = None if deadline is None else max(deadline - time.perf_counter(), 0)
+            try:
+                chunk = await asyncio.wait_for(body_iterator.__anext__(), timeout)
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                status = 'timeout'
+                error = {'message': 'Request timeout', 'object': 'error'}
+                yield f'data:{json.dumps(error)}\n\n'
+                return
+            yield chunk
+        status = 'success'
+    except Exception:
+        status = 'error'
+        raise
+    finally:
+        _finish_request(raw_request, status)
+        if hasattr(body_iterator, 'aclose'):
+            await body_iterator.aclose()
+
+
+async def _run_until_disconnected(coro, raw_request: Request, deadline: Optional[float]):
+    """Run the coroutine, cancel it if the client disconnects or the deadline is exceeded."""
+    task = asyncio.create_task(coro)
+    while True:
+        timeout = _DISCONNECT_POLL_INTERVAL
+        if deadline is not None:
+            timeout = min(timeout, max(deadline - time.perf_counter(), 0))
+        done, _ = await asyncio.wait({task}, timeout=timeout)
+        if done:
+            return task.result()
+        if deadline is not None and time.perf_counter() >= deadline:
+            task.cancel()
+            return create_error_response(HTTPStatus.REQUEST_TIMEOUT, 'Request timeout')
+        if await raw_request.is_disconnected():
+            task.cancel()
+            return None
+
+
+async def _inference_async(request: Union[ChatCompletionRequest, CompletionRequest], raw_request: Request):
     global _args
     assert _args is not None
     if request.stop is None:
         request.stop = []
+    model_list = await get_available_models()  # cached
+    model_name = request.model
+    if model_name not in {model.id for model in model_list.data}:
+        model_name = 'unknown'  # bound the label values of the metrics
+    raw_request.state.request_stats = _metrics.start_request(model_name)
+    deadline = None
+    if _args.request_timeout is not None:
+        deadline = raw_request.state.request_stats.arrival_time + _args.request_timeout
+    if not _admission.acquire_seqs(raw_request.state, getattr(request, 'n', None) or 1):
+        _finish_request(raw_request, 'error')
+        return create_error_response(
+            HTTPStatus.TOO_MANY_REQUESTS, f'The server is saturated: the concurrent sequences exceed '
+            f'max_concurrent_seqs({_admission.max_concurrent_seqs}). Please retry later.')
     if _args.infer_backend == 'vllm':
-        return await inference_vllm_async(request, raw_request)
+        coro = inference_vllm_async(request, raw_request)
     elif _args.infer_backend == 'lmdeploy':
-        return await inference_lmdeploy_async(request, raw_request)
+        coro = inference_lmdeploy_async(request, raw_request)
+    else:
+        coro = inference_pt_async(request, raw_request)
+    try:
+        res = await _run_until_disconnected(coro, raw_request, deadline)
+    except BaseException:
+        _finish_request(raw_request, 'error')
+        raise
+    if res is None:
+        _finish_request(raw_request, 'aborted')
+        return create_error_response(HTTPStatus.BAD_REQUEST, 'Client disconnected')
+    if isinstance(res, StreamingResponse):
+        res.body_iterator = _wrap_stream(res.body_iterator, raw_request, deadline)
+    elif isinstance(res, JSONResponse) and res.status_code == HTTPStatus.REQUEST_TIMEOUT:
+        _finish_request(raw_request, 'timeout')
+    elif isinstance(res, JSONResponse) and res.status_code >= 400:
+        _finish_request(raw_request, 'error')
     else:
-        return await inference_pt_async(request, raw_request)
+        _finish_request(raw_request)
+    return res
+
+
+@app.post('/v1/chat/completions')
+async def create_chat_completion(request: ChatCompletionRequest, raw_request: Request):
+    return await _inference_async(request, raw_request)
 
 
 @app.post('/v1/completions')
 async def create_completion(request: CompletionRequest, raw_request: Request):
-    global _args
-    assert _args is not None
-    if request.stop is None:
-        request.stop = []
-    if _args.infer_backend == 'vllm':
-        return await inference_vllm_async(request, raw_request)
-    elif _args.infer_backend == 'lmdeploy':
-        return await inference_lmdeploy_async(request, raw_request)
-    else:
-        return await inference_pt_async(request, raw_request)
+    return await _inference_async(request, raw_request)
+
+
+@app.get('/metrics')
+async def get_metrics():
+    return PlainTextResponse(_metrics.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 def llm_deploy(args: DeployArguments) -> None:
@@ -875,8 +1132,11 @@ def llm_deploy(args: DeployArguments) -> None:
     logger_format = logging.Formatter('%(levelname)s: %(asctime)s %(filename)s:%(lineno)d] %(message)s')
     logger.handlers[0].setFormatter(logger_format)
     import uvicorn
-    global llm_engine, model, template, _args
+    global llm_engine, model, template, _args, _pt_scheduler, _lora_cache, _assistant_model, _encode_pool, _admission
+    global _model_list
     _args = args
+    _model_list = _get_model_list(args)
+    _admission = _AdmissionController(args.max_concurrent_seqs, args.max_queued_tokens)
     if args.merge_lora:
         merge_lora(args, device_map=args.merge_device_map)
     if args.infer_backend == 'vllm':
@@ -889,6 +1149,20 @@ def llm_deploy(args: DeployArguments) -> None:
         template._is_lmdeploy = True
     else:
         model, template = prepare_model_template(args)
+        template.model = model
+        _assistant_model = prepare_assistant_model(args, model, template.tokenizer)
+        if args.max_loras is not None and isinstance(model, PeftModel) and args.lora_request_list is not None:
+            _lora_cache = PtLoRACache(model, args.lora_request_list, args.max_loras)
+        if args.max_batch_size > 1:
+            prefix_cache = PrefixCache(args.prefix_cache_max_tokens) if args.prefix_cache_max_tokens > 0 else None
+            _pt_scheduler = PtScheduler(model, template, args.max_batch_size, _lora_cache, prefix_cache)
+        elif args.prefix_cache_max_tokens > 0:
+            logger.warning('The prefix cache is only supported by the scheduler, i.e. `max_batch_size > 1`.')
+    encode_num_proc = args.encode_num_proc
+    if encode_num_proc > 0 and args.infer_backend not in {'vllm', 'lmdeploy'}:
+        logger.warning('The pt backend encodes the medias with the model, so `encode_num_proc` is ignored.')
+        encode_num_proc = 0
+    _encode_pool = EncodePool(template, args.encode_num_threads, encode_num_proc)
     uvicorn.run(app, host=args.host, port=args.port, ssl_keyfile=args.ssl_keyfile, ssl_certfile=args.ssl_certfile)
 
 
@@ -22,7 +22,7 @@ from transformers import GenerationConfig
 
 from swift.utils import append_to_jsonl, get_logger, get_main, seed_everything
 from .infer import merge_lora, prepare_model_template
-from .utils import DeployArguments, EvalArguments, XRequestConfig, inference, inference_client_async
+from .utils import AsyncInferenceClient, DeployArguments, EvalArguments, XRequestConfig, inference
 
 logger = get_logger()
 
@@ -43,35 +43,21 @@ class EvalModel(CustomModel):
         super().__init__(config={'model_id': model_name}, **kwargs)
         self.model_name = model_name
 
-    @staticmethod
-    async def _call_openai(model_type: str, query: str, eval_url: str, *, is_chat_model: bool,
-                           request_config: XRequestConfig, prog_bar: tqdm) -> Tuple[str, Optional[int]]:
-        # idx: maintain the order
-        resp = await inference_client_async(
-            model_type, query, is_chat_request=is_chat_model, request_config=request_config, url=eval_url)
-        if is_chat_model:
-            response = resp.choices[0].message.content
-        else:
-            response = resp.choices[0].text
-        prog_bar.update()
-        return response
-
     async def call_openai_batched(self, prompts: List[str], request_config: XRequestConfig) -> List[str]:
         assert self.args.eval_is_chat_model is not None
         use_tqdm = True if len(prompts) >= 20 else False
-        prog_bar = tqdm(total=len(prompts), dynamic_ncols=True, disable=not use_tqdm)
-        tasks = []
-        for prompt in prompts:
-            tasks.append(
-                self._call_openai(
-                    self.args.model_type,
-                    prompt,
-                    self.args.eval_url,
-                    is_chat_model=self.args.eval_is_chat_model,
-                    request_config=request_config,
-                    prog_bar=prog_bar))
-        response_list: List[Optional[str]] = await asyncio.gather(*tasks)
-        prog_bar.close()
+        request_list = [{
+            'model_type': self.args.model_type,
+            'query': prompt,
+            'is_chat_request': self.args.eval_is_chat_model,
+            'is_multimodal': False
+        } for prompt in prompts]
+        async with AsyncInferenceClient(api_key=self.args.eval_token, url=self.args.eval_url) as client:
+            resp_list = await client.infer_batch(request_list, request_config=request_config, use_tqdm=use_tqdm)
+        if self.args.eval_is_chat_model:
+            response_list = [resp.choices[0].message.content for resp in resp_list]
+        else:
+            response_list = [resp.choices[0].text for resp in resp_list]
         return response_list
 
     def predict(self, prompts: List[str], **kwargs) -> List[Dict[str, Any]]:
@@ -13,13 +13,14 @@ from transformers import BitsAndBytesConfig, GenerationConfig, PreTrainedModel,
 from transformers.utils import is_torch_npu_available
 
 from swift.tuners import Swift
-from swift.utils import (append_to_jsonl, get_logger, get_main, get_model_info, read_multi_line, seed_everything,
-                         show_layers)
+from swift.utils import JsonlWriter, get_logger, get_main, get_model_info, read_multi_line, seed_everything, show_layers
 from .utils import (DeployArguments, InferArguments, MediaTag, Template, get_additional_saved_files, get_dataset,
-                    get_model_tokenizer, get_template, inference, inference_stream, is_adapter, is_quant_model,
-                    sample_dataset, set_generation_config)
+                    get_model_tokenizer, get_template, inference, inference_pt, inference_stream, is_adapter,
+                    is_quant_model, sample_dataset, set_generation_config)
 
 logger = get_logger()
+# The number of rows inferred (and saved) at a time by the batched backends when saving results.
+_RESUME_CHUNK_SIZE = 1024
 
 
 def save_checkpoint(model: Optional[PreTrainedModel],
@@ -201,6 +202,8 @@ def prepare_model_template(args: InferArguments,
         num_beams=args.num_beams,
         pad_token_id=tokenizer.pad_token_id,
         eos_token_id=tokenizer.eos_token_id)
+    if args.speculative_model_type == 'ngram':
+        generation_config.prompt_lookup_num_tokens = args.num_speculative_tokens
     set_generation_config(model, generation_config)
     logger.info(f'model.generation_config: {model.generation_config}')
 
@@ -219,7 +222,11 @@ def prepare_model_template(args: InferArguments,
     if is_adapter(args.sft_type) and args.ckpt_dir is not None:
         if isinstance(args, DeployArguments) and args.lora_request_list is not None:
             logger.info(f'args.lora_request_list: {args.lora_request_list}')
-            for lora_request in args.lora_request_list:
+            lora_request_list = args.lora_request_list
+            if args.max_loras is not None:
+                # The other adapters are loaded on demand.
+                lora_request_list = lora_request_list[:max(args.max_loras, 1)]
+            for lora_request in lora_request_list:
                 model = Swift.from_pretrained(
                     model, lora_request.lora_local_path, lora_request.lora_name, inference_mode=True)
         else:
@@ -244,6 +251,26 @@ def prepare_model_template(args: InferArguments,
     return model, template
 
 
+def prepare_assistant_model(args: InferArguments, model: PreTrainedModel,
+                            tokenizer: PreTrainedTokenizerBase) -> Optional[PreTrainedModel]:
+    """Load the draft model of speculative decoding, which shares the tokenizer with the model."""
+    if args.speculative_model_type in {None, 'ngram'}:
+        return None
+    device = next(model.parameters()).device
+    assistant_model, assistant_tokenizer = get_model_tokenizer(
+        args.speculative_model_type,
+        args.torch_dtype, {'device_map': str(device)},
+        model_id_or_path=args.speculative_model_id_or_path)
+    if assistant_tokenizer.get_vocab() != tokenizer.get_vocab():
+        raise ValueError('The draft model should use the same tokenizer as the model. '
+                         f'speculative_model_type: {args.speculative_model_type}')
+    assistant_model.requires_grad_(False)
+    assistant_model.eval()
+    assistant_model.generation_config.num_assistant_tokens = args.num_speculative_tokens
+    logger.info(f'assistant_model: {assistant_model.model_dir}')
+    return assistant_model
+
+
 def read_media_file(infer_kwargs: Dict[str, Any], infer_media_type: Literal['none', 'round', 'dialogue', 'interleave'],
                     media_type: Literal['image', 'video', 'audio'], query: str) -> None:
     if infer_media_type == 'none':
@@ -277,6 +304,7 @@ def llm_infer(args: InferArguments) -> Dict[str, List[Dict[str, Any]]]:
     if args.merge_lora:
         merge_lora(args, device_map=args.merge_device_map)
 
+    assistant_model = None
     if args.infer_backend == 'vllm':
         from .utils import (prepare_vllm_engine_template, inference_stream_vllm as inference_stream_x, inference_vllm as
                             inference_x)
@@ -306,6 +334,15 @@ def llm_infer(args: InferArguments) -> Dict[str, List[Dict[str, Any]]]:
         if args.overwrite_generation_config:
             assert args.ckpt_dir is not None, 'args.ckpt_dir is not specified.'
             model.generation_config.save_pretrained(args.ckpt_dir)
+        assistant_model = prepare_assistant_model(args, model, template.tokenizer)
+    # speculative decoding
+    generation_info = {}
+    speculative_stats = {'num_draft_tokens': 0, 'num_accepted_tokens': 0}
+
+    def _update_speculative_stats() -> None:
+        for k in speculative_stats.keys():
+            speculative_stats[k] += generation_info.get(k, 0)
+
     lora_request = None
     if args.vllm_enable_lora:
         assert len(args.lora_request_list) == 1
@@ -313,7 +350,12 @@ def llm_infer(args: InferArguments) -> Dict[str, List[Dict[str, Any]]]:
     # Inference
     result: List[Dict[str, Any]] = []
     jsonl_path = None
-    if args.save_result:
+    if args.result_path is not None:
+        jsonl_path = args.result_path
+        result_dir = os.path.dirname(jsonl_path)
+        if result_dir:
+            os.makedirs(result_dir, exist_ok=True)
+    elif args.save_result:
         if args.result_dir:
             result_dir = args.result_dir
         else:
@@ -326,6 +368,12 @@ def llm_infer(args: InferArguments) -> Dict[str, List[Dict[str, Any]]]:
             os.makedirs(result_dir, exist_ok=True)
             time = dt.datetime.now().strftime('%Y%m%d-%H%M%S')
             jsonl_path = os.path.join(result_dir, f'{time}.jsonl')
+    writer = None
+    if jsonl_path is not None:
+        if args.eval_human:
+            writer = JsonlWriter(jsonl_path, append=True)
+        else:
+            writer = JsonlWriter(jsonl_path, resume=args.result_path is not None)
     if args.eval_human:
         input_mode: Literal['S', 'M'] = 'S'
         logger.info('Input `exit` or `quit` to exit the conversation.')
@@ -408,6 +456,7 @@ def llm_infer(args: InferArguments) -> Dict[str, List[Dict[str, Any]]]:
             else:
                 if args.stop_words:
                     infer_kwargs['stop_words'] = args.stop_words
+                infer_kwargs.update({'assistant_model': assistant_model, 'generation_info': generation_info})
                 if args.stream:
                     gen = inference_stream(model, template, query, history, system, **infer_kwargs)
                     print_idx = 0
@@ -419,6 +468,7 @@ def llm_infer(args: InferArguments) -> Dict[str, List[Dict[str, Any]]]:
                 else:
                     response, new_history = inference(model, template, query, history, system, **infer_kwargs)
                     print(response)
+                _update_speculative_stats()
             print('-' * 50)
             obj = {
                 'system': system,
@@ -431,8 +481,8 @@ def llm_infer(args: InferArguments) -> Dict[str, List[Dict[str, Any]]]:
                 if media_files is not None:
                     obj[media_key] = media_files
             history = new_history
-            if jsonl_path is not None:
-                append_to_jsonl(jsonl_path, obj)
+            if writer is not None:
+                writer.write(obj)
             result.append(obj)
     else:
         dataset_kwargs = {
@@ -452,6 +502,12 @@ def llm_infer(args: InferArguments) -> Dict[str, List[Dict[str, Any]]]:
             logger.info(f'show_dataset_sample: {args.show_dataset_sample}')
             val_dataset = sample_dataset(val_dataset, args.show_dataset_sample, random_state)
         logger.info(f'val_dataset: {val_dataset}')
+        completed = writer.completed if writer is not None else {}
+        index_list = list(range(len(val_dataset)))
+        if len(completed) > 0:
+            index_list = [i for i in index_list if i not in completed]
+            logger.info(f'Skipping {len(val_dataset) - len(index_list)} rows that already have results.')
+            val_dataset = val_dataset.select(index_list)
 
         if args.verbose is None:
             if len(val_dataset) >= 20:
@@ -463,7 +519,7 @@ def llm_infer(args: InferArguments) -> Dict[str, List[Dict[str, Any]]]:
             args.stream = False
             logger.info(f'Setting args.stream: {args.stream}')
 
-        if args.infer_backend in {'vllm', 'lmdeploy'} and not args.stream:
+        if (args.infer_backend in {'vllm', 'lmdeploy'} or args.max_batch_size > 1) and not args.stream:
             if args.verbose:
                 args.verbose = False
                 logger.info('Setting args.verbose: False')
@@ -486,32 +542,50 @@ def llm_infer(args: InferArguments) -> Dict[str, List[Dict[str, Any]]]:
                     media_files = data.get(media_key)
                     if media_files is not None:
                         request[media_key] = media_files
+                if args.infer_backend not in {'vllm', 'lmdeploy'}:
+                    # Same as the row by row inference below.
+                    for key in ['tools', 'objects']:
+                        if data.get(key) is not None:
+                            request[key] = data[key]
                 request['truncation_strategy'] = args.truncation_strategy
                 request_list.append(request)
-            resp_list = inference_x(llm_engine, template, request_list, use_tqdm=True)
             result = []
             if label_list is not None:
                 for request, label in zip(request_list, label_list):
                     request['label'] = label
-            for request, resp in zip(request_list, resp_list):
-                obj = {
-                    'system': request['system'],
-                    'query': request['query'],
-                    'response': resp['response'],
-                    'label': request.pop('label', None),
-                    'history': request['history'],
-                }
-                for media_key in MediaTag.media_keys.values():
-                    media_files = request.get(media_key)
-                    if media_files is not None:
-                        obj[media_key] = media_files
-                if jsonl_path is not None:
-                    append_to_jsonl(jsonl_path, obj)
-                result.append(obj)
+            # Infer in chunks so that the results are saved progressively and the job can be resumed.
+            chunk_size = _RESUME_CHUNK_SIZE if writer is not None else len(request_list)
+            for i in range(0, len(request_list), max(chunk_size, 1)):
+                chunk_request_list = request_list[i:i + chunk_size]
+                if args.infer_backend in {'vllm', 'lmdeploy'}:
+                    resp_list = inference_x(llm_engine, template, chunk_request_list, use_tqdm=True)
+                else:
+                    resp_list = inference_pt(
+                        model,
+                        template,
+                        chunk_request_list,
+                        max_batch_size=args.max_batch_size,
+                        max_tokens_per_batch=args.max_tokens_per_batch,
+                        use_tqdm=True)
+                for j, (request, resp) in enumerate(zip(chunk_request_list, resp_list)):
+                    obj = {
+                        'system': request['system'],
+                        'query': request['query'],
+                        'response': resp['response'],
+                        'label': request.pop('label', None),
+                        'history': request['history'],
+                    }
+                    for media_key in MediaTag.media_keys.values():
+                        media_files = request.get(media_key)
+                        if media_files is not None:
+                            obj[media_key] = media_files
+                    if writer is not None:
+                        writer.write(obj, index_list[i + j])
+                    result.append(obj)
         else:
             if not args.verbose:
                 val_dataset = tqdm(val_dataset)
-            for data in val_dataset:
+            for i, data in enumerate(val_dataset):
                 kwargs = {'query': data['query']}
                 history = data.get('history')
                 system = data.get('system')
@@ -548,7 +622,14 @@ def llm_infer(args: InferArguments) -> Dict[str, List[Dict[str, Any]]]:
                     print()
                 else:
                     response, _ = inference(
-                        model, template, stream=args.stream and args.verbose, verbose=args.verbose, **kwargs)
+                        model,
+                        template,
+                        stream=args.stream and args.verbose,
+                        verbose=args.verbose,
+                        assistant_model=assistant_model,
+                        generation_info=generation_info,
+                        **kwargs)
+                    _update_speculative_stats()
                 label = data.pop('response', None)
                 obj = {
                     'system': kwargs['system'],
@@ -561,8 +642,8 @@ def llm_infer(args: InferArguments) -> Dict[str, List[Dict[str, Any]]]:
                     media_files = kwargs.get(media_key)
                     if media_files is not None:
                         obj[media_key] = media_files
-                if jsonl_path is not None:
-                    append_to_jsonl(jsonl_path, obj)
+                if writer is not None:
+                    writer.write(obj, index_list[i])
                 result.append(obj)
                 if args.verbose:
                     print()
@@ -572,9 +653,17 @@ def llm_infer(args: InferArguments) -> Dict[str, List[Dict[str, Any]]]:
                         if media_files is not None:
                             print(f'[{media_key.upper()}]{media_files}')
                     print('-' * 50, flush=True)
+        if len(completed) > 0:
+            result_mapping = {**completed, **dict(zip(index_list, result))}
+            result = [result_mapping[i] for i in sorted(result_mapping)]
 
-    if jsonl_path is not None:
+    if writer is not None:
+        writer.close()
         logger.info(f'save_result_path: {jsonl_path}')
+    num_draft_tokens = speculative_stats['num_draft_tokens']
+    if num_draft_tokens > 0:
+        acceptance_rate = speculative_stats['num_accepted_tokens'] / num_draft_tokens
+        logger.info(f'speculative decoding: {speculative_stats}, acceptance_rate: {acceptance_rate:.4f}')
     return {'result': result}
 
 
@@ -16,13 +16,14 @@ from swift.torchacc_utils import patch_acc_model
 from swift.trainers import TrainerFactory
 from swift.trainers.utils import can_return_loss, find_labels
 from swift.utils import (append_to_jsonl, check_json_format, compute_acc_metrics, compute_nlg_metrics, get_dist_setting,
-                         get_logger, get_main, get_model_info, is_ddp_plus_mp, is_dist, is_master, plot_images,
-                         preprocess_logits_for_metrics, seed_everything, show_layers, use_torchacc)
+                         get_logger, get_main, get_model_info, is_ddp_plus_mp, is_dist, is_local_master, is_master,
+                         plot_images, preprocess_logits_for_metrics, seed_everything, show_layers, use_torchacc)
 from .accelerator import ta_accelerate
 from .tuner import prepare_model
 from .utils import (TEMPLATE_MAPPING, LazyLLMDataset, PtArguments, RLHFArguments, SftArguments, Template, dataset_map,
-                    deep_getattr, dynamic_vit_gradient_checkpointing, get_dataset, get_mllm_arch, get_model_tokenizer,
-                    get_template, get_time_info, print_example, set_generation_config, sort_by_max_length, stat_dataset)
+                    deep_getattr, dynamic_vit_gradient_checkpointing, get_dataset, get_dataset_cache_path,
+                    get_mllm_arch, get_model_tokenizer, get_template, get_time_info, load_dataset_cache, print_example,
+                    save_dataset_cache, set_generation_config, sort_by_max_length, stat_dataset)
 
 logger = get_logger()
 
@@ -78,9 +79,9 @@ def llm_sft_megatron(args: SftArguments) -> Dict[str, Any]:
     train_dataset, val_dataset = _get_train_val_dataset(args)
     td0, tkwargs0 = template.encode(train_dataset[0])
     print_example(td0, tokenizer, tkwargs0)
-    train_dataset = LazyLLMDataset(train_dataset, template.encode)
+    train_dataset = _get_lazy_dataset(args, train_dataset, template)
     if val_dataset is not None:
-        val_dataset = LazyLLMDataset(val_dataset, template.encode)
+        val_dataset = _get_lazy_dataset(args, val_dataset, template)
 
     res = MegatronArguments.load_megatron_config(tokenizer.model_dir)
     res.update(MegatronArguments.from_sft_args(args, train_dataset, val_dataset))
@@ -343,6 +344,39 @@ def prepare_model_template_train(args, msg: Optional[Dict[str, Any]] = None):
     return model, ref_model, template, callbacks
 
 
+def _get_lazy_dataset(args, dataset: HfDataset, template: Template) -> LazyLLMDataset:
+    cache_dir = None
+    if args.use_dataset_cache:
+        cache_path = get_dataset_cache_path(dataset, template, args.dataset_cache_dir)
+        if cache_path is not None:
+            cache_dir = f'{cache_path}-lazy'
+    return LazyLLMDataset(
+        dataset,
+        template.encode,
+        batch_encode_func=template.batch_encode,
+        cache_max_mb=args.lazy_cache_max_mb,
+        cache_dir=cache_dir)
+
+
+def _dataset_map_with_cache(args, dataset: HfDataset, template: Template):
+    cache_path = None
+    if args.use_dataset_cache and not args.streaming:
+        cache_path = get_dataset_cache_path(dataset, template, args.dataset_cache_dir)
+        llm_dataset = load_dataset_cache(cache_path)
+        if llm_dataset is not None:
+            return llm_dataset
+    llm_dataset = dataset_map(
+        dataset,
+        template.encode,
+        args.preprocess_num_proc,
+        streaming=args.streaming,
+        columnar=args.columnar_dataset,
+        batch_map_func=template.batch_encode)
+    if cache_path is not None and is_local_master():
+        save_dataset_cache(llm_dataset, cache_path)
+    return llm_dataset
+
+
 def prepare_dataset(args, template: Template, msg: Optional[Dict[str, Any]] = None):
     training_args = args.training_args
     train_dataset, val_dataset = _get_train_val_dataset(args)
@@ -358,11 +392,24 @@ def prepare_dataset(args, template: Template, msg: Optional[Dict[str, Any]] = No
     dataset_info = {}
     if args.packing:
         from swift.llm.utils.utils import ConstantLengthDataset
+        from swift.llm.utils.template import is_packing_isolated
+        if not is_packing_isolated(template.model):
+            raise ValueError('`--packing` requires flash attention (`--use_flash_attn true`) and transformers>=4.44, '
+                             'which restrict the attention to each sample in the pack.')
+        if not args.lazy_tokenize:
+            # encode with num_proc and the dataset cache, then pack the encoded samples.
+            train_dataset = _dataset_map_with_cache(args, train_dataset, template)
+            if val_dataset is not None:
+                val_dataset = _dataset_map_with_cache(args, val_dataset, template)
         train_dataset = ConstantLengthDataset.get_packed_dataset(
-            template, train_dataset, args.max_length, lazy_tokenize=args.lazy_tokenize)
+            template, train_dataset, args.max_length, lazy_tokenize=args.lazy_tokenize, columnar=args.columnar_dataset)
         if val_dataset is not None:
             val_dataset = ConstantLengthDataset.get_packed_dataset(
-                template, val_dataset, args.max_length, lazy_tokenize=args.lazy_tokenize)
+                template,
+                val_dataset,
+                args.max_length,
+                lazy_tokenize=args.lazy_tokenize,
+                columnar=args.columnar_dataset)
         if not args.lazy_tokenize:
             print_example(train_dataset[0], tokenizer, {})
             dataset_info['train_dataset'] = stat_dataset(train_dataset)
@@ -381,9 +428,9 @@ def prepare_dataset(args, template: Template, msg: Optional[Dict[str, Any]] = No
                     template.model = None
         td0, tkwargs0 = template.encode(train_dataset[0])
         print_example(td0, tokenizer, tkwargs0)
-        train_dataset = dataset_map(train_dataset, template.encode, args.preprocess_num_proc, streaming=args.streaming)
+        train_dataset = _dataset_map_with_cache(args, train_dataset, template)
         if val_dataset is not None:
-            val_dataset = dataset_map(val_dataset, template.encode, args.preprocess_num_proc, streaming=args.streaming)
+            val_dataset = _dataset_map_with_cache(args, val_dataset, template)
         template.model = model  # recover
         if args.test_oom_error:
             train_dataset = sort_by_max_length(train_dataset, 20000)
@@ -402,9 +449,9 @@ def prepare_dataset(args, template: Template, msg: Optional[Dict[str, Any]] = No
     else:
         td0, tkwargs0 = template.encode(train_dataset[0])
         print_example(td0, tokenizer, tkwargs0)
-        train_dataset = LazyLLMDataset(train_dataset, template.encode)
+        train_dataset = _get_lazy_dataset(args, train_dataset, template)
         if val_dataset is not None:
-            val_dataset = LazyLLMDataset(val_dataset, template.encode)
+            val_dataset = _get_lazy_dataset(args, val_dataset, template)
     if isinstance(msg, dict):
         msg['dataset_info'] = dataset_info
     return train_dataset, val_dataset
@@ -645,6 +645,8 @@ class SftArguments(ArgumentsBase):
     # multimodal
     model_kwargs: Optional[str] = None
     loss_name: Optional[str] = field(default=None, metadata={'help': f'loss_func choices: {list(LOSS_MAPPING.keys())}'})
+    # Compute lm_head + cross entropy over the chunks of this many tokens, without the full logits
+    ce_chunk_size: Optional[int] = None
 
     # dataset_id or dataset_name or dataset_path or ...
     dataset: List[str] = field(
@@ -806,12 +808,18 @@ class SftArguments(ArgumentsBase):
     eval_steps: Optional[int] = None  # full: 200, other: 50
     save_steps: Optional[int] = None
     save_only_model: bool = False
+    # Snapshot the states into the host memory, and write the checkpoints on the background threads
+    async_save: bool = False
     save_total_limit: int = 2  # save last and best. -1: all checkpoints
     logging_steps: int = 5
     acc_steps: int = 1
     dataloader_num_workers: Optional[int] = None
     dataloader_pin_memory: bool = True
     dataloader_drop_last: bool = False
+    # Batch the samples of similar lengths together to reduce the padding
+    group_by_length: bool = False
+    # Build the batches up to the padded token budget instead of `batch_size`
+    max_tokens_per_batch: Optional[int] = None
 
     # push to ms hub
     push_to_hub: bool = False
@@ -834,6 +842,13 @@ class SftArguments(ArgumentsBase):
     disable_tqdm: bool = False
     lazy_tokenize: Optional[bool] = None
     preprocess_num_proc: int = 1
+    # Store the encoded dataset in contiguous numpy buffers instead of python lists.
+    columnar_dataset: bool = False
+    # Cache the encoded dataset on disk, and memory-map it in later runs.
+    use_dataset_cache: bool = False
+    dataset_cache_dir: Optional[str] = None  # None: `{modelscope_cache_dir}/swift_dataset_cache`
+    # The memory budget (MB) of the LRU cache of the encoded samples in lazy_tokenize mode
+    lazy_cache_max_mb: Optional[float] = None
     use_flash_attn: Optional[bool] = None
     ignore_args_error: bool = False  # True: notebook compatibility
     check_model_is_latest: bool = True
@@ -1185,6 +1200,10 @@ class SftArguments(ArgumentsBase):
             kwargs['neftune_noise_alpha'] = self.neftune_noise_alpha
 
         parameters = inspect.signature(training_args_cls.__init__).parameters
+        if (self.lazy_tokenize and self.lazy_cache_max_mb is not None and self.dataloader_num_workers > 0
+                and 'dataloader_persistent_workers' in training_args_cls.__dataclass_fields__):
+            # keep the cache of the dataloader workers across epochs
+            kwargs['dataloader_persistent_workers'] = True
         for k in ['lr_scheduler_kwargs', 'include_num_input_tokens_seen', 'auto_find_batch_size']:
             if k in parameters:
                 kwargs[k] = getattr(self, k)
@@ -1238,6 +1257,7 @@ class SftArguments(ArgumentsBase):
             gradient_checkpointing=self.gradient_checkpointing,
             local_rank=self.local_rank,
             save_only_model=self.save_only_model,
+            async_save=self.async_save,
             train_sampler_random=self.train_sampler_random,
             report_to=self.report_to,
             deepspeed=self.deepspeed,
@@ -1251,9 +1271,12 @@ class SftArguments(ArgumentsBase):
             fsdp=self.fsdp,
             fsdp_config=self.fsdp_config,
             dataloader_drop_last=self.dataloader_drop_last,
+            group_by_length=self.group_by_length,
+            max_tokens_per_batch=self.max_tokens_per_batch,
             seed=self.seed,
             data_seed=self.dataset_seed,
             loss_name=self.loss_name,
+            ce_chunk_size=self.ce_chunk_size,
             **kwargs)
 
         training_args.ddp_find_unused_parameters = self.ddp_find_unused_parameters
@@ -1335,6 +1358,8 @@ class InferArguments(ArgumentsBase):
     infer_backend: Literal['AUTO', 'vllm', 'pt', 'lmdeploy'] = 'AUTO'
     ckpt_dir: Optional[str] = field(default=None, metadata={'help': '/path/to/your/vx-xxx/checkpoint-xxx'})
     result_dir: Optional[str] = field(default=None, metadata={'help': '/path/to/your/infer_result'})
+    # If the file exists, the rows that already have results are skipped.
+    result_path: Optional[str] = field(default=None, metadata={'help': '/path/to/your/infer_result.jsonl'})
     load_args_from_ckpt_dir: bool = True
     load_dataset_config: bool = False
     eval_human: Optional[bool] = None
@@ -1381,6 +1406,13 @@ class InferArguments(ArgumentsBase):
     repetition_penalty: Optional[float] = None
     num_beams: int = 1
     stop_words: List[str] = field(default_factory=list)
+    # pt backend: batched inference (the requests are sorted by the prompt length)
+    max_batch_size: int = 1
+    max_tokens_per_batch: Optional[int] = None  # the max number of padded prompt tokens of a batch
+    # pt backend: speculative decoding. 'ngram': prompt lookup decoding, else the model_type of the draft model
+    speculative_model_type: Optional[str] = None
+    speculative_model_id_or_path: Optional[str] = None
+    num_speculative_tokens: int = 5
 
     # rope-scaling
     rope_scaling: Literal['linear', 'dynamic'] = None
@@ -1495,6 +1527,7 @@ class InferArguments(ArgumentsBase):
             self.sft_type = 'full'
 
         self.handle_infer_backend()
+        self.handle_speculative_decoding()
         self.handle_generation_config()
         self._load_json_or_path('limit_mm_per_prompt')
 
@@ -1503,6 +1536,8 @@ class InferArguments(ArgumentsBase):
         support_vllm = model_info.get('support_vllm', False)
         support_lmdeploy = model_info.get('support_lmdeploy', False)
         self.lora_request_list = None
+        if self.infer_backend == 'AUTO' and self.speculative_model_type is not None:
+            self.infer_backend = 'pt'
         if self.infer_backend == 'AUTO':
             self.infer_backend = 'pt'
             if is_vllm_available() and support_vllm and not self.is_multimodal:
@@ -1549,6 +1584,23 @@ class InferArguments(ArgumentsBase):
         if self.merge_device_map is None and not isinstance(self, ExportArguments):
             self.merge_device_map = 'cpu'
 
+    def handle_speculative_decoding(self) -> None:
+        if self.speculative_model_type is None:
+            return
+        if self.infer_backend != 'pt':
+            raise ValueError('Speculative decoding is only supported by the pt backend.')
+        if version.parse(transformers.__version__) < version.parse('4.37'):
+            # The candidate generators of assisted generation and the prompt lookup decoding.
+            raise ValueError('Speculative decoding requires transformers>=4.37.')
+        if self.speculative_model_type != 'ngram' and self.speculative_model_type not in MODEL_MAPPING:
+            raise ValueError(f'speculative_model_type: {self.speculative_model_type} is not in MODEL_MAPPING.')
+        if self.num_beams != 1:
+            raise ValueError('Speculative decoding does not support beam search.')
+        if self.max_batch_size > 1:
+            # Assisted generation only supports batch_size 1.
+            self.max_batch_size = 1
+            logger.info('Setting args.max_batch_size: 1')
+
     @staticmethod
     def check_ckpt_dir_correct(ckpt_dir) -> bool:
         """Check the checkpoint dir is correct, which means it must contain a `configuration.json` file.
@@ -1584,6 +1636,15 @@ class DeployArguments(InferArguments):
     served_model_name: Optional[str] = None
     verbose: bool = True  # Whether to log request_info
     log_interval: int = 10  # Interval for printing global statistics
+    max_batch_size: int = 1  # pt backend: > 1 enables continuous batching, the max number of sequences decoded together
+    max_loras: Optional[int] = None  # pt backend: the max number of resident LoRA adapters (LRU). None: all
+    prefix_cache_max_tokens: int = 0  # pt backend: the max number of tokens in the prefix kv_cache. 0: disabled
+    encode_num_threads: Optional[int] = None  # Default: os.cpu_count()
+    encode_num_proc: int = 0  # vllm/lmdeploy: the number of processes encoding the requests with media
+    # Admission control: return 429/503 if exceeded. None: no limit.
+    max_concurrent_seqs: Optional[int] = None
+    max_queued_tokens: Optional[int] = None  # the sum of (prompt tokens + max_tokens) of the in-flight requests
+    request_timeout: Optional[float] = None  # seconds
 
 
 @dataclass
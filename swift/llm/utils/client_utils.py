@@ -1,22 +1,68 @@
+import asyncio
 import base64
+import dataclasses
 import hashlib
 import os
+import random
 import re
+import typing
 from copy import deepcopy
 from io import BytesIO
-from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple, Union
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple, Type, TypeVar, Union
 
 import aiohttp
 import json
 import requests
-from dacite import from_dict
 from requests.exceptions import HTTPError
+from tqdm import tqdm
 
 from .protocol import (ChatCompletionResponse, ChatCompletionStreamResponse, CompletionResponse,
                        CompletionStreamResponse, ModelList, XRequestConfig)
 from .template import History
 from .utils import Messages, history_to_messages
 
+_T = TypeVar('_T')
+_field_converters_cache: Dict[type, List[Tuple[str, Optional[Callable[[Any], Any]]]]] = {}
+
+
+def _get_converter(tp: Any) -> Optional[Callable[[Any], Any]]:
+    # None: the value is used as it is.
+    if dataclasses.is_dataclass(tp):
+        return lambda v: from_dict(tp, v)
+    origin, args = getattr(tp, '__origin__', None), getattr(tp, '__args__', ())
+    if origin is Union:
+        converters = [_get_converter(arg) for arg in args if arg is not type(None)]
+        if len(converters) == 1 and converters[0] is not None:
+            converter = converters[0]
+            return lambda v: None if v is None else converter(v)
+    elif origin is list and len(args) == 1:
+        converter = _get_converter(args[0])
+        if converter is not None:
+            return lambda v: [converter(x) for x in v]
+    return None
+
+
+def from_dict(data_class: Type[_T], data: Dict[str, Any]) -> _T:
+    """Create the response dataclass from the json object, a faster `dacite.from_dict` without type checking.
+
+    The field converters of each dataclass are resolved once and cached, which matters when parsing the stream
+    chunks. The unknown keys are ignored, and the missing keys use the default values.
+    """
+    field_converters = _field_converters_cache.get(data_class)
+    if field_converters is None:
+        field_converters = []
+        type_hints = typing.get_type_hints(data_class)
+        for f in dataclasses.fields(data_class):
+            if f.init:
+                field_converters.append((f.name, _get_converter(type_hints[f.name])))
+        _field_converters_cache[data_class] = field_converters
+    kwargs = {}
+    for name, converter in field_converters:
+        if name in data:
+            value = data[name]
+            kwargs[name] = value if converter is None else converter(value)
+    return data_class(**kwargs)
+
 
 def _get_request_kwargs(api_key: Optional[str] = None) -> Dict[str, Any]:
     timeout = float(os.getenv('TIMEOUT', '1800'))
@@ -410,3 +456,207 @@ async def inference_client_async(
                 if resp_obj['object'] == 'error':
                     raise HTTPError(resp_obj['message'])
                 return from_dict(ret_cls, resp_obj)
+
+
+class AsyncInferenceClient:
+    """A long-lived async client of the OpenAI-compatible server, e.g. `swift deploy`.
+
+    Compared to `inference_client_async`, the connections are pooled and reused across the requests, and the model
+    list is fetched only once. `infer_batch` runs many requests with a bounded concurrency. The requests failed by
+    connection errors, timeouts or the 429/5xx responses are retried with exponential backoff and jitter.
+    The connections are bound to the event loop, use the client within one loop, e.g.
+    `async with AsyncInferenceClient() as client:`.
+
+    Args:
+        host, port, api_key, url: The address of the server, the same as `inference_client_async`.
+        max_connections: The max number of the pooled connections, also the default concurrency of `infer_batch`.
+        max_retries: The max number of retries of a request.
+        retry_backoff: The base delay (seconds) of the exponential backoff.
+        timeout: The timeout (seconds) of a request, default is the env `TIMEOUT` (1800). `<= 0` means no timeout.
+    """
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self,
+                 host: str = '127.0.0.1',
+                 port: str = '8000',
+                 api_key: str = 'EMPTY',
+                 *,
+                 url: Optional[str] = None,
+                 max_connections: int = 100,
+                 max_retries: int = 3,
+                 retry_backoff: float = 0.5,
+                 timeout: Optional[float] = None) -> None:
+        if url is None:
+            url = f'http://{host}:{port}/v1'
+        self.url = url.rstrip('/')
+        self.api_key = api_key
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        if timeout is None:
+            timeout = float(os.getenv('TIMEOUT', '1800'))
+        self.timeout = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._model_list: Optional[ModelList] = None
+        self._model_list_lock: Optional[asyncio.Lock] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            timeout = aiohttp.ClientTimeout(total=self.timeout if self.timeout > 0 else None)
+            headers = {'Authorization': f'Bearer {self.api_key}'} if self.api_key is not None else None
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers)
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self) -> 'AsyncInferenceClient':
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.close()
+
+    async def _request(self,
+                       method: str,
+                       url: str,
+                       data: Optional[Dict[str, Any]] = None,
+                       stream: bool = False) -> Union[Dict[str, Any], aiohttp.ClientResponse]:
+        """Returns the json object, or the response to read (stream=True). Raises HTTPError for the error object."""
+        for i in range(self.max_retries + 1):
+            resp = None
+            try:
+                resp = await self.session.request(method, url, json=data)
+                if resp.status not in self.RETRY_STATUS or i == self.max_retries:
+                    if stream and resp.status == 200:
+                        return resp
+                    resp_obj = await resp.json(content_type=None)
+                    resp.release()
+                    if resp_obj.get('object') == 'error':
+                        raise HTTPError(resp_obj['message'])
+                    return resp_obj
+                resp.release()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if resp is not None:
+                    resp.release()
+                if i == self.max_retries:
+                    raise
+            # full jitter: the retries of the concurrent requests are spread out.
+            await asyncio.sleep(random.uniform(0, self.retry_backoff * 2**i))
+
+    async def get_model_list(self, refresh: bool = False) -> ModelList:
+        if self._model_list is None or refresh:
+            if self._model_list_lock is None:
+                self._model_list_lock = asyncio.Lock()
+            async with self._model_list_lock:
+                if self._model_list is None or refresh:
+                    resp_obj = await self._request('GET', f'{self.url}/models')
+                    self._model_list = from_dict(ModelList, resp_obj)
+        return self._model_list
+
+    async def infer(
+        self,
+        model_type: str,
+        query: str,
+        history: Optional[History] = None,
+        system: Optional[str] = None,
+        images: Optional[List[str]] = None,
+        tools: Optional[List[Dict[str, Union[str, Dict]]]] = None,
+        tool_choice: Optional[Union[str, Dict]] = 'auto',
+        *,
+        is_chat_request: Optional[bool] = None,
+        is_multimodal: Optional[bool] = None,
+        request_config: Optional[XRequestConfig] = None,
+        **kwargs
+    ) -> Union[ChatCompletionResponse, CompletionResponse, AsyncIterator[ChatCompletionStreamResponse],
+               AsyncIterator[CompletionStreamResponse]]:
+        """The same as `inference_client_async`, using the pooled connections and the cached model list."""
+        if request_config is None:
+            request_config = XRequestConfig()
+        model_list = None
+        if is_chat_request is None:
+            is_chat_request = kwargs.get('is_chat')
+        if is_chat_request is None or is_multimodal is None:
+            model_list = await self.get_model_list()
+
+        url, data, is_chat_request = _pre_inference_client(
+            model_type,
+            query,
+            history,
+            system,
+            images,
+            tools,
+            tool_choice,
+            model_list=model_list,
+            is_chat_request=is_chat_request,
+            is_multimodal=is_multimodal,
+            request_config=request_config,
+            url=self.url,
+            **kwargs)
+
+        if request_config.stream:
+            if is_chat_request:
+                ret_cls = ChatCompletionStreamResponse
+            else:
+                ret_cls = CompletionStreamResponse
+            resp = await self._request('POST', url, data, stream=True)
+
+            async def _gen_stream(
+            ) -> Union[AsyncIterator[ChatCompletionStreamResponse], AsyncIterator[CompletionStreamResponse]]:
+                try:
+                    async for _data in resp.content:
+                        _data = _parse_stream_data(_data)
+                        if _data == '[DONE]':
+                            break
+                        if _data is not None:
+                            resp_obj = json.loads(_data)
+                            if resp_obj['object'] == 'error':
+                                raise HTTPError(resp_obj['message'])
+                            yield from_dict(ret_cls, resp_obj)
+                finally:
+                    resp.release()
+
+            return _gen_stream()
+        else:
+            if is_chat_request:
+                ret_cls = ChatCompletionResponse
+            else:
+                ret_cls = CompletionResponse
+            resp_obj = await self._request('POST', url, data)
+            return from_dict(ret_cls, resp_obj)
+
+    async def infer_batch(self,
+                          request_list: List[Dict[str, Any]],
+                          *,
+                          request_config: Optional[XRequestConfig] = None,
+                          max_concurrency: Optional[int] = None,
+                          use_tqdm: bool = False,
+                          return_exceptions: bool = False) -> List[Union[ChatCompletionResponse, CompletionResponse]]:
+        """Run the requests concurrently, and return the responses in the order of `request_list`.
+
+        Args:
+            request_list: The kwargs of `infer` of each request, e.g. `[{'model_type': 'qwen2-7b-instruct',
+                'query': '...'}]`. `request_config` is the default of the requests without it.
+            max_concurrency: The max number of the in-flight requests, default is `max_connections`.
+            return_exceptions: Return the exception in place of the response of the failed request, instead of
+                raising it.
+        """
+        assert request_config is None or not request_config.stream, 'infer_batch does not support stream.'
+        semaphore = asyncio.Semaphore(max_concurrency or self.max_connections)
+        prog_bar = tqdm(total=len(request_list), dynamic_ncols=True, disable=not use_tqdm)
+
+        async def _infer(request: Dict[str, Any]) -> Union[ChatCompletionResponse, CompletionResponse]:
+            async with semaphore:
+                try:
+                    return await self.infer(**{'request_config': request_config, **request})
+                finally:
+                    prog_bar.update()
+
+        try:
+            return await asyncio.gather(
+                *[_infer(request) for request in request_list], return_exceptions=return_exceptions)
+        finally:
+            prog_bar.close()
@@ -0,0 +1,229 @@
+# Copyright (c) Alibaba, Inc. and its affiliates.
+import hashlib
+import os
+import shutil
+import tempfile
+from typing import Any, Callable, Dict, Optional
+
+import json
+import numpy as np
+from datasets import Dataset as HfDataset
+from modelscope.hub.utils.utils import get_cache_dir
+from torch.utils.data import Dataset
+
+from swift.utils import check_json_format, get_logger
+from swift.version import __version__
+from .template import Template
+from .utils import ColumnarLLMDataset
+
+logger = get_logger()
+
+# Increase it when the on-disk layout changes.
+_CACHE_FORMAT_VERSION = 1
+_META_FNAME = 'meta.json'
+
+
+class MMapLLMDataset(ColumnarLLMDataset):
+    """A read-only ColumnarLLMDataset whose buffers `{key}.npy` and offsets `{key}_offsets.npy`
+    are memory-mapped from the cache directory."""
+
+    def __init__(self, cache_path: str, indices: Optional[np.ndarray] = None) -> None:
+        self.cache_path = cache_path
+        with open(os.path.join(cache_path, _META_FNAME), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        super().__init__({}, {}, self.meta['dtypes'], indices)
+        self._open()
+
+    def _open(self) -> None:
+        for key in self.keys:
+            self.buffers[key] = np.load(os.path.join(self.cache_path, f'{key}.npy'), mmap_mode='r')
+            self.offsets[key] = np.load(os.path.join(self.cache_path, f'{key}_offsets.npy'), mmap_mode='r')
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Only the path is pickled, the dataloader workers re-map the files.
+        state = self.__dict__.copy()
+        state['buffers'] = {}
+        state['offsets'] = {}
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._open()
+
+    def _new_with_indices(self, indices: np.ndarray) -> 'MMapLLMDataset':
+        return self.__class__(self.cache_path, indices)
+
+
+def _get_tokenizer_hash(tokenizer) -> str:
+    """The hash of the vocab and the merges, so that a tokenizer edited at the same path is not mistaken for another."""
+    backend_tokenizer = getattr(tokenizer, 'backend_tokenizer', None)
+    if backend_tokenizer is not None:
+        # The fast tokenizers: the vocab, the merges, the normalization and the added tokens.
+        return hashlib.sha256(backend_tokenizer.to_str().encode('utf-8')).hexdigest()
+    sha256 = hashlib.sha256()
+    vocab = sorted(tokenizer.get_vocab().items(), key=lambda x: (x[1], str(x[0])))
+    sha256.update(json.dumps(check_json_format(vocab), ensure_ascii=False).encode('utf-8'))
+    sp_model = getattr(tokenizer, 'sp_model', None)
+    if hasattr(sp_model, 'serialized_model_proto'):
+        sha256.update(sp_model.serialized_model_proto())
+    bpe_ranks = getattr(tokenizer, 'bpe_ranks', None)
+    if isinstance(bpe_ranks, dict):
+        merges = sorted(bpe_ranks.items(), key=lambda x: x[1])
+        sha256.update(json.dumps(check_json_format(merges), ensure_ascii=False).encode('utf-8'))
+    return sha256.hexdigest()
+
+
+def _get_tokenizer_info(tokenizer) -> Dict[str, Any]:
+    return {
+        'class': tokenizer.__class__.__name__,
+        'name_or_path': getattr(tokenizer, 'name_or_path', None),
+        'model_dir': getattr(tokenizer, 'model_dir', None),
+        'vocab_size': len(tokenizer),
+        'vocab_hash': _get_tokenizer_hash(tokenizer),
+        'special_tokens': tokenizer.special_tokens_map,
+        'padding_side': tokenizer.padding_side,
+    }
+
+
+def get_dataset_cache_key(dataset: HfDataset, template: Template) -> Optional[str]:
+    """Content-addressed key of the encoded dataset.
+
+    It covers the dataset fingerprint, the template, the tokenizer and the truncation settings.
+    """
+    fingerprint = getattr(dataset, '_fingerprint', None)
+    if fingerprint is None:
+        return None
+    key_info = {
+        'cache_format_version': _CACHE_FORMAT_VERSION,
+        'swift_version': __version__,
+        'dataset_fingerprint': fingerprint,
+        'num_rows': len(dataset),
+        'template_type': getattr(template, 'template_type', None),
+        'template_class': template.__class__.__name__,
+        'template': {
+            k: getattr(template, k, None)
+            for k in [
+                'prefix', 'prompt', 'chat_sep', 'suffix', 'system_prefix', 'default_system', 'use_default_system',
+                'auto_add_bos', 'tools_prompt', 'tool_prompt', 'padding_side'
+            ]
+        },
+        'tokenizer': _get_tokenizer_info(template.tokenizer),
+        'max_length': template.max_length,
+        'truncation_strategy': template.truncation_strategy,
+        'use_loss_scale': template.use_loss_scale,
+        'response_loss_scale_map': template.response_loss_scale_map,
+        'query_loss_scale_map': template.query_loss_scale_map,
+    }
+    key_str = json.dumps(check_json_format(key_info), ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(key_str.encode('utf-8')).hexdigest()
+
+
+def get_dataset_cache_path(dataset: HfDataset, template: Template, cache_dir: Optional[str] = None) -> Optional[str]:
+    if cache_dir is None:
+        cache_dir = os.path.join(get_cache_dir(), 'swift_dataset_cache')
+    cache_key = get_dataset_cache_key(dataset, template)
+    if cache_key is None:
+        return None
+    return os.path.join(cache_dir, cache_key)
+
+
+def load_dataset_cache(cache_path: Optional[str]) -> Optional[MMapLLMDataset]:
+    if cache_path is None or not os.path.isfile(os.path.join(cache_path, _META_FNAME)):
+        return None
+    logger.info(f'Loading the encoded dataset from the cache: {cache_path}')
+    return MMapLLMDataset(cache_path)
+
+
+def _get_cache_dtype(value: Any) -> Optional[str]:
+    if not isinstance(value, (list, tuple, np.ndarray)):
+        return None
+    array = np.asarray(value)
+    if array.ndim != 1:
+        return None
+    if array.dtype.kind in 'iub' or array.size == 0:
+        return 'int64'
+    elif array.dtype.kind == 'f':
+        return 'float32'
+
+
+def save_dataset_cache(llm_dataset: Dataset, cache_path: Optional[str]) -> bool:
+    """Write the encoded dataset as flat token buffers + offsets. Only 1-d numeric fields are supported,
+    e.g. `input_ids`, `labels` and `loss_scale`; otherwise (e.g. multimodal tensors) nothing is written.
+
+    The files are written to a temporary directory first and then renamed, so a partially written cache
+    is never visible.
+    """
+    if cache_path is None or llm_dataset is None or len(llm_dataset) == 0:
+        return False
+    if os.path.exists(cache_path):
+        return True
+    if isinstance(llm_dataset, ColumnarLLMDataset) and llm_dataset.indices is None:
+        return _save_columnar_dataset(llm_dataset, cache_path)
+    row0 = llm_dataset[0]
+    keys = list(row0.keys())
+    dtypes = {}
+    for key in keys:
+        dtype = _get_cache_dtype(row0[key])
+        if dtype is None:
+            logger.info(f'The key `{key}` cannot be cached, skip writing the dataset cache.')
+            return False
+        dtypes[key] = dtype
+    storage_dtypes = {key: np.int32 if dtype == 'int64' else np.float32 for key, dtype in dtypes.items()}
+
+    lengths = {key: np.zeros(len(llm_dataset) + 1, dtype=np.int64) for key in keys}
+    for i in range(len(llm_dataset)):
+        row = llm_dataset[i]
+        if row.keys() != row0.keys():
+            logger.info(f'The keys of the row {i} are inconsistent, skip writing the dataset cache.')
+            return False
+        for key in keys:
+            value = row[key]
+            if not isinstance(value, (list, tuple, np.ndarray)):
+                logger.info(f'The key `{key}` of the row {i} cannot be cached, skip writing the dataset cache.')
+                return False
+            lengths[key][i + 1] = len(value)
+
+    def _write_buffers(tmp_dir: str) -> None:
+        for key in keys:
+            offsets = np.cumsum(lengths[key])
+            np.save(os.path.join(tmp_dir, f'{key}_offsets.npy'), offsets)
+            buffer = np.lib.format.open_memmap(
+                os.path.join(tmp_dir, f'{key}.npy'), mode='w+', dtype=storage_dtypes[key], shape=(offsets[-1], ))
+            for i in range(len(llm_dataset)):
+                buffer[offsets[i]:offsets[i + 1]] = llm_dataset[i][key]
+            buffer.flush()
+            del buffer
+
+    return _atomic_write(cache_path, _write_buffers, {'keys': keys, 'dtypes': dtypes, 'num_rows': len(llm_dataset)})
+
+
+def _save_columnar_dataset(llm_dataset: ColumnarLLMDataset, cache_path: str) -> bool:
+
+    def _write_buffers(tmp_dir: str) -> None:
+        for key in llm_dataset.keys:
+            np.save(os.path.join(tmp_dir, f'{key}_offsets.npy'), llm_dataset.offsets[key])
+            np.save(os.path.join(tmp_dir, f'{key}.npy'), llm_dataset.buffers[key])
+
+    meta = {'keys': llm_dataset.keys, 'dtypes': llm_dataset.dtypes, 'num_rows': len(llm_dataset)}
+    return _atomic_write(cache_path, _write_buffers, meta)
+
+
+def _atomic_write(cache_path: str, write_func: Callable[[str], None], meta: Dict[str, Any]) -> bool:
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=cache_dir)
+    try:
+        write_func(tmp_dir)
+        with open(os.path.join(tmp_dir, _META_FNAME), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp_dir, cache_path)
+        except OSError:
+            # Another process has written the same cache.
+            if not os.path.exists(cache_path):
+                raise
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    logger.info(f'The encoded dataset has been cached in: {cache_path}')
+    return True
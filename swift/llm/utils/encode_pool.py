@@ -0,0 +1,93 @@
+# Copyright (c) Alibaba, Inc. and its affiliates.
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from copy import copy
+from typing import Any, Dict, Optional, Tuple
+
+from swift.utils import get_logger
+from .template import Template
+
+logger = get_logger()
+
+_thread_pool: Optional[ThreadPoolExecutor] = None
+_worker_template: Optional[Template] = None
+
+
+def get_encode_thread_pool() -> ThreadPoolExecutor:
+    """The thread pool shared by the encoding of the inference backends."""
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='encode')
+    return _thread_pool
+
+
+def _encode(template: Template, example: Dict[str, Any], submit_time: float) -> Tuple[Any, float]:
+    wait_time = time.time() - submit_time
+    return template.encode(example), wait_time
+
+
+def _init_worker(template: Template) -> None:
+    global _worker_template
+    _worker_template = template
+
+
+def _encode_in_worker(example: Dict[str, Any], submit_time: float) -> Tuple[Any, float]:
+    return _encode(_worker_template, example, submit_time)
+
+
+def _has_media(example: Dict[str, Any]) -> bool:
+    return any(example.get(key) for key in ['images', 'audios', 'videos'])
+
+
+class EncodePool:
+    """A long-lived pool running `template.encode` for the request handlers of `swift deploy`.
+
+    The text examples are encoded in a thread pool. If `num_proc > 0`, the examples with media are encoded
+    in a process pool, so that the media decoding is not throttled by the GIL. The worker processes hold a copy
+    of the template without the model, so this is only supported by the vllm and lmdeploy backends.
+
+    Args:
+        template: The template.
+        num_threads: The number of threads. Default is the shared pool of `get_encode_thread_pool`.
+        num_proc: The number of processes for the examples with media. 0 means using the threads.
+    """
+
+    def __init__(self, template: Template, num_threads: Optional[int] = None, num_proc: int = 0) -> None:
+        self.template = template
+        if num_threads is None:
+            self.thread_pool = get_encode_thread_pool()
+        else:
+            self.thread_pool = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='encode')
+        self.process_pool: Optional[ProcessPoolExecutor] = None
+        if num_proc > 0:
+            worker_template = copy(template)
+            worker_template.model = None
+            # spawn: the server process may have initialized CUDA.
+            self.process_pool = ProcessPoolExecutor(
+                max_workers=num_proc,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(worker_template, ))
+
+    async def encode(self, example: Dict[str, Any]) -> Tuple[Tuple[Dict[str, Any], Dict[str, Any]], float]:
+        """Encode the example without blocking the event loop.
+
+        Returns:
+            The result of `template.encode` and the time (in seconds) the example waited in the queue.
+        """
+        loop = asyncio.get_running_loop()
+        submit_time = time.time()
+        if self.process_pool is not None and _has_media(example):
+            res, wait_time = await loop.run_in_executor(self.process_pool, _encode_in_worker, example, submit_time)
+        else:
+            res, wait_time = await loop.run_in_executor(self.thread_pool, _encode, self.template, example, submit_time)
+        return res, wait_time
+
+    def shutdown(self) -> None:
+        if self.thread_pool is not _thread_pool:
+            self.thread_pool.shutdown()
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
@@ -1,5 +1,4 @@
 import asyncio
-import concurrent.futures
 import inspect
 import os
 import time
@@ -21,8 +20,9 @@ from transformers import AutoConfig, AutoTokenizer, GenerationConfig
 
 from swift.utils import get_logger, get_seed
 from .argument import InferArguments
+from .encode_pool import get_encode_thread_pool
 from .model import get_model_tokenizer
-from .template import Template, get_template
+from .template import IncrementalDetokenizer, Template, get_template
 from .utils import get_max_model_len
 
 try:
@@ -200,10 +200,8 @@ def _prepare_lmdeploy_request(lmdeploy_engine: Union[AsyncEngine, VLAsyncEngine]
     resp_list: List[Optional[Dict[str, Any]]] = [None] * len(request_list)
     generators = []
     is_multimodal = getattr(lmdeploy_engine, 'is_multimodal', False)
-    max_workers = os.cpu_count()
     if not is_multimodal:
         use_tqdm = False
-        max_workers = 1
 
     prog_bar = tqdm(request_list, dynamic_ncols=True, disable=not use_tqdm)
 
@@ -213,11 +211,12 @@ def _prepare_lmdeploy_request(lmdeploy_engine: Union[AsyncEngine, VLAsyncEngine]
         prog_bar.update()
         return inputs
 
-    with template.lmdeploy_context(), concurrent.futures.ThreadPoolExecutor(
-            max_workers=min(max_workers, len(request_list))) as executor:
-        futures = [executor.submit(_prepare_inputs, request) for request in request_list]
-        concurrent.futures.wait(futures)
-        inputs_list = [future.result() for future in futures]
+    with template.lmdeploy_context():
+        if is_multimodal:
+            # Load the medias in the shared encode threads.
+            inputs_list = list(get_encode_thread_pool().map(_prepare_inputs, request_list))
+        else:
+            inputs_list = [_prepare_inputs(request) for request in request_list]
     prog_bar.close()
 
     for i, (inputs, request) in enumerate(zip(inputs_list, request_list)):
@@ -269,7 +268,7 @@ def inference_stream_lmdeploy(lmdeploy_engine: Union[AsyncEngine, VLAsyncEngine]
         **kwargs)
 
     n_finished = 0
-    print_idx_list = [[0] for _ in range(len(request_list))]
+    detokenizer_list = [IncrementalDetokenizer(template) for _ in range(len(request_list))]
     outputs = [None] * len(request_list)
     num_generated_tokens = [0] * len(request_list)
     prog_bar = tqdm(total=len(generators), dynamic_ncols=True, disable=not use_tqdm)
@@ -306,7 +305,8 @@ def inference_stream_lmdeploy(lmdeploy_engine: Union[AsyncEngine, VLAsyncEngine]
         outputs[i] = output
         request = request_list[i]
         logprobs = output.logprobs
-        safe_response = template.generate_ids_to_response(output.token_ids, is_finished, print_idx=print_idx_list[i])
+        detokenizer_list[i].step(output.token_ids, is_finished)
+        safe_response = detokenizer_list[i].response
         query = request['query']
         history = request['history']
         if resp_list[i] is None:
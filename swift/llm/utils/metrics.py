@@ -0,0 +1,227 @@
+# Copyright (c) Alibaba, Inc. and its affiliates.
+import bisect
+import time
+from threading import Lock
+from typing import Dict, List, Literal, Optional, Sequence, Tuple
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric:
+    """The base class of the metrics, rendered in the Prometheus text format (version 0.0.4)."""
+    metric_type: str
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = Lock()
+
+    def _get_label_values(self, labels: Dict[str, str]) -> LabelValues:
+        assert set(labels.keys()) == set(self.label_names), f'labels: {labels}, label_names: {self.label_names}'
+        return tuple(str(labels[k]) for k in self.label_names)
+
+    def _format_labels(self, label_values: LabelValues, extra_labels: Optional[Dict[str, str]] = None) -> str:
+        labels = [f'{k}="{_escape(v)}"' for k, v in zip(self.label_names, label_values)]
+        for k, v in (extra_labels or {}).items():
+            labels.append(f'{k}="{_escape(v)}"')
+        if len(labels) == 0:
+            return ''
+        return f"{{{','.join(labels)}}}"
+
+    def _render_samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        res = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.metric_type}']
+        with self._lock:
+            res += self._render_samples()
+        return '\n'.join(res)
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, value: float = 1., **labels: str) -> None:
+        assert value >= 0, 'Counters can only be increased.'
+        label_values = self._get_label_values(labels)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.) + value
+
+    def get(self, **labels: str) -> float:
+        return self._values.get(self._get_label_values(labels), 0.)
+
+    def sum(self) -> float:
+        """The sum over all the label values."""
+        with self._lock:
+            return sum(self._values.values())
+
+    def _render_samples(self) -> List[str]:
+        return [
+            f'{self.name}{self._format_labels(label_values)} {_format_value(value)}'
+            for label_values, value in self._values.items()
+        ]
+
+
+class Gauge(Counter):
+    metric_type = 'gauge'
+
+    def inc(self, value: float = 1., **labels: str) -> None:
+        label_values = self._get_label_values(labels)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.) + value
+
+    def dec(self, value: float = 1., **labels: str) -> None:
+        self.inc(-value, **labels)
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = ()) -> None:
+        super().__init__(name, documentation, label_names)
+        self.buckets = sorted(buckets)
+        # label_values -> [bucket_counts (non-cumulative, the last is +Inf), sum]
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        label_values = self._get_label_values(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if label_values not in self._values:
+                self._values[label_values] = ([0] * (len(self.buckets) + 1), [0.])
+            counts, sum_ = self._values[label_values]
+            counts[idx] += 1
+            sum_[0] += value
+
+    def _render_samples(self) -> List[str]:
+        res = []
+        for label_values, (counts, sum_) in self._values.items():
+            cum_count = 0
+            for bucket, count in zip(self.buckets + [float('inf')], counts):
+                cum_count += count
+                labels = self._format_labels(label_values, {'le': _format_value(bucket)})
+                res.append(f'{self.name}_bucket{labels} {_format_value(cum_count)}')
+            labels = self._format_labels(label_values)
+            res.append(f'{self.name}_sum{labels} {_format_value(sum_[0])}')
+            res.append(f'{self.name}_count{labels} {_format_value(cum_count)}')
+        return res
+
+
+class DeployMetrics:
+    """The server metrics of `swift deploy`, exposed by the `/metrics` endpoint.
+
+    The metrics are labeled by `model`, i.e. the model name of the request, so that the traffic of each
+    LoRA adapter can be distinguished.
+    """
+    LATENCY_BUCKETS = [
+        0.001, 0.005, 0.01, 0.02, 0.04, 0.06, 0.08, 0.1, 0.25, 0.5, 0.75, 1., 2.5, 5., 7.5, 10., 20., 40.
+    ]
+    TPOT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5, 0.75, 1., 2.5]
+    E2E_BUCKETS = [0.3, 0.5, 0.8, 1., 1.5, 2., 2.5, 5., 10., 15., 20., 30., 40., 50., 60., 120., 300.]
+
+    def __init__(self, prefix: str = 'swift') -> None:
+        self.requests_in_flight = Gauge(f'{prefix}_requests_in_flight', 'Number of requests being processed.',
+                                        ['model'])
+        self.requests = Counter(f'{prefix}_requests_total', 'Number of finished requests.', ['model', 'status'])
+        self.prompt_tokens = Counter(f'{prefix}_prompt_tokens_total', 'Number of prompt tokens processed.', ['model'])
+        self.generation_tokens = Counter(f'{prefix}_generation_tokens_total', 'Number of generated tokens.', ['model'])
+        self.encode_wait_time = Histogram(f'{prefix}_encode_wait_time_seconds',
+                                          'Time the request waited in the encode pool.', ['model'],
+                                          self.LATENCY_BUCKETS)
+        self.queue_time = Histogram(f'{prefix}_request_queue_time_seconds',
+                                    'Time from the arrival of the request to its submission to the engine.', ['model'],
+                                    self.LATENCY_BUCKETS)
+        self.time_to_first_token = Histogram(f'{prefix}_time_to_first_token_seconds', 'Time to the first token.',
+                                             ['model'], self.LATENCY_BUCKETS)
+        self.time_per_output_token = Histogram(f'{prefix}_time_per_output_token_seconds',
+                                               'Average time per output token after the first token.', ['model'],
+                                               self.TPOT_BUCKETS)
+        self.e2e_request_latency = Histogram(f'{prefix}_e2e_request_latency_seconds', 'End-to-end request latency.',
+                                             ['model'], self.E2E_BUCKETS)
+        self.spec_decode_draft_tokens = Counter(f'{prefix}_spec_decode_draft_tokens_total',
+                                                'Number of tokens drafted by speculative decoding.', ['model'])
+        self.spec_decode_accepted_tokens = Counter(f'{prefix}_spec_decode_accepted_tokens_total',
+                                                   'Number of draft tokens accepted by speculative decoding.',
+                                                   ['model'])
+
+    @property
+    def metrics(self) -> List[_Metric]:
+        return [v for v in self.__dict__.values() if isinstance(v, _Metric)]
+
+    def start_request(self, model: str) -> 'RequestStats':
+        return RequestStats(self, model)
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+class RequestStats:
+    """Tracks the timing of a request and records it in the `DeployMetrics` when finished."""
+
+    def __init__(self, metrics: DeployMetrics, model: str) -> None:
+        self.metrics = metrics
+        self.model = model
+        self.arrival_time = time.perf_counter()
+        self.first_token_time: Optional[float] = None
+        self.submitted = False
+        self.finished = False
+        self.num_prompt_tokens = 0
+        self.num_generated_tokens = 0
+        metrics.requests_in_flight.inc(model=model)
+
+    def encoded(self, wait_time: float) -> None:
+        self.metrics.encode_wait_time.observe(wait_time, model=self.model)
+
+    def submit(self) -> None:
+        """The request is submitted to the engine."""
+        if self.submitted:
+            return
+        self.submitted = True
+        self.metrics.queue_time.observe(time.perf_counter() - self.arrival_time, model=self.model)
+
+    def step(self, num_generated_tokens: int) -> None:
+        """Called with the incremental outputs, to record the time to the first token."""
+        if self.first_token_time is None and num_generated_tokens > 0:
+            self.first_token_time = time.perf_counter()
+            self.metrics.time_to_first_token.observe(self.first_token_time - self.arrival_time, model=self.model)
+
+    def speculate(self, num_draft_tokens: int, num_accepted_tokens: int) -> None:
+        self.metrics.spec_decode_draft_tokens.inc(num_draft_tokens, model=self.model)
+        self.metrics.spec_decode_accepted_tokens.inc(num_accepted_tokens, model=self.model)
+
+    def set_usage(self, num_prompt_tokens: int, num_generated_tokens: int) -> None:
+        self.num_prompt_tokens = num_prompt_tokens
+        self.num_generated_tokens = num_generated_tokens
+
+    def finish(self, status: Literal['success', 'error', 'aborted', 'timeout'] = 'success') -> None:
+        if self.finished:
+            return
+        self.finished = True
+        metrics, model = self.metrics, self.model
+        finish_time = time.perf_counter()
+        metrics.requests_in_flight.dec(model=model)
+        metrics.requests.inc(model=model, status=status)
+        metrics.prompt_tokens.inc(self.num_prompt_tokens, model=model)
+        metrics.generation_tokens.inc(self.num_generated_tokens, model=model)
+        if status != 'success':
+            return
+        metrics.e2e_request_latency.observe(finish_time - self.arrival_time, model=model)
+        if self.first_token_time is not None and self.num_generated_tokens > 1:
+            tpot = (finish_time - self.first_token_time) / (self.num_generated_tokens - 1)
+            metrics.time_per_output_token.observe(tpot, model=model)
@@ -0,0 +1,150 @@
+# Copyright (c) Alibaba, Inc. and its affiliates.
+import time
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from swift.utils import get_logger
+
+logger = get_logger()
+
+# [(key, value)], [head, seq_len, dim], i.e. the legacy kv_cache of a sequence without the batch dim.
+SeqKVCache = List[Tuple[torch.Tensor, torch.Tensor]]
+
+
+class _Node:
+    __slots__ = ('token_ids', 'kv_cache', 'children', 'parent', 'last_access')
+
+    def __init__(self, token_ids: Tuple[int, ...], kv_cache: Optional[SeqKVCache], parent: Optional['_Node']) -> None:
+        self.token_ids = token_ids
+        self.kv_cache = kv_cache
+        self.children: Dict[int, '_Node'] = {}  # the first token of the child -> child
+        self.parent = parent
+        self.last_access = time.monotonic()
+
+
+def _slice(kv_cache: SeqKVCache, start: int, end: Optional[int] = None) -> SeqKVCache:
+    # clone: the slice does not keep the whole tensor alive.
+    return [tuple(t[:, start:end].clone() for t in kv) for kv in kv_cache]
+
+
+def _common_prefix_len(a: Tuple[int, ...], b: List[int]) -> int:
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class PrefixCache:
+    """The radix tree of the kv_cache of the prompts, keyed by the token ids.
+
+    The multi-turn conversations (and the requests sharing a system prompt) only prefill the tokens after the
+    longest cached prefix. Each edge of the tree holds the token ids and their kv_cache. The trees are separated by
+    the adapter name, since the kv_cache depends on the LoRA adapter.
+
+    Args:
+        max_tokens: The max number of the cached tokens. The least recently used leaves are evicted beyond it.
+    """
+
+    def __init__(self, max_tokens: int) -> None:
+        self.max_tokens = max_tokens
+        self.num_tokens = 0
+        self._roots: Dict[Optional[str], _Node] = {}
+        self.num_query_tokens = 0
+        self.num_hit_tokens = 0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.num_hit_tokens / self.num_query_tokens if self.num_query_tokens > 0 else 0.
+
+    def match(self, token_ids: List[int], adapter_name: Optional[str] = None) -> Tuple[int, Optional[SeqKVCache]]:
+        """Find the longest cached prefix of `token_ids`, excluding the last token (whose logits are needed).
+
+        Returns:
+            The length of the prefix and its kv_cache ([head, length, dim]), or (0, None).
+        """
+        self.num_query_tokens += len(token_ids)
+        token_ids = token_ids[:-1]
+        node = self._roots.get(adapter_name)
+        kv_list: List[SeqKVCache] = []
+        length = 0
+        now = time.monotonic()
+        while node is not None and length < len(token_ids):
+            child = node.children.get(token_ids[length])
+            if child is None:
+                break
+            child.last_access = now
+            n = _common_prefix_len(child.token_ids, token_ids[length:])
+            kv_list.append([tuple(t[:, :n] for t in kv) for kv in child.kv_cache])
+            length += n
+            if n < len(child.token_ids):
+                break
+            node = child
+        if length == 0:
+            return 0, None
+        self.num_hit_tokens += length
+        kv_cache = [tuple(torch.cat(ts, dim=1) for ts in zip(*kvs)) for kvs in zip(*kv_list)]
+        return length, kv_cache
+
+    def insert(self, token_ids: List[int], kv_cache: SeqKVCache, adapter_name: Optional[str] = None) -> None:
+        """Insert the kv_cache ([head, len(token_ids), dim]) of the tokens, then evict to `max_tokens`."""
+        if adapter_name not in self._roots:
+            self._roots[adapter_name] = _Node((), None, None)
+        node = self._roots[adapter_name]
+        length = 0
+        now = time.monotonic()
+        while length < len(token_ids):
+            child = node.children.get(token_ids[length])
+            if child is None:
+                leaf = _Node(tuple(token_ids[length:]), _slice(kv_cache, length), node)
+                node.children[token_ids[length]] = leaf
+                self.num_tokens += len(leaf.token_ids)
+                break
+            child.last_access = now
+            n = _common_prefix_len(child.token_ids, token_ids[length:])
+            if n < len(child.token_ids):
+                self._split(child, n)
+                child = node.children[token_ids[length]]
+            length += n
+            node = child
+        self._evict()
+
+    @staticmethod
+    def _split(node: _Node, n: int) -> None:
+        """Split the edge of the node at n, the node becomes the child of the new node."""
+        parent = node.parent
+        new_node = _Node(node.token_ids[:n], _slice(node.kv_cache, 0, n), parent)
+        new_node.last_access = node.last_access
+        parent.children[node.token_ids[0]] = new_node
+        node.token_ids = node.token_ids[n:]
+        node.kv_cache = _slice(node.kv_cache, n)
+        node.parent = new_node
+        new_node.children[node.token_ids[0]] = node
+
+    def _evict(self) -> None:
+        if self.num_tokens <= self.max_tokens:
+            return
+        leaves = []
+        for root in self._roots.values():
+            stack = [root]
+            while stack:
+                node = stack.pop()
+                if node.children:
+                    stack += node.children.values()
+                elif node.parent is not None:
+                    leaves.append(node)
+        leaves.sort(key=lambda node: node.last_access, reverse=True)
+        while self.num_tokens > self.max_tokens and leaves:
+            leaf = leaves.pop()
+            parent = leaf.parent
+            parent.children.pop(leaf.token_ids[0])
+            self.num_tokens -= len(leaf.token_ids)
+            if not parent.children and parent.parent is not None:
+                # The parent becomes a leaf, it is older than its children.
+                leaves.append(parent)
+                leaves.sort(key=lambda node: node.last_access, reverse=True)
+
+    def clear(self) -> None:
+        self._roots = {}
+        self.num_tokens = 0
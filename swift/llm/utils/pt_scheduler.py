@@ -0,0 +1,477 @@
+# Copyright (c) Alibaba, Inc. and its affiliates.
+import asyncio
+import inspect
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+from queue import Queue
+from threading import RLock, Thread
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+import torch
+from peft import PeftModel
+from transformers import GenerationConfig, PreTrainedModel
+from transformers.utils import is_torch_npu_available
+
+from swift.tuners.lora_layers import enable_lora_mixed_batch_forward
+from swift.utils import get_logger
+from .prefix_cache import PrefixCache
+from .template import StopWords, Template, get_stop_words_automaton
+
+logger = get_logger()
+
+try:
+    from transformers import DynamicCache
+except ImportError:
+    DynamicCache = None
+
+KVCache = List[Tuple[torch.Tensor, torch.Tensor]]  # legacy format: [(key, value)], [batch, head, seq_len, dim]
+
+
+def _top_k_top_p_filter(sorted_logits: torch.Tensor, top_k: torch.Tensor, top_p: torch.Tensor) -> torch.Tensor:
+    """Mask the logits (sorted in descending order) in place, the same as transformers' TopKLogitsWarper followed by
+    TopPLogitsWarper: top_p is applied to the distribution renormalized after top_k, the first token is always kept.
+
+    top_k, top_p: [batch_size]
+    """
+    vocab_size = sorted_logits.shape[-1]
+    mask = torch.arange(vocab_size, device=sorted_logits.device)[None] >= top_k[:, None]
+    sorted_logits.masked_fill_(mask, float('-inf'))
+    probs = sorted_logits.softmax(dim=-1)
+    mask = (probs.cumsum(dim=-1) - probs) >= top_p[:, None]
+    mask[:, 0] = False
+    mask &= top_p[:, None] < 1.
+    return sorted_logits.masked_fill_(mask, float('-inf'))
+
+
+class _PtRequest:
+
+    def __init__(self,
+                 input_ids: List[int],
+                 generation_config: GenerationConfig,
+                 stop_words: StopWords,
+                 *,
+                 adapter_names: Optional[List[str]] = None,
+                 seed: Optional[int] = None,
+                 output_logits: bool = False) -> None:
+        self.input_ids = input_ids
+        self.generation_config = generation_config
+        self.stop_words = stop_words
+        self.adapter_names = adapter_names
+        self.adapter_name = adapter_names[0] if adapter_names else None
+        self.seed = seed
+        self.output_logits = output_logits
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.aborted = False
+
+    def put(self, output: Any) -> None:
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, output)
+
+
+class _PtSequence:
+
+    def __init__(self, request: _PtRequest, template: Template, device: torch.device) -> None:
+        self.request = request
+        self.generate_ids = []
+        generation_config = request.generation_config
+        self.max_new_tokens = generation_config.max_new_tokens
+        tokenizer = template.tokenizer
+        eos_token_id = tokenizer.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = generation_config.eos_token_id
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        self.eos_token_id = set(eos_token_id or [])
+        stop_words = list(request.stop_words)
+        if template.suffix[-1] not in stop_words:
+            stop_words.append(template.suffix[-1])
+        self.stop_words_automaton = get_stop_words_automaton(tokenizer, stop_words)
+        self.stop_words_state = self.stop_words_automaton.new_state()
+        self.generator = None
+        if request.seed is not None and generation_config.do_sample:
+            self.generator = torch.Generator(device).manual_seed(request.seed)
+
+    def append(self, token_id: int) -> bool:
+        """Append the new token, return whether the sequence is finished."""
+        self.generate_ids.append(token_id)
+        if token_id in self.eos_token_id or len(self.generate_ids) >= self.max_new_tokens:
+            return True
+        return self.stop_words_automaton.step(self.stop_words_state, [token_id])
+
+
+class PtLoRACache:
+    """The LRU of the LoRA adapters resident in the PeftModel of the pt backend.
+
+    The adapters are loaded on demand. When more than `max_loras` adapters are resident, the least recently used
+    adapters not used by any request are deleted. If all of them are in use, the limit is exceeded temporarily.
+
+    Args:
+        model: The PeftModel, with the adapters loaded at startup.
+        lora_request_list: The `lora_request_list` of the DeployArguments, for the name and the path of the adapters.
+        max_loras: The max number of the resident adapters.
+    """
+
+    def __init__(self, model: PeftModel, lora_request_list: List[Any], max_loras: int) -> None:
+        self.model = model
+        self.lora_paths = {lora_request.lora_name: lora_request.lora_local_path for lora_request in lora_request_list}
+        self.max_loras = max_loras
+        # The adapters are not loaded or deleted during the forward of the scheduler.
+        self.lock = RLock()
+        self._ref_count: Dict[str, int] = OrderedDict(
+            (adapter_name, 0) for adapter_name in model.peft_config.keys() if adapter_name in self.lora_paths)
+
+    @property
+    def resident_adapters(self) -> List[str]:
+        return list(self._ref_count.keys())
+
+    def acquire(self, adapter_name: str) -> None:
+        """Make the adapter resident until `release`. The names not in the `lora_request_list` are ignored."""
+        if adapter_name not in self.lora_paths:
+            return
+        with self.lock:
+            if adapter_name not in self._ref_count:
+                from swift.tuners import Swift
+                logger.info(f'Loading the adapter: {adapter_name}')
+                Swift.from_pretrained(self.model, self.lora_paths[adapter_name], adapter_name, inference_mode=True)
+                self.model.to(self.model.dtype)
+                enable_lora_mixed_batch_forward(self.model)
+                self._ref_count[adapter_name] = 0
+            self._ref_count[adapter_name] += 1
+            self._ref_count.move_to_end(adapter_name)
+            self._evict()
+
+    def release(self, adapter_name: str) -> None:
+        if adapter_name not in self.lora_paths:
+            return
+        with self.lock:
+            self._ref_count[adapter_name] -= 1
+
+    def _evict(self) -> None:
+        for adapter_name, ref_count in list(self._ref_count.items()):
+            if len(self._ref_count) <= self.max_loras:
+                break
+            if ref_count == 0:
+                logger.info(f'Deleting the adapter: {adapter_name}')
+                self.model.base_model.delete_adapter(adapter_name)
+                enable_lora_mixed_batch_forward(self.model)
+                self._ref_count.pop(adapter_name)
+                if self.model.active_adapter == adapter_name:
+                    # The rows use `adapter_names`, but the PeftModel requires a valid active adapter.
+                    self.model.set_adapter(next(reversed(self._ref_count)))
+                    self.model.requires_grad_(False)
+
+
+class PtScheduler:
+    """The continuous batching scheduler of the pt backend.
+
+    A dedicated worker thread decodes the running sequences in one batch (left padded, sharing one kv_cache).
+    At each decode step, the waiting requests are prefilled and merged into the running batch, and the finished
+    sequences are removed from it, so that a new request does not wait for the whole batch to finish.
+    The generated tokens of each step are put into the asyncio queue of each request.
+
+    Args:
+        model: The decoder-only model, which supports `position_ids` and the kv_cache of `DynamicCache`.
+        template: The template, used for the stop words.
+        max_batch_size: The max number of sequences decoded together.
+        lora_cache: The LRU of the LoRA adapters, which are not loaded or deleted during a step.
+        prefix_cache: The kv_cache of the prompts. Only the tokens after the longest cached prefix are prefilled.
+
+    The sequences of a batch can use different LoRA adapters (`adapter_names`), computed in one forward.
+    """
+
+    def __init__(self,
+                 model: PreTrainedModel,
+                 template: Template,
+                 max_batch_size: int = 16,
+                 lora_cache: Optional[PtLoRACache] = None,
+                 prefix_cache: Optional[PrefixCache] = None) -> None:
+        self.model = model
+        self.template = template
+        self.max_batch_size = max_batch_size
+        self.lora_cache = lora_cache
+        self.prefix_cache = prefix_cache
+        self.device = next(model.parameters()).device
+        base_model = model.get_base_model() if isinstance(model, PeftModel) else model
+        parameters = inspect.signature(base_model.forward).parameters
+        self._use_cache_class = getattr(base_model, '_supports_cache_class', False) and DynamicCache is not None
+        self._support_logits_to_keep = 'num_logits_to_keep' in parameters
+        self._is_supported = (not base_model.config.is_encoder_decoder and 'position_ids' in parameters
+                              and self._use_cache_class)
+        pad_token_id = template.tokenizer.pad_token_id
+        self._pad_token_id = 0 if pad_token_id is None else pad_token_id
+        if isinstance(model, PeftModel):
+            enable_lora_mixed_batch_forward(model)
+
+        self._queue = Queue()  # new requests
+        self._waiting: Deque[_PtRequest] = deque()
+        self._running: List[_PtSequence] = []
+        self._kv_cache: Optional[KVCache] = None
+        self._attention_mask: Optional[torch.Tensor] = None
+        self._thread: Optional[Thread] = None
+
+    def is_supported(self, inputs: Dict[str, Any], generation_config: GenerationConfig) -> bool:
+        """Whether the request can be scheduled, else use `inference/inference_stream` instead."""
+        return (self._is_supported and set(inputs.keys()) <= {'input_ids', 'labels', 'loss_scale'}
+                and generation_config.num_beams == 1)
+
+    @property
+    def num_running(self) -> int:
+        return len(self._running)
+
+    @property
+    def num_waiting(self) -> int:
+        return len(self._waiting) + self._queue.qsize()
+
+    async def generate(self,
+                       input_ids: List[int],
+                       generation_config: GenerationConfig,
+                       stop_words: Optional[StopWords] = None,
+                       *,
+                       adapter_names: Optional[List[str]] = None,
+                       seed: Optional[int] = None,
+                       output_logits: bool = False) -> AsyncIterator[Dict[str, Any]]:
+        """Schedule a request, yield the new tokens of each decode step.
+
+        Yields:
+            {'token_ids': List[int], 'is_finished': bool}, and 'logits' (List[Tensor], shape [1, vocab_size])
+            if `output_logits` is True.
+        """
+        if self._thread is None:
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+        request = _PtRequest(
+            input_ids,
+            generation_config,
+            stop_words or [],
+            adapter_names=adapter_names,
+            seed=seed,
+            output_logits=output_logits)
+        self._queue.put(request)
+        is_finished = False
+        try:
+            while not is_finished:
+                output = await request.queue.get()
+                if isinstance(output, Exception):
+                    raise output
+                is_finished = output['is_finished']
+                yield output
+        finally:
+            # e.g. the client is disconnected.
+            request.aborted = not is_finished
+
+    def _run(self) -> None:
+        if is_torch_npu_available():
+            torch.npu.set_device(self.device)
+        while True:
+            if not self._running and not self._waiting:
+                self._waiting.append(self._queue.get())  # block
+            try:
+                with torch.inference_mode(), (self.lora_cache.lock if self.lora_cache else nullcontext()):
+                    self._step()
+            except Exception as e:
+                logger.error(f'PtScheduler error: {e}')
+                for seq in self._running:
+                    seq.request.put(e)
+                self._reset()
+
+    def _reset(self) -> None:
+        self._running = []
+        self._kv_cache = None
+        self._attention_mask = None
+
+    def _get_new_requests(self) -> List[_PtRequest]:
+        while not self._queue.empty():
+            self._waiting.append(self._queue.get())
+        while self._waiting and self._waiting[0].aborted:
+            self._waiting.popleft()
+        requests = []
+        while self._waiting and len(self._running) + len(requests) < self.max_batch_size:
+            request = self._waiting.popleft()
+            if not request.aborted:
+                requests.append(request)
+        return requests
+
+    def _forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, position_ids: torch.Tensor,
+                 kv_cache: Optional[KVCache], requests: List[_PtRequest]) -> Tuple[torch.Tensor, KVCache]:
+        kwargs = {}
+        if any(request.adapter_names is not None for request in requests):
+            # one adapter per row, '-': the base model
+            kwargs['adapter_names'] = [request.adapter_name or '-' for request in requests]
+        if self._support_logits_to_keep:
+            kwargs['num_logits_to_keep'] = 1
+        past_key_values = DynamicCache.from_legacy_cache(kv_cache)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+            **kwargs)
+        kv_cache = outputs.past_key_values
+        if hasattr(kv_cache, 'to_legacy_cache'):
+            kv_cache = kv_cache.to_legacy_cache()
+        return outputs.logits[:, -1], list(kv_cache)
+
+    def _prefill(self, requests: List[_PtRequest]) -> Tuple[torch.Tensor, KVCache, torch.Tensor]:
+        """Prefill the prompts after their cached prefixes.
+
+        Each row is [left padding, cached prefix, left padding, new tokens], the paddings are masked.
+        """
+        prefix_lens, prefix_kv_list = [0] * len(requests), [None] * len(requests)
+        if self.prefix_cache is not None:
+            for i, request in enumerate(requests):
+                prefix_lens[i], prefix_kv_list[i] = self.prefix_cache.match(request.input_ids, request.adapter_name)
+        max_prefix_len = max(prefix_lens)
+        past_kv_cache = None
+        if max_prefix_len > 0:
+            past_kv_cache = self._stack_prefix_kv_cache(prefix_kv_list, max_prefix_len)
+        suffix_lens = [len(request.input_ids) - prefix_len for request, prefix_len in zip(requests, prefix_lens)]
+        max_len = max(suffix_lens)
+        input_ids = torch.full((len(requests), max_len), self._pad_token_id, dtype=torch.int64)
+        attention_mask = torch.zeros((len(requests), max_prefix_len + max_len), dtype=torch.int64)
+        for i, request in enumerate(requests):
+            length = suffix_lens[i]
+            input_ids[i, max_len - length:] = torch.tensor(request.input_ids[prefix_lens[i]:])
+            attention_mask[i, max_prefix_len - prefix_lens[i]:max_prefix_len] = 1
+            attention_mask[i, max_prefix_len + max_len - length:] = 1
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp_(min=0)[:, max_prefix_len:]
+        logits, kv_cache = self._forward(input_ids, attention_mask, position_ids, past_kv_cache, requests)
+        if self.prefix_cache is not None:
+            for i, request in enumerate(requests):
+                idx = attention_mask[i].nonzero()[:, 0]
+                self.prefix_cache.insert(request.input_ids, [tuple(t[i][:, idx] for t in kv) for kv in kv_cache],
+                                         request.adapter_name)
+        return logits, kv_cache, attention_mask
+
+    @classmethod
+    def _stack_prefix_kv_cache(cls, prefix_kv_list: List[Optional[KVCache]], length: int) -> KVCache:
+        """Stack the kv_cache of the prefixes ([head, seq_len, dim], None: no prefix) with left padding."""
+        prefix_kv = next(kv for kv in prefix_kv_list if kv is not None)
+        kv_cache = []
+        for layer_idx, layer_kv in enumerate(prefix_kv):
+            tensors = []
+            for j, t in enumerate(layer_kv):
+                empty = t.new_zeros((t.shape[0], 0, t.shape[2]))
+                tensors.append(
+                    torch.stack(
+                        [cls._left_pad(empty if kv is None else kv[layer_idx][j], length, 1) for kv in prefix_kv_list]))
+            kv_cache.append(tuple(tensors))
+        return kv_cache
+
+    @staticmethod
+    def _left_pad(tensor: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+        pad_len = length - tensor.shape[dim]
+        if pad_len == 0:
+            return tensor
+        shape = list(tensor.shape)
+        shape[dim] = pad_len
+        return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+    def _merge(self, kv_cache: KVCache, attention_mask: torch.Tensor) -> None:
+        """Merge the prefilled sequences into the running batch."""
+        if self._kv_cache is None:
+            self._kv_cache, self._attention_mask = kv_cache, attention_mask
+            return
+        seq_len = max(self._attention_mask.shape[1], attention_mask.shape[1])
+        self._attention_mask = torch.cat(
+            [self._left_pad(self._attention_mask, seq_len, 1),
+             self._left_pad(attention_mask, seq_len, 1)])
+        self._kv_cache = [
+            tuple(
+                torch.cat([self._left_pad(t1, seq_len, 2),
+                           self._left_pad(t2, seq_len, 2)]) for t1, t2 in zip(kv1, kv2))
+            for kv1, kv2 in zip(self._kv_cache, kv_cache)
+        ]
+
+    def _remove(self, finished: List[bool]) -> None:
+        """Remove the finished sequences, and the left padding shared by all the remaining sequences."""
+        if self.prefix_cache is not None:
+            # The next turn of the conversation starts with the prompt and the response.
+            for i, is_finished in enumerate(finished):
+                if is_finished:
+                    seq = self._running[i]
+                    idx = self._attention_mask[i].nonzero()[:, 0]
+                    self.prefix_cache.insert(seq.request.input_ids + seq.generate_ids[:-1],
+                                             [tuple(t[i][:, idx] for t in kv) for kv in self._kv_cache],
+                                             seq.request.adapter_name)
+        keep_idx = [i for i, is_finished in enumerate(finished) if not is_finished]
+        self._running = [self._running[i] for i in keep_idx]
+        if not self._running:
+            self._reset()
+            return
+        if len(keep_idx) < len(finished):
+            idx = torch.tensor(keep_idx, device=self.device)
+            self._attention_mask = self._attention_mask[idx]
+            self._kv_cache = [tuple(t[idx] for t in kv) for kv in self._kv_cache]
+        start = int(self._attention_mask.any(dim=0).int().argmax())
+        if start > 0:
+            self._attention_mask = self._attention_mask[:, start:]
+            self._kv_cache = [tuple(t[:, :, start:] for t in kv) for kv in self._kv_cache]
+
+    def _sample(self, logits: torch.Tensor, seqs: List[_PtSequence]) -> List[int]:
+        logits = logits.to(torch.float32, copy=True)  # the logits are also the outputs, do not penalize in place
+        for i, seq in enumerate(seqs):
+            penalty = seq.request.generation_config.repetition_penalty
+            if penalty is not None and penalty != 1.:
+                token_ids = torch.tensor(seq.request.input_ids + seq.generate_ids, device=logits.device)
+                score = logits[i].gather(0, token_ids)
+                score = torch.where(score < 0, score * penalty, score / penalty)
+                logits[i].scatter_(0, token_ids, score)
+        next_tokens = logits.argmax(dim=-1)
+        sample_idx = [i for i, seq in enumerate(seqs) if seq.request.generation_config.do_sample]
+        if sample_idx:
+            configs = [seqs[i].request.generation_config for i in sample_idx]
+            vocab_size = logits.shape[-1]
+            device = logits.device
+            temperature = torch.tensor([config.temperature or 1. for config in configs], device=device)
+            top_k = torch.tensor([min(config.top_k or vocab_size, vocab_size) for config in configs], device=device)
+            top_p = torch.tensor([1. if config.top_p is None else config.top_p for config in configs], device=device)
+            sorted_logits, sorted_idx = (logits[sample_idx] / temperature[:, None]).sort(dim=-1, descending=True)
+            probs = _top_k_top_p_filter(sorted_logits, top_k, top_p).softmax(dim=-1)
+            sampled = torch.empty((len(sample_idx), 1), dtype=torch.int64, device=device)
+            for j, i in enumerate(sample_idx):
+                sampled[j] = torch.multinomial(probs[j], 1, generator=seqs[i].generator)
+            next_tokens[sample_idx] = sorted_idx.gather(-1, sampled)[:, 0]
+        return next_tokens.tolist()
+
+    def _put_outputs(self, seqs: List[_PtSequence], logits: torch.Tensor) -> List[bool]:
+        next_tokens = self._sample(logits, seqs)
+        finished = []
+        for i, (seq, token_id) in enumerate(zip(seqs, next_tokens)):
+            is_finished = seq.append(token_id) or seq.request.aborted
+            output = {'token_ids': [token_id], 'is_finished': is_finished}
+            if seq.request.output_logits:
+                output['logits'] = [logits[i:i + 1].cpu()]
+            seq.request.put(output)
+            finished.append(is_finished)
+        return finished
+
+    def _step(self) -> None:
+        finished = []
+        if self._running:
+            # decode
+            seqs = self._running
+            last_ids = torch.tensor([seq.generate_ids[-1] for seq in seqs], device=self.device)[:, None]
+            attention_mask = torch.cat([self._attention_mask, self._attention_mask.new_ones((len(seqs), 1))], dim=1)
+            position_ids = attention_mask.sum(dim=-1, keepdim=True) - 1
+            logits, self._kv_cache = self._forward(last_ids, attention_mask, position_ids, self._kv_cache,
+                                                   [seq.request for seq in seqs])
+            self._attention_mask = attention_mask
+            finished = self._put_outputs(seqs, logits)
+
+        requests = self._get_new_requests()
+        if requests:
+            seqs = [_PtSequence(request, self.template, self.device) for request in requests]
+            try:
+                logits, kv_cache, attention_mask = self._prefill(requests)
+            except Exception as e:
+                for seq in seqs:
+                    seq.request.put(e)
+                raise
+            self._merge(kv_cache, attention_mask)
+            self._running += seqs
+            finished += self._put_outputs(seqs, logits)
+        self._remove(finished)
@@ -2,12 +2,13 @@
 import inspect
 import os
 import re
+from collections import OrderedDict
 from contextlib import contextmanager
 from copy import deepcopy
 from datetime import datetime
-from functools import partial, wraps
+from functools import lru_cache, partial, wraps
 from types import MethodType
-from typing import Any, Callable, Dict, List, Literal, Optional, Tuple, TypeVar, Union
+from typing import Any, Callable, Dict, List, Literal, Optional, Sequence, Tuple, TypeVar, Union
 
 import json
 import torch
@@ -159,30 +160,245 @@ class TemplateType:
         return res
 
 
+class _StopWordsState:
+    __slots__ = ('node', 'is_finished', 'token_ids', 'prefix_offset', 'read_offset', 'text', 'tokenizer_kwargs')
+
+    def __init__(self, tokenizer_kwargs: Dict[str, Any]) -> None:
+        self.node = 0  # the node of the automaton
+        self.is_finished = False
+        # text matching
+        self.token_ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.text = ''
+        self.tokenizer_kwargs = tokenizer_kwargs
+
+
+class StopWordsAutomaton:
+    """Match the stop words token by token.
+
+    The stop words of token ids, and the str stop words which are added tokens (e.g. '<|im_end|>'),
+    are compiled into an Aho-Corasick automaton of token ids. The tokenization of the other str stop words
+    is ambiguous (e.g. 'Observation:' can be generated as different tokens), they are matched on the text
+    decoded incrementally (only the new tokens are decoded).
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizerBase, stop_words: StopWords) -> None:
+        self.tokenizer = tokenizer
+        added_vocab = tokenizer.get_added_vocab()
+        token_stop_words, text_stop_words = [], []
+        for stop_word in stop_words:
+            if not stop_word:
+                continue
+            if isinstance(stop_word, str):
+                if stop_word in added_vocab:
+                    token_stop_words.append([added_vocab[stop_word]])
+                else:
+                    text_stop_words.append(stop_word)
+            else:
+                token_stop_words.append(list(stop_word))
+        self.text_stop_words = text_stop_words
+        self._max_text_len = max([len(stop_word) for stop_word in text_stop_words], default=0)
+        self._build(token_stop_words)
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.text_stop_words and len(self._goto) == 1
+
+    def _build(self, token_stop_words: List[List[int]]) -> None:
+        goto: List[Dict[int, int]] = [{}]
+        is_end = [False]
+        for token_ids in token_stop_words:
+            node = 0
+            for token_id in token_ids:
+                if token_id not in goto[node]:
+                    goto[node][token_id] = len(goto)
+                    goto.append({})
+                    is_end.append(False)
+                node = goto[node][token_id]
+            is_end[node] = True
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        for node in queue:  # BFS
+            for token_id, child in goto[node].items():
+                f = fail[node]
+                while f and token_id not in goto[f]:
+                    f = fail[f]
+                fail[child] = goto[f].get(token_id, 0) if node else 0
+                is_end[child] |= is_end[fail[child]]
+                queue.append(child)
+        self._goto, self._fail, self._is_end = goto, fail, is_end
+
+    def new_state(self, **tokenizer_kwargs) -> _StopWordsState:
+        return _StopWordsState(tokenizer_kwargs)
+
+    def _match_text(self, state: _StopWordsState) -> bool:
+        token_ids = state.token_ids
+        prefix_text = self.tokenizer.decode(token_ids[state.prefix_offset:state.read_offset], **state.tokenizer_kwargs)
+        new_text = self.tokenizer.decode(token_ids[state.prefix_offset:], **state.tokenizer_kwargs)
+        if len(new_text) <= len(prefix_text) or new_text.endswith('\ufffd'):
+            return False
+        text = state.text + new_text[len(prefix_text):]
+        state.token_ids = token_ids[state.read_offset:]
+        state.prefix_offset, state.read_offset = 0, len(state.token_ids)
+        state.text = text[max(len(text) - self._max_text_len + 1, 0):]
+        return any(stop_word in text for stop_word in self.text_stop_words)
+
+    def step(self, state: _StopWordsState, token_ids: List[int]) -> bool:
+        """Feed the new tokens of a sequence, return whether the sequence is finished."""
+        if state.is_finished:
+            return True
+        goto, fail = self._goto, self._fail
+        node = state.node
+        for token_id in token_ids:
+            while node and token_id not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(token_id, 0)
+            if self._is_end[node]:
+                state.is_finished = True
+        state.node = node
+        if self.text_stop_words and not state.is_finished:
+            state.token_ids += token_ids
+            state.is_finished = self._match_text(state)
+        return state.is_finished
+
+
+@lru_cache(maxsize=128)
+def _get_stop_words_automaton(tokenizer: PreTrainedTokenizerBase, stop_words: Tuple) -> StopWordsAutomaton:
+    return StopWordsAutomaton(tokenizer, list(stop_words))
+
+
+def get_stop_words_automaton(tokenizer: PreTrainedTokenizerBase, stop_words: StopWords) -> StopWordsAutomaton:
+    stop_words = tuple(tuple(stop_word) if isinstance(stop_word, list) else stop_word for stop_word in stop_words)
+    return _get_stop_words_automaton(tokenizer, stop_words)
+
+
+# Since transformers 4.39, the stopping criteria return whether each row is finished.
+_is_stopping_criteria_per_row = version.parse(transformers.__version__) >= version.parse('4.39.0')
+
+
 class StopWordsCriteria(StoppingCriteria):
-    # The returned sentence includes stop words.
-    def __init__(self, tokenizer: PreTrainedTokenizerBase, stop_words: StopWords, **tokenizer_kwargs) -> None:
+    """The stopping criteria of batched generation, returning whether each row is finished.
+
+    The returned sentence includes stop words. Only the new tokens are copied to the host at each step,
+    and matched by `StopWordsAutomaton` with the state of each row. Beam search reorders the rows between
+    the steps, so with `incremental=False` the states are rebuilt from the generated ids of each row at each step.
+    Before transformers 4.39, the criteria stops the whole batch, so it returns whether all the rows are finished.
+    """
+
+    def __init__(self,
+                 tokenizer: PreTrainedTokenizerBase,
+                 stop_words: StopWords,
+                 *,
+                 incremental: bool = True,
+                 **tokenizer_kwargs) -> None:
         self.tokenizer = tokenizer
         self.stop_words = stop_words
+        self.incremental = incremental
         self.tokenizer_kwargs = tokenizer_kwargs
+        self.automaton = get_stop_words_automaton(tokenizer, stop_words)
         self.start_idx = -1
+        self._seq_len = -1
+        self._states: List[_StopWordsState] = []
 
-    def __call__(self, input_ids: torch.Tensor, scores: torch.Tensor, **kwargs) -> bool:
-        if self.start_idx == -1:
-            self.start_idx = len(input_ids[0]) - 1
-        tokenizer = self.tokenizer
-        stop_words = self.stop_words
-        # [-20:]: Assuming the end tokens do not exceed 20 tokens,
-        #   to avoid input_ids being too long and affecting efficiency.
-        text = tokenizer.decode(input_ids[0, self.start_idx:][-20:], **self.tokenizer_kwargs)
-        for stop_word in stop_words:
-            if isinstance(stop_word, str):
-                if stop_word in text:
-                    return True
-            else:  # list
-                if len(stop_word) > 0 and input_ids[0].tolist()[-len(stop_word):] == stop_word:
-                    return True
+    def __call__(self, input_ids: torch.Tensor, scores: torch.Tensor, **kwargs) -> Union[torch.BoolTensor, bool]:
+        batch_size, seq_len = input_ids.shape
+        if self.automaton.is_empty:
+            is_done = [False] * batch_size
+        else:
+            if self.start_idx == -1 or len(self._states) != batch_size or seq_len <= self._seq_len:
+                # a new generation
+                self.start_idx = self._seq_len = seq_len - 1
+                self._states = [self.automaton.new_state(**self.tokenizer_kwargs) for _ in range(batch_size)]
+            if not self.incremental:
+                self._seq_len = self.start_idx
+                self._states = [self.automaton.new_state(**self.tokenizer_kwargs) for _ in range(batch_size)]
+            new_token_ids = input_ids[:, self._seq_len:].tolist()  # the only device-to-host copy
+            self._seq_len = seq_len
+            is_done = [self.automaton.step(state, token_ids) for state, token_ids in zip(self._states, new_token_ids)]
+        if not _is_stopping_criteria_per_row:
+            return all(is_done)
+        return torch.tensor(is_done, dtype=torch.bool, device=input_ids.device)
+
+
+class IncrementalDetokenizer:
+    """Decode the generated ids of a sequence incrementally for streaming.
+
+    Only the new tokens are decoded at each step, together with the tokens between `prefix_offset`
+    and `read_offset` as the context (e.g. the leading space of sentencepiece). The text ending with
+    an incomplete UTF-8 character is held back, and so is the tail which may be the beginning of
+    `template.suffix[-1]`. The concatenation of the deltas equals `template.generate_ids_to_response(generate_ids)`.
+    """
+
+    def __init__(self, template: 'Template', tokenizer_kwargs: Optional[Dict[str, Any]] = None) -> None:
+        self.tokenizer = template.tokenizer
+        self.tokenizer_kwargs = tokenizer_kwargs or {}
+        suffix = template.suffix[-1]
+        self.suffix_ids = suffix if isinstance(suffix, list) else None
+        self.suffix_text = suffix if isinstance(suffix, str) else None
+        self.eos_token_id = self.tokenizer.eos_token_id
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self._pending_text = ''  # decoded, but not returned
+        self._deltas = []
+
+    @property
+    def response(self) -> str:
+        return ''.join(self._deltas)
+
+    @staticmethod
+    def _get_prefix_tail_len(seq: Sequence, suffix: Sequence) -> int:
+        """The length of the longest tail of `seq` which is a prefix of `suffix`."""
+        for i in range(min(len(seq), len(suffix)), 0, -1):
+            if seq[-i:] == suffix[:i]:
+                return i
+        return 0
+
+    def _get_end(self, generate_ids: List[int], is_finished: bool) -> int:
+        end = len(generate_ids)
+        if self.suffix_ids:
+            tail = generate_ids[-len(self.suffix_ids):]
+            if not is_finished:
+                end -= self._get_prefix_tail_len(tail, self.suffix_ids)
+            elif tail == self.suffix_ids:
+                end -= len(self.suffix_ids)
+        if end > 0 and generate_ids[end - 1] == self.eos_token_id:
+            end -= 1
+        return max(end, self.read_offset)
+
+    def step(self, generate_ids: List[int], is_finished: bool = False) -> str:
+        """Return the new text of `generate_ids` (all the generated ids of the sequence till now)."""
+        if hasattr(generate_ids, 'tolist'):
+            generate_ids = generate_ids.tolist()
+        end = self._get_end(generate_ids, is_finished)
+        if end > self.read_offset:
+            tokenizer = self.tokenizer
+            prefix_text = tokenizer.decode(generate_ids[self.prefix_offset:self.read_offset], **self.tokenizer_kwargs)
+            new_text = tokenizer.decode(generate_ids[self.prefix_offset:end], **self.tokenizer_kwargs)
+            if is_finished or len(new_text) > len(prefix_text) and not new_text.endswith('\ufffd'):
+                self._pending_text += new_text[len(prefix_text):]
+                self.prefix_offset = self.read_offset
+                self.read_offset = end
+        text = self._pending_text
+        if self.suffix_text:
+            if not is_finished:
+                hold_len = self._get_prefix_tail_len(text[-len(self.suffix_text):], self.suffix_text)
+            else:
+                hold_len = len(self.suffix_text) if text.endswith(self.suffix_text) else 0
+            text = text[:len(text) - hold_len]
+        self._pending_text = '' if is_finished else self._pending_text[len(text):]
+        if text:
+            self._deltas.append(text)
+        return text
+
+
+def is_packing_isolated(model: Optional[torch.nn.Module]) -> bool:
+    """Whether the attention is restricted to each sample of a pack, i.e. flash attention with transformers>=4.44,
+    which takes the varlen path by the restarting `position_ids` when `attention_mask` is None."""
+    if model is None or version.parse(transformers.__version__) < version.parse('4.44.0'):
         return False
+    config = getattr(model, 'config', None)
+    return getattr(config, '_attn_implementation', None) == 'flash_attention_2'
 
 
 def is_deepspeed_enabled():
@@ -215,6 +431,8 @@ class Template:
     load_medias = True
     compute_per_round_loss = True  # for rlhf
     output_prompt_answer = False  # for encoder-decoder & kto
+    use_token_cache = True  # memoize the token ids of the template fragments
+    token_cache_size = 1024  # the max number of non-template pieces (e.g. system) kept in the LRU cache
 
     def __init__(self,
                  prefix: Prompt,
@@ -317,6 +535,7 @@ class Template:
                 self.response_loss_scale_map = self.response_loss_scale_map['response']
 
         self.sequence_parallel_size = kwargs.get('sequence_parallel_size', 1)
+        self._token_cache = None  # lazy init, subclasses may modify the prompts after `_init_template`
         self.rescale_image = kwargs.get('rescale_image', -1)
 
         for key in ['prefix', 'prompt', 'chat_sep', 'suffix', 'system_prefix']:
@@ -579,32 +798,92 @@ class Template:
         inputs['input_embedding_ranges'] = ranges
         inputs['input_ids'] = new_input_ids
 
+    def batch_encode(self, examples: List[Dict[str, Any]]) -> List[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """The same as `[self.encode(example) for example in examples]`.
+
+        The text pieces of all the examples that are not cached are tokenized with a single batched call
+        of the fast tokenizer, instead of one call per context. The multimodal examples and the templates
+        that override the encoding are encoded one by one.
+        """
+        if not self._support_batch_encode():
+            return [self.encode(example) for example in examples]
+        if self._token_cache is None:
+            self._init_token_cache()
+        res: List[Optional[Tuple[Dict[str, Any], Dict[str, Any]]]] = [None] * len(examples)
+        concat_res = []
+        for i, example in enumerate(examples):
+            if any([example.get(key) for key in Template.special_keys]):
+                res[i] = self.encode(example)
+                continue
+            example = self.preprocess(example)
+            context_lists = self._concat_context_lists(
+                **self._get_query_kwargs(example),
+                auto_add_bos=self.auto_add_bos,
+                example=example,
+                is_multi_modal=False)
+            concat_res.append((i, example, context_lists))
+
+        texts = {}  # ordered set
+        for _, _, context_lists in concat_res:
+            for _, context_list, _ in context_lists:
+                for context in context_list:
+                    if not isinstance(context, str):
+                        continue
+                    for piece in self._split_context(context):
+                        if piece not in self._token_cache and piece not in self._token_lru:
+                            texts[piece] = None
+        texts = list(texts.keys())
+        self._batch_token_cache = dict(zip(texts, self._tokenize(texts))) if texts else {}
+        try:
+            for i, example, context_lists in concat_res:
+                inputs, tokenizer_kwargs = self._tokenize_context_lists(context_lists, example.get('response'),
+                                                                        self.truncation_strategy)
+                self._postprocess_inputs(inputs, example)
+                res[i] = (inputs, tokenizer_kwargs)
+        finally:
+            self._batch_token_cache = None
+        return res
+
+    def _support_batch_encode(self) -> bool:
+        if not getattr(self.tokenizer, 'is_fast', False):
+            return False
+        cls = self.__class__
+        return all([
+            getattr(cls, name) is getattr(Template, name) for name in [
+                'encode', 'preprocess', '_encode', '_concat_and_tokenize', '_encode_context_list', '_tokenize',
+                '_get_tokenizer_kwargs'
+            ]
+        ])
+
+    @staticmethod
+    def _get_query_kwargs(example: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'query': example.get('query') or '',
+            'query_role': example.get('query_role') or 'user',
+            'response': example.get('response'),
+            'history': example.get('history') or [],
+            'history_roles': example.get('history_roles'),
+            'system': example.get('system', None),
+        }
+
+    def _postprocess_inputs(self, inputs: Dict[str, Any], example: Dict[str, Any]) -> None:
+        if self._is_lmdeploy or self._is_vllm:
+            for key in ['images', 'audios', 'videos']:
+                inputs[key] = example.get(key)
+        if inputs.get('labels') is None:
+            inputs.pop('loss_scale', None)
+
     def _encode(self, example: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
         """return: inputs, tokenizer_kwargs"""
-        query: str = example.get('query') or ''
-        query_role: str = example.get('query_role') or 'user'
-        response: Optional[str] = example.get('response')
-        history: History = example.get('history') or []
-        history_roles: Optional[History] = example.get('history_roles')
-        system: Optional[str] = example.get('system', None)
         is_multi_modal: bool = any([example.get(key) for key in Template.special_keys])
 
         inputs, tokenizer_kwargs = self._concat_and_tokenize(
-            query,
-            query_role,
-            response,
-            history,
-            history_roles,
-            system,
-            self.truncation_strategy,
+            **self._get_query_kwargs(example),
+            truncation_strategy=self.truncation_strategy,
             auto_add_bos=self.auto_add_bos,
             example=example,
             is_multi_modal=is_multi_modal)
-        if self._is_lmdeploy or self._is_vllm:
-            for key in ['images', 'audios', 'videos']:
-                inputs[key] = example.get(key)
-        if inputs.get('labels') is None:
-            inputs.pop('loss_scale', None)
+        self._postprocess_inputs(inputs, example)
         return inputs, tokenizer_kwargs
 
     def _concat_context_list(
@@ -702,6 +981,102 @@ class Template:
         return self.tokenizer(
             context, return_attention_mask=False, add_special_tokens=False, **tokenizer_kwargs)['input_ids']
 
+    def _init_token_cache(self) -> None:
+        """Memoize the token ids of the static template fragments.
+
+        The contexts are split at the special tokens used by the template (e.g. `<|im_start|>`),
+        so that the fixed pieces (e.g. `assistant\\n`) are tokenized only once and only the pieces containing
+        the user content are tokenized per example. The splitting is enabled only if the tokenizer tokenizes
+        the pieces around a special token independently, so the token ids are the same as tokenizing the whole context.
+        """
+        tokenizer = self.tokenizer
+        self._token_cache: Dict[str, List[int]] = {}
+        self._token_lru: Dict[str, List[int]] = OrderedDict()
+        self._special_token_pattern = None
+        self._empty_token_ids = tokenizer.encode('')
+        self._suffix_token_ids = None
+        self._batch_token_cache: Optional[Dict[str, List[int]]] = None
+        if not self.use_token_cache:
+            return
+        fragments = []
+        for key in ['prefix', 'prompt', 'chat_sep', 'suffix', 'system_prefix', 'tool_prompt']:
+            fragments += [context for context in getattr(self, key) or [] if isinstance(context, str)]
+        if self.default_system is not None:
+            fragments += [context.replace('{{SYSTEM}}', self.default_system) for context in fragments]
+        special_tokens = set(getattr(tokenizer, 'all_special_tokens', None) or [])
+        try:
+            special_tokens.update(tokenizer.get_added_vocab())
+        except (AttributeError, NotImplementedError):
+            pass
+        special_tokens = [
+            token for token in special_tokens
+            if token and any(token in context for context in fragments) and len(self._tokenize(token)) == 1
+        ]
+        if not special_tokens or not self._check_special_token_split(special_tokens):
+            return
+        special_tokens.sort(key=len, reverse=True)  # longest match first
+        self._special_token_pattern = re.compile('(' + '|'.join(re.escape(token) for token in special_tokens) + ')')
+        for context in fragments:
+            for piece in self._special_token_pattern.split(context):
+                if piece and '{{' not in piece:
+                    self._token_cache[piece] = self._tokenize(piece)
+
+    def _check_special_token_split(self, special_tokens: List[str]) -> bool:
+        """Check that `tokenize(a + special_token + b) == tokenize(a) + tokenize(special_token) + tokenize(b)`.
+
+        e.g. the sentencepiece tokenizers may add a prefix space to each piece, and the added tokens with
+            `lstrip/rstrip` swallow the spaces around them.
+        """
+        probes = ['', 'a', ' a', 'a ', ' ', '\n', 'a\n', '\n\n', 'Hello, world!', ' 1', '你好']
+        probe_token_ids = [self._tokenize(probe) if probe else [] for probe in probes]
+        for token in special_tokens:
+            token_ids = self._tokenize(token)
+            for left, left_ids in zip(probes, probe_token_ids):
+                for right, right_ids in zip(probes, probe_token_ids):
+                    if self._tokenize(left + token + right) != left_ids + token_ids + right_ids:
+                        logger.debug(f'The special token {token!r} cannot be split, the token cache is disabled.')
+                        return False
+        return True
+
+    def _split_context(self, context: str) -> List[str]:
+        if self._special_token_pattern is None:
+            return [context]
+        return [piece for piece in self._special_token_pattern.split(context) if piece]
+
+    def _tokenize_with_cache(self, context: str) -> List[int]:
+        batch_token_cache = self._batch_token_cache  # see `batch_encode`
+        if self._special_token_pattern is None:
+            token_list = batch_token_cache.get(context) if batch_token_cache else None
+            return self._tokenize(context) if token_list is None else token_list
+        token_list = []
+        for piece in self._split_context(context):
+            piece_token_list = self._token_cache.get(piece)
+            if piece_token_list is None and batch_token_cache:
+                piece_token_list = batch_token_cache.get(piece)
+            if piece_token_list is None:
+                piece_token_list = self._get_lru_token_list(piece)
+            token_list += piece_token_list
+        return token_list
+
+    def _get_lru_token_list(self, piece: str) -> List[int]:
+        # e.g. the system prompts. Tolerate the concurrent eviction of the threads.
+        token_lru = self._token_lru
+        token_list = token_lru.get(piece)
+        if token_list is not None:
+            try:
+                token_lru.move_to_end(piece)
+            except KeyError:
+                pass
+            return token_list
+        token_list = self._tokenize(piece)
+        token_lru[piece] = token_list
+        while len(token_lru) > self.token_cache_size:
+            try:
+                token_lru.popitem(last=False)
+            except KeyError:
+                break
+        return token_list
+
     def replace_tag(self, media_type: Literal['image', 'video', 'audio'], index: int,
                     example: Dict[str, Any]) -> List[Context]:
         if media_type == 'image':
@@ -825,6 +1200,8 @@ class Template:
         labels: List[int] = []
         loss_scale: List[float] = []
         tokenizer_kwargs = {}
+        if self._token_cache is None:
+            self._init_token_cache()
         if loss_scale_list is None:
             loss_scale_list = [0.] * len(context_list)
         for i, (context, loss_weight) in enumerate(zip(context_list, loss_scale_list)):
@@ -833,7 +1210,10 @@ class Template:
                 # while curr_tokenizer_kwargs is the tokenizer_kwargs for the current context.
                 curr_tokenizer_kwargs = self._get_tokenizer_kwargs(context)
                 self._concat_tokenizer_kwargs(tokenizer_kwargs, curr_tokenizer_kwargs)
-                token_list = self._tokenize(context, **curr_tokenizer_kwargs)
+                if curr_tokenizer_kwargs:
+                    token_list = self._tokenize(context, **curr_tokenizer_kwargs)
+                else:
+                    token_list = self._tokenize_with_cache(context)
             else:
                 token_list = context
             input_ids += token_list
@@ -870,14 +1250,33 @@ class Template:
         """
         return: inputs, tokenizer_kwargs
         """
+        context_lists = self._concat_context_lists(query, query_role, response, history, history_roles, system,
+                                                   auto_add_bos, **kwargs)
+        return self._tokenize_context_lists(context_lists, response, truncation_strategy)
+
+    def _concat_context_lists(self,
+                              query: str,
+                              query_role: str,
+                              response: Optional[str],
+                              history: History,
+                              history_roles: History,
+                              system: Optional[str],
+                              auto_add_bos: bool = False,
+                              **kwargs) -> List[Tuple[Optional[str], List[Context], List[float]]]:
+        """
+        return: [(key, context_list, loss_scale_list)], the simplified context lists to be tokenized.
+            key is 'answer'/'prompt' if `output_prompt_answer`, else None.
+        """
         history = history.copy()
         history_roles = history_roles.copy()
 
         res_context_list: List[Context] = []
         loss_scale_list: List[float] = []
+        if self._token_cache is None:
+            self._init_token_cache()
         if auto_add_bos:
             bos_token_id = self.tokenizer.bos_token_id
-            if isinstance(bos_token_id, int) and bos_token_id in self.tokenizer.encode(''):
+            if isinstance(bos_token_id, int) and bos_token_id in self._empty_token_ids:
                 res_context_list.append([bos_token_id])
                 loss_scale_list.append(0.)
         prompt = self.prompt.copy()
@@ -918,16 +1317,30 @@ class Template:
                     compute_loss=self.compute_per_round_loss or is_suffix)
                 res_context_list += extra_context_list
                 loss_scale_list += ([1.] if is_suffix else [0.]) * len(extra_context_list)
-        inputs = {}
         if self.output_prompt_answer:
-            # tokenizer_kwargs: use prompt
             answer_len = len(extra_context_list) + bool(response is not None)
             total_len = len(res_context_list)
+            res = []
             for key, _slice in zip(['answer', 'prompt'],
                                    [slice(total_len - answer_len, total_len),
                                     slice(0, total_len - answer_len)]):
                 _res_context_list, _loss_scale_list = self._simplify_context_list(res_context_list[_slice],
                                                                                   loss_scale_list[_slice], **kwargs)
+                res.append((key, _res_context_list, _loss_scale_list))
+            return res
+        res_context_list, loss_scale_list = self._simplify_context_list(res_context_list, loss_scale_list, **kwargs)
+        return [(None, res_context_list, loss_scale_list)]
+
+    def _tokenize_context_lists(self, context_lists: List[Tuple[Optional[str], List[Context],
+                                                                List[float]]], response: Optional[str],
+                                truncation_strategy: str) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        return: inputs, tokenizer_kwargs
+        """
+        inputs = {}
+        if self.output_prompt_answer:
+            # tokenizer_kwargs: use prompt
+            for key, _res_context_list, _loss_scale_list in context_lists:
                 input_ids, labels, loss_scale, tokenizer_kwargs = self._encode_context_list(
                     _res_context_list, _loss_scale_list)
                 inputs[f'{key}_input_ids'], inputs[f'{key}_labels'] = input_ids, labels
@@ -940,11 +1353,13 @@ class Template:
                 inputs['answer_labels'] = None
 
         else:
-            res_context_list, loss_scale_list = self._simplify_context_list(res_context_list, loss_scale_list, **kwargs)
+            _, res_context_list, loss_scale_list = context_lists[0]
             input_ids, labels, loss_scale, tokenizer_kwargs = self._encode_context_list(
                 res_context_list, loss_scale_list)
             if labels is not None:
-                self.use_dynamic_eos(labels, self._encode_context_list(self.suffix)[0])
+                if self._suffix_token_ids is None:
+                    self._suffix_token_ids = self._encode_context_list(self.suffix)[0]
+                self.use_dynamic_eos(labels, self._suffix_token_ids)
 
         if response is None:
             labels = None
@@ -1066,6 +1481,11 @@ class Template:
             value = _local_var[key]
             if value is not None:
                 res[key] = value
+        if ('position_ids' in batch[0] and padding_right and self.sequence_parallel_size == 1 and not use_torchacc()
+                and is_packing_isolated(self.model)):
+            # packing: flash attention restricts the attention to each sample by the restarting `position_ids`
+            # (only if `attention_mask` is None), the right padding tokens do not affect the real tokens.
+            res.pop('attention_mask', None)
 
         if '_data' in batch[0]:
             res['_data'] = [b['_data'] for b in batch]
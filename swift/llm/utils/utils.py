@@ -3,13 +3,17 @@
 import heapq
 import importlib.util
 import os
+import pickle
 import shutil
 import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from copy import deepcopy
 from functools import partial, wraps
-from queue import Empty, Queue
+from itertools import islice
+from queue import Queue
 from tempfile import TemporaryDirectory
-from threading import Thread
+from threading import Lock, Thread, local
 from types import MethodType
 from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Sequence, Set, Tuple, Union
 
@@ -30,14 +34,14 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data import Dataset, IterableDataset
 from tqdm.auto import tqdm
 from transformers import (GenerationConfig, PretrainedConfig, PreTrainedModel, PreTrainedTokenizerBase,
-                          StoppingCriteriaList, TextStreamer, trainer)
+                          StoppingCriteria, StoppingCriteriaList, TextStreamer, trainer)
 from transformers.generation.streamers import BaseStreamer
-from transformers.utils import is_torch_npu_available
+from transformers.utils import ModelOutput, is_torch_npu_available
 
 from swift.hub import ModelScopeConfig
 from swift.utils import get_dist_setting, get_logger, is_ddp_plus_mp, stat_array, upper_bound, use_torchacc
 from swift.utils.module_mapping import MODEL_KEYS_MAPPING, MultiModelKeys
-from .template import History, StopWords, StopWordsCriteria, Template
+from .template import History, IncrementalDetokenizer, StopWords, StopWordsCriteria, Template
 
 DATASET_TYPE = Union[HfDataset, HfIterableDataset]
 
@@ -143,8 +147,187 @@ class LLMDataset(Dataset):
         return len(self.data)
 
 
+class ColumnarLLMDataset(Dataset):
+    """A columnar LLMDataset: each field is stored as one contiguous numpy buffer plus an offsets array,
+    so row `i` is `buffers[key][offsets[key][i]:offsets[key][i + 1]]`.
+
+    Compared with a list of dicts holding python lists, it takes 4 bytes per token for each field,
+    pickles as a few large arrays, and is not touched by refcounting after the dataloader workers fork.
+    """
+
+    def __init__(self,
+                 buffers: Dict[str, np.ndarray],
+                 offsets: Dict[str, np.ndarray],
+                 dtypes: Dict[str, str],
+                 indices: Optional[np.ndarray] = None) -> None:
+        self.buffers = buffers
+        self.offsets = offsets
+        self.dtypes = dtypes  # The dtype of the values, the rows are returned as lists
+        self.keys: List[str] = list(dtypes.keys())
+        self.indices = indices
+
+    @classmethod
+    def from_packed(cls, packed_list: List[Dict[str, Any]]) -> Optional['ColumnarLLMDataset']:
+        """Create the dataset from the chunks returned by `_pack_rows`. The rows which are None are skipped.
+
+        return: None if the rows cannot be stored in columns (e.g. multimodal tensors).
+        """
+        keys = None
+        buffer_list, length_list = {}, {}
+        for packed in packed_list:
+            if 'rows' in packed:
+                if any(row is not None for row in packed['rows']):
+                    return
+                continue
+            if keys is None:
+                keys = packed['keys']
+                buffer_list = {key: [] for key in keys}
+                length_list = {key: [] for key in keys}
+            elif packed['keys'] != keys:
+                return
+            for key in keys:
+                buffer_list[key].append(packed['buffers'][key])
+                length_list[key].append(packed['lengths'][key])
+        if keys is None:
+            return
+        buffers, offsets, dtypes = {}, {}, {}
+        for key in keys:
+            kinds = {buffer.dtype.kind for buffer in buffer_list[key] if buffer.size > 0}
+            if 'f' in kinds:
+                dtype, storage_dtype = 'float32', np.float32
+            elif kinds == {'b'}:
+                dtype, storage_dtype = 'bool', np.bool_
+            else:
+                dtype, storage_dtype = 'int64', np.int64
+            buffer = np.concatenate(buffer_list[key]).astype(storage_dtype)
+            if dtype == 'int64' and buffer.size > 0 and np.iinfo(np.int32).min <= buffer.min() \
+                    and buffer.max() <= np.iinfo(np.int32).max:
+                buffer = buffer.astype(np.int32)
+            buffers[key] = buffer
+            offsets[key] = np.concatenate([[0], np.cumsum(np.concatenate(length_list[key]))]).astype(np.int64)
+            dtypes[key] = dtype
+        return cls(buffers, offsets, dtypes)
+
+    @classmethod
+    def from_list(cls, data: List[Dict[str, Any]]) -> Optional['ColumnarLLMDataset']:
+        return cls.from_packed([_pack_rows(data)])
+
+    def _get_row(self, idx: int) -> Dict[str, Any]:
+        res = {}
+        for key in self.keys:
+            offsets = self.offsets[key]
+            # Keep the interface of LLMDataset: the rows are python lists.
+            res[key] = self.buffers[key][offsets[idx]:offsets[idx + 1]].tolist()
+        return res
+
+    def __getitem__(self, idx: Union[int, str]) -> Dict[str, Any]:
+        if isinstance(idx, (int, np.integer)):
+            if idx < 0:
+                idx += len(self)
+            if not 0 <= idx < len(self):
+                raise IndexError(f'idx: {idx}, len(dataset): {len(self)}')
+            if self.indices is not None:
+                idx = self.indices[idx]
+            return self._get_row(idx)
+        elif isinstance(idx, str):
+            return [self[i][idx] for i in range(len(self))]
+        else:
+            raise ValueError(f'idx: {idx}')
+
+    def select(self, idx_list: List[int]) -> 'ColumnarLLMDataset':
+        """The buffers are shared, only the indices are stored."""
+        indices = np.asarray(idx_list, dtype=np.int64)
+        if self.indices is not None:
+            indices = self.indices[indices]
+        return self._new_with_indices(indices)
+
+    def _new_with_indices(self, indices: np.ndarray) -> 'ColumnarLLMDataset':
+        return self.__class__(self.buffers, self.offsets, self.dtypes, indices)
+
+    def get_lengths(self, key: str = 'input_ids') -> np.ndarray:
+        lengths = np.diff(self.offsets[key])
+        if self.indices is not None:
+            lengths = lengths[self.indices]
+        return lengths
+
+    def __len__(self) -> int:
+        if self.indices is not None:
+            return len(self.indices)
+        return len(self.offsets[self.keys[0]]) - 1
+
+
+def _first_fit_decreasing(lengths: np.ndarray, capacity: int) -> List[List[int]]:
+    """Pack the items into bins of `capacity` with first-fit-decreasing.
+
+    The items of the same length are placed together: first-fit puts them into the earliest bins in order,
+    each bin taking `remaining // length` of them, and the rest go into new bins. So the loop runs over
+    the distinct lengths (at most `capacity`) instead of the items, with numpy operations over the open bins.
+
+    return: The item indices of each bin. Items longer than `capacity` get their own bins.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    order = np.argsort(-lengths, kind='stable')
+    sorted_lengths = lengths[order]
+    bin_ids = np.empty(len(lengths), dtype=np.int64)  # the bin of each item in `order`
+    remaining = np.empty(len(lengths), dtype=np.int64)  # at most one bin per item
+    num_bins = 0
+    first_bin = 0  # the bins before it cannot take any item
+    min_length = max(int(sorted_lengths[-1]), 1) if len(lengths) > 0 else 1
+    max_remaining = 0  # an upper bound of the remaining capacity of the bins
+    _, starts, counts = np.unique(-sorted_lengths, return_index=True, return_counts=True)
+    for start, count, length in zip(starts.tolist(), counts.tolist(), sorted_lengths[starts].tolist()):
+        length = max(length, 1)
+        num_fit = 0
+        if length <= max_remaining:
+            while first_bin < num_bins and remaining[first_bin] < min_length:
+                first_bin += 1
+            bins_remaining = remaining[first_bin:num_bins]
+            if count == 1:
+                bin_id = int((bins_remaining >= length).argmax()) if len(bins_remaining) > 0 else 0
+                if len(bins_remaining) > 0 and bins_remaining[bin_id] >= length:
+                    bins_remaining[bin_id] -= length
+                    bin_ids[start] = first_bin + bin_id
+                    num_fit = 1
+            elif len(bins_remaining) > 0:
+                per_bin = bins_remaining // length
+                cum_per_bin = np.cumsum(per_bin)
+                num_fit = min(count, int(cum_per_bin[-1]))
+                if num_fit > 0:
+                    last = int(np.searchsorted(cum_per_bin, num_fit))
+                    takes = per_bin[:last + 1]
+                    takes[last] -= cum_per_bin[last] - num_fit
+                    bins_remaining[:last + 1] -= takes * length
+                    bin_ids[start:start + num_fit] = np.repeat(np.arange(first_bin, first_bin + last + 1), takes)
+            max_remaining = int(bins_remaining.max()) if num_fit > 0 else length - 1
+        num_rest = count - num_fit
+        if num_rest > 0:
+            per_new_bin = max(capacity // length, 1)
+            num_new_bins = -(-num_rest // per_new_bin)
+            bin_ids[start + num_fit:start + count] = num_bins + np.arange(num_rest) // per_new_bin
+            full_remaining = max(capacity - per_new_bin * length, 0)
+            last_remaining = max(capacity - (num_rest - (num_new_bins - 1) * per_new_bin) * length, 0)
+            remaining[num_bins:num_bins + num_new_bins] = full_remaining
+            remaining[num_bins + num_new_bins - 1] = last_remaining
+            max_remaining = max(max_remaining, full_remaining, last_remaining)
+            num_bins += num_new_bins
+    bins: List[List[int]] = [[] for _ in range(num_bins)]
+    for i, bin_id in zip(order.tolist(), bin_ids.tolist()):
+        bins[bin_id].append(i)
+    return bins
+
+
 # Code borrowed from trl
 class ConstantLengthDataset(IterableDataset):
+    """Pack the encoded samples into sequences of at most `seq_length` tokens.
+
+    The samples are consumed buffer by buffer (`num_of_sequences` samples) and packed with first-fit-decreasing.
+    The `position_ids` of each pack restart from 0 at every sample, which flash attention uses to restrict
+    the attention to each sample (see `Template.data_collator`).
+
+    dataset: The raw dataset (encoded with `template.batch_encode` buffer by buffer),
+        or the encoded dataset, e.g. `LLMDataset`.
+    chars_per_token, append_concat_token, add_special_tokens: Not used, kept for compatibility.
+    """
 
     def __init__(
         self,
@@ -157,13 +340,13 @@ class ConstantLengthDataset(IterableDataset):
         add_special_tokens=True,
     ):
         self.template = template
-
-        self.concat_token_id = self.template.tokenizer.eos_token_id
         self.dataset = dataset
         self.seq_length = seq_length
-        self.max_buffer_size = seq_length * chars_per_token * num_of_sequences
-        self.append_concat_token = append_concat_token
-        self.add_special_tokens = add_special_tokens
+        self.num_of_sequences = num_of_sequences
+        self.is_encoded = not isinstance(dataset, (HfDataset, HfIterableDataset))
+        self.num_samples = 0
+        self.num_tokens = 0
+        self.num_packs = 0
 
     @staticmethod
     def get_packed_dataset(template: 'Template',
@@ -173,75 +356,140 @@ class ConstantLengthDataset(IterableDataset):
                            chars_per_token=3.6,
                            append_concat_token=True,
                            add_special_tokens=True,
-                           lazy_tokenize=False):
+                           lazy_tokenize=False,
+                           columnar=False):
         constant_length_iterator = ConstantLengthDataset(template, dataset, seq_length, num_of_sequences,
                                                          chars_per_token, append_concat_token, add_special_tokens)
 
         if lazy_tokenize:
             return constant_length_iterator
 
+        start_time = time.perf_counter()
         dataset_list = []
-        for item in constant_length_iterator:
+        for item in tqdm(iter(constant_length_iterator), desc='Packing'):
             dataset_list.append(item)
-        return HfDataset.from_list(dataset_list)
+        logger.info(f'Packing finished, runtime: {time.perf_counter() - start_time:.2f}s, '
+                    f'{constant_length_iterator.get_packing_info()}')
+        packed_dataset = None
+        if columnar:
+            packed_dataset = ColumnarLLMDataset.from_list(dataset_list)
+        if packed_dataset is None:
+            packed_dataset = LLMDataset(dataset_list)
+        return packed_dataset
 
     def __len__(self):
         return len(self.dataset)
 
-    def calculate_matched_group(self, sequences: Dict[str, List[int]]):
+    @property
+    def packing_efficiency(self) -> float:
+        """The ratio of the real tokens in the packs."""
+        if self.num_packs == 0:
+            return 0.
+        return self.num_tokens / (self.num_packs * self.seq_length)
+
+    def get_packing_info(self) -> str:
+        return (f'num_samples: {self.num_samples}, num_packs: {self.num_packs}, num_tokens: {self.num_tokens}, '
+                f'packing_efficiency: {self.packing_efficiency:.4f}')
+
+    def calculate_matched_group(self, sequences: List[Dict[str, List[Any]]]) -> List[Dict[str, List[Any]]]:
         # https://arxiv.org/pdf/2404.10830
-        import binpacking
-        binpacked = binpacking.to_constant_volume(sequences, self.seq_length, weight_pos=1)
+        lengths = np.array([len(s['input_ids']) for s in sequences], dtype=np.int64)
         packed_sequence = []
-        for sequence in binpacked:
+        for bin_ids in _first_fit_decreasing(lengths, self.seq_length):
+            bin_ids.sort()  # keep the dataset order inside the pack
             packed = {}
-            position_id_lengths = [len(s[0]['input_ids']) for s in sequence]
-            for key in sequence[0][0].keys():
-                packed[key] = np.concatenate([s[0][key] for s in sequence])
+            for key in sequences[bin_ids[0]].keys():
+                value = []
+                for i in bin_ids:
+                    value += sequences[i][key]
+                    if key == 'labels' and len(value) > len(sequences[i][key]):
+                        # The first token of a sample must not be predicted by the previous sample.
+                        value[len(value) - len(sequences[i][key])] = -100
+                packed[key] = value
+            position_ids = []
+            for i in bin_ids:
+                position_ids += range(lengths[i])
+            packed['position_ids'] = position_ids
             packed_sequence.append(packed)
-            packed['position_ids'] = np.concatenate([list(range(pil)) for pil in position_id_lengths])
+        self.num_samples += len(sequences)
+        self.num_tokens += int(lengths.sum())
+        self.num_packs += len(packed_sequence)
         return packed_sequence
 
-    def __iter__(self):
+    def _iter_buffer(self) -> Iterator[List[Dict[str, Any]]]:
         iterator = iter(self.dataset)
-        more_examples = True
-        while more_examples:
-            buffer, buffer_len = [], 0
-            while True:
-                if buffer_len >= self.max_buffer_size:
-                    break
-                try:
-                    example = next(iterator)
-                    lens = sum([len(value) if value else 0 for value in example.values()])
-                    buffer.append(next(iterator))
-                    buffer_len += lens
-                except StopIteration:
-                    more_examples = False
-                    break
-
+        while True:
+            buffer = list(islice(iterator, self.num_of_sequences))
+            if len(buffer) == 0:
+                break
+            if not self.is_encoded:
+                buffer = [res[0] for res in self.template.batch_encode(buffer)]
             sequences = []
             for example in buffer:
-                input, _ = self.template.encode(example)
-                if not input:
+                if not example:
                     continue
-                sequences.append((input, len(input['input_ids'])))
+                example = {k: v.tolist() if isinstance(v, np.ndarray) else v for k, v in example.items()}
+                if any(not isinstance(v, list) for v in example.values()):
+                    raise ValueError('Packing only supports the examples whose fields are lists, '
+                                     f'keys: {list(example.keys())}')
+                sequences.append(example)
+            yield sequences
 
+    def __iter__(self):
+        for sequences in self._iter_buffer():
+            if len(sequences) == 0:
+                continue
             packed_sequences = self.calculate_matched_group(sequences)
             for sequence in packed_sequences:
                 yield sequence
 
 
+def _get_sample_nbytes(sample: Dict[str, Any]) -> int:
+    """An estimate of the memory usage of the encoded sample."""
+    nbytes = 0
+    for value in sample.values():
+        if isinstance(value, torch.Tensor):
+            nbytes += value.numel() * value.element_size()
+        elif isinstance(value, np.ndarray):
+            nbytes += value.nbytes
+        elif isinstance(value, (list, tuple)):
+            nbytes += 36 * len(value)  # pointer + int object
+        else:
+            nbytes += 64
+    return nbytes
+
+
 class LazyLLMDataset(Dataset):
+    """Encode the samples on the fly.
 
-    def __init__(self,
-                 dataset: HfDataset,
-                 encode_func: Callable[[Dict[str, Any]], Union[Tuple[Dict[str, Any], Dict[str, Any]], Dict[str, Any]]],
-                 *,
-                 try_fetch_time: int = 20) -> None:
+    cache_max_mb: The memory budget of the LRU cache of the encoded samples. The cache lives in each dataloader
+        worker, so it lasts across epochs only with `persistent_workers` (or `num_workers=0`).
+    cache_dir: Store the encoded samples as files in the directory, which is shared by all the processes and runs.
+        The directory must be specific to the dataset and the template.
+    """
+
+    def __init__(
+        self,
+        dataset: HfDataset,
+        encode_func: Callable[[Dict[str, Any]], Union[Tuple[Dict[str, Any], Dict[str, Any]], Dict[str, Any]]],
+        *,
+        try_fetch_time: int = 20,
+        batch_encode_func: Optional[Callable[[List[Dict[str, Any]]], List[Tuple[Dict[str, Any], Dict[str,
+                                                                                                     Any]]]]] = None,
+        cache_max_mb: Optional[float] = None,
+        cache_dir: Optional[str] = None,
+    ) -> None:
         self.dataset = dataset
         self.encode_func = encode_func
+        self.batch_encode_func = batch_encode_func
         self.try_fetch_time = min(try_fetch_time, len(self.dataset))
         assert self.try_fetch_time >= 1
+        self.cache_max_bytes = None if cache_max_mb is None else int(cache_max_mb * 1024**2)
+        self.cache_dir = cache_dir
+        self._cache: Dict[int, Dict[str, Any]] = OrderedDict()
+        self._cache_bytes = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
 
     def __getitem__(self, idx: int) -> Dict[str, Any]:
         res = self._try_fetch(idx)
@@ -249,18 +497,87 @@ class LazyLLMDataset(Dataset):
             return res
         raise ValueError('Please check if the max_length is appropriate.')
 
-    def _try_fetch(self, first_idx: int) -> Optional[Dict[str, Any]]:
-        idx = np.random.permutation(len(self))[:self.try_fetch_time - 1]
-        for i in [first_idx] + idx.tolist():
-            data = self.dataset[i]
+    def __getitems__(self, indices: List[int]) -> List[Dict[str, Any]]:
+        # Called by the DataLoader with the indices of a batch.
+        res = [self._get_cache(idx) for idx in indices]
+        miss_indices = [idx for idx, r in zip(indices, res) if r is None]
+        if self.batch_encode_func is None or len(miss_indices) == 0:
+            return [self[idx] if r is None or len(r) == 0 else r for idx, r in zip(indices, res)]
+        try:
+            encoded = [r[0] for r in self.batch_encode_func([self.dataset[idx] for idx in miss_indices])]
+        except Exception as e:
+            logger.error(f'Error occurs in lazy tokenize: {e}')
+            return [self[idx] for idx in indices]
+        encoded = dict(zip(miss_indices, encoded))
+        for idx, r in encoded.items():
+            self._set_cache(idx, r)
+        # the failed rows are retried by `__getitem__`
+        res = [encoded[idx] if r is None else r for idx, r in zip(indices, res)]
+        return [r if len(r) > 0 else self[idx] for idx, r in zip(indices, res)]
+
+    def _get_cache_path(self, idx: int) -> str:
+        return os.path.join(self.cache_dir, str(idx // 10000), f'{idx}.pkl')
+
+    def _get_cache(self, idx: int) -> Optional[Dict[str, Any]]:
+        if self.cache_max_bytes is not None and idx in self._cache:
+            self._cache.move_to_end(idx)
+            return self._cache[idx].copy()
+        if self.cache_dir is None:
+            return None
+        cache_path = self._get_cache_path(idx)
+        if not os.path.exists(cache_path):
+            return None
+        try:
+            with open(cache_path, 'rb') as f:
+                res = pickle.load(f)
+        except Exception as e:  # e.g. written by an incompatible version
+            logger.warning(f'Failed to load the lazy tokenize cache {cache_path}: {e}')
+            return None
+        self._set_cache(idx, res, write_file=False)
+        return res
+
+    def _set_cache(self, idx: int, res: Dict[str, Any], write_file: bool = True) -> None:
+        # The empty results (deleted by max_length) are also cached, so that they are not encoded again.
+        if self.cache_max_bytes is not None:
+            nbytes = _get_sample_nbytes(res)
+            if nbytes <= self.cache_max_bytes:
+                self._cache[idx] = res.copy()
+                self._cache_bytes += nbytes
+                while self._cache_bytes > self.cache_max_bytes:
+                    _, old_res = self._cache.popitem(last=False)
+                    self._cache_bytes -= _get_sample_nbytes(old_res)
+        if self.cache_dir is not None and write_file:
+            cache_path = self._get_cache_path(idx)
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
             try:
-                res = self.encode_func(data)
-                if isinstance(res, (tuple, list)) and len(res) == 2:
-                    res = res[0]
-            except Exception as e:
-                logger.error(f'Error occurs in lazy tokenize: {e}')
-                continue
-            if len(res) > 0:
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump(res, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, cache_path)
+            except OSError as e:
+                logger.warning(f'Failed to write the lazy tokenize cache {cache_path}: {e}')
+
+    def _encode(self, idx: int) -> Optional[Dict[str, Any]]:
+        res = self._get_cache(idx)
+        if res is not None:
+            return res
+        try:
+            res = self.encode_func(self.dataset[idx])
+            if isinstance(res, (tuple, list)) and len(res) == 2:
+                res = res[0]
+        except Exception as e:
+            logger.error(f'Error occurs in lazy tokenize: {e}')
+            return None
+        self._set_cache(idx, res)
+        return res
+
+    def _try_fetch(self, first_idx: int) -> Optional[Dict[str, Any]]:
+        idx = first_idx
+        for i in range(self.try_fetch_time):
+            if i > 0:
+                idx = np.random.randint(len(self))  # O(1) instead of a permutation of the whole dataset
+            res = self._encode(idx)
+            if res is not None and len(res) > 0:
                 return res
 
     def __len__(self) -> int:
@@ -268,6 +585,7 @@ class LazyLLMDataset(Dataset):
 
 
 MapFunc = Callable[[Dict[str, Any]], Tuple[Dict[str, Any], Dict[str, Any]]]
+BatchMapFunc = Callable[[List[Dict[str, Any]]], List[Tuple[Dict[str, Any], Dict[str, Any]]]]
 
 
 def _single_map(d: Dict[str, Any], map_func: MapFunc) -> Optional[Dict[str, Any]]:
@@ -277,57 +595,152 @@ def _single_map(d: Dict[str, Any], map_func: MapFunc) -> Optional[Dict[str, Any]
     return d
 
 
-def _map_mp_single(subset: HfDataset, map_func: MapFunc, queue: Queue, start_idx: int):
-    for i, d in enumerate(subset, start=start_idx):
-        queue.put((i, map_func(d)))  # idx, result
+def _batch_map(rows: List[Dict[str, Any]],
+               map_func: MapFunc,
+               batch_map_func: Optional[BatchMapFunc] = None) -> List[Optional[Dict[str, Any]]]:
+    if batch_map_func is None:
+        return [_single_map(d, map_func) for d in rows]
+    return [None if len(res[0]) == 0 else res[0] for res in batch_map_func(rows)]
 
 
-def _map_mp_i(dataset: HfDataset, map_func: MapFunc, num_proc: int) -> Iterator[Tuple[int, Dict[str, Any]]]:
-    with multiprocess.Pool(num_proc) as pool, multiprocess.Manager() as manager:
-        queue = manager.Queue()
-        async_results = []
-        split_idx = np.linspace(0, len(dataset), num_proc + 1, dtype=np.int32)
-        for i in range(num_proc):
-            subset = dataset.select(range(split_idx[i], split_idx[i + 1]))
-            async_results.append(pool.apply_async(_map_mp_single, args=(subset, map_func, queue, split_idx[i])))
-        while True:
-            try:
-                yield queue.get(timeout=0.05)
-            except Empty:
-                if all(async_result.ready() for async_result in async_results) and queue.empty():
-                    break
+def _pack_rows(rows: List[Optional[Dict[str, Any]]]) -> Dict[str, Any]:
+    """Pack the encoded rows into flat numpy buffers + lengths, which are much cheaper to pickle
+    than python lists of dicts. Rows that cannot be packed (e.g. multimodal tensors) are kept as they are."""
+    keys = None
+    for row in rows:
+        if row is not None:
+            keys = list(row.keys())
+            break
+    res = {'rows': rows}
+    if keys is None:
+        return res
+    rows_not_none = [row for row in rows if row is not None]
+    if any(row.keys() != rows_not_none[0].keys() for row in rows_not_none):
+        return res
+    buffers, lengths = {}, {}
+    for key in keys:
+        values = [row[key] for row in rows_not_none]
+        if any(not isinstance(value, list) for value in values):
+            return res
+        try:
+            buffer = np.array([v for value in values for v in value])
+        except ValueError:  # inhomogeneous shape
+            return res
+        if buffer.dtype.kind not in 'iubf':
+            return res
+        buffers[key] = buffer
+        lengths[key] = np.array([len(value) for value in values], dtype=np.int64)
+    is_none = np.array([row is None for row in rows], dtype=bool)
+    return {'keys': keys, 'is_none': is_none, 'buffers': buffers, 'lengths': lengths}
+
+
+def _unpack_rows(packed: Dict[str, Any]) -> List[Optional[Dict[str, Any]]]:
+    if 'rows' in packed:
+        return packed['rows']
+    keys = packed['keys']
+    offsets = {key: np.concatenate([[0], np.cumsum(packed['lengths'][key])]) for key in keys}
+    rows = []
+    i = 0
+    for is_none in packed['is_none'].tolist():
+        if is_none:
+            rows.append(None)
+            continue
+        row = {}
+        for key in keys:
+            offset = offsets[key]
+            row[key] = packed['buffers'][key][offset[i]:offset[i + 1]].tolist()
+        rows.append(row)
+        i += 1
+    return rows
+
+
+# The dataset and map_func of the pool worker, set once by `_map_mp_init` instead of being pickled with each chunk.
+_map_mp_state: Dict[str, Any] = {}
+
 
+def _map_mp_init(dataset: HfDataset, map_func: Callable[[List[Dict[str, Any]]], List[Any]]) -> None:
+    _map_mp_state['dataset'] = dataset
+    _map_mp_state['map_func'] = map_func
 
-def _map_mp(dataset: HfDataset, map_func: MapFunc, num_proc: int) -> List[Dict[str, Any]]:
-    # Solving the unordered problem
-    data = [None] * len(dataset)
+
+def _map_mp_single(chunk_range: Tuple[int, int]) -> Dict[str, Any]:
+    start, end = chunk_range
+    dataset, map_func = _map_mp_state['dataset'], _map_mp_state['map_func']
+    return _pack_rows(map_func(list(dataset.select(range(start, end)))))
+
+
+def _map_mp_i(dataset: HfDataset, map_func: Callable[[List[Dict[str, Any]]], List[Any]],
+              num_proc: int) -> Iterator[Dict[str, Any]]:
+    # Contiguous chunks: results are returned in order, without going through a Manager queue row by row.
+    # Only the index ranges are sent to the workers, the dataset and map_func are passed once per worker.
+    chunk_size = min(max(len(dataset) // (num_proc * 4), 1), 1000)
+    split_idx = list(range(0, len(dataset), chunk_size)) + [len(dataset)]
+    chunk_ranges = [(split_idx[i], split_idx[i + 1]) for i in range(len(split_idx) - 1)]
+    with multiprocess.Pool(num_proc, initializer=_map_mp_init, initargs=(dataset, map_func)) as pool:
+        for packed in pool.imap(_map_mp_single, chunk_ranges):
+            yield packed
+
+
+def _map_mp(dataset: HfDataset, map_func: Callable[[List[Dict[str, Any]]], List[Any]],
+            num_proc: int) -> List[Dict[str, Any]]:
+    """map_func: Map a chunk of rows.
+    return: The packed chunks in order, see `_pack_rows`."""
+    packed_list = []
     num_proc = min(num_proc, len(dataset))
-    for d in tqdm(_map_mp_i(dataset, map_func, num_proc), total=len(dataset), desc=f'Map (num_proc={num_proc})'):
-        data[d[0]] = d[1]
-    return data
+    prog_bar = tqdm(total=len(dataset), desc=f'Map (num_proc={num_proc})')
+    for packed in _map_mp_i(dataset, map_func, num_proc):
+        packed_list.append(packed)
+        prog_bar.update(len(packed['rows']) if 'rows' in packed else len(packed['is_none']))
+    prog_bar.close()
+    return packed_list
 
 
 def dataset_map(dataset: DATASET_TYPE,
                 map_func: MapFunc,
                 num_proc: int = 1,
-                streaming: bool = False) -> Optional[Union[LLMDataset, DATASET_TYPE]]:
+                streaming: bool = False,
+                columnar: bool = False,
+                batch_map_func: Optional[BatchMapFunc] = None,
+                batch_size: int = 1000) -> Optional[Union[LLMDataset, ColumnarLLMDataset, DATASET_TYPE]]:
+    """
+    columnar: Return a `ColumnarLLMDataset` if all the fields are 1-d numeric lists, else fall back to `LLMDataset`.
+    batch_map_func: e.g. `template.batch_encode`, map `batch_size` rows at a time. Its results must be the same as
+        `[map_func(d) for d in rows]`.
+    """
     if streaming:
         return LLMIterableDataset(dataset.map(map_func))  # num_proc is not supported for IterableDataset
 
-    single_map = partial(_single_map, map_func=map_func)
+    chunk_map = partial(_batch_map, map_func=map_func, batch_map_func=batch_map_func)
+    start_time = time.perf_counter()
     if num_proc == 1:
         data = []
-        for d in tqdm(dataset, desc='Map'):
-            d = single_map(d)
-            data.append(d)
+        prog_bar = tqdm(total=len(dataset), desc='Map')
+        dataset_iter = iter(dataset)
+        while True:
+            rows = list(islice(dataset_iter, batch_size if batch_map_func is not None else 1))
+            if len(rows) == 0:
+                break
+            data += chunk_map(rows)
+            prog_bar.update(len(rows))
+        prog_bar.close()
+        packed_list = [_pack_rows(data) if columnar else {'rows': data}]
     else:
         assert num_proc > 1
-        data = _map_mp(dataset, single_map, num_proc)
-    data = [d for d in data if d is not None]
-    if len(data) == 0:
+        packed_list = _map_mp(dataset, chunk_map, num_proc)
+    llm_dataset = None
+    if columnar:
+        llm_dataset = ColumnarLLMDataset.from_packed(packed_list)
+    if llm_dataset is None:
+        data = [d for packed in packed_list for d in _unpack_rows(packed) if d is not None]
+        llm_dataset = LLMDataset(data)
+    if len(llm_dataset) == 0:
         logger.warning('len(dataset): 0')
         return None
-    return LLMDataset(data)
+    runtime = time.perf_counter() - start_time
+    num_tokens = sum(_get_token_len(llm_dataset))
+    logger.info(f'Map finished, num_proc: {num_proc}, runtime: {runtime:.2f}s, num_samples: {len(llm_dataset)}, '
+                f'num_tokens: {num_tokens}, tokens/s: {num_tokens / runtime:.1f}')
+    return llm_dataset
 
 
 def _get_token_len(llm_dataset):
@@ -336,6 +749,9 @@ def _get_token_len(llm_dataset):
         input_ids = llm_dataset['input_ids']
         for ii in input_ids:
             token_len.append(len(ii))
+    elif hasattr(llm_dataset, 'get_lengths'):  # ColumnarLLMDataset/MMapLLMDataset, no need to read the tokens
+        keys = [k for k in llm_dataset.keys if k == 'input_ids' or k.endswith('_input_ids')]
+        token_len = sum(llm_dataset.get_lengths(k) for k in keys).tolist()
     else:
         for d in llm_dataset:  # LLMDataset
             _len = 0
@@ -604,6 +1020,121 @@ class TokenListIteratorStreamer(BaseStreamer):
             return value
 
 
+_speculative_local = local()
+_speculative_lock = Lock()
+_speculative_count = 0  # the running calls of `_speculative_generate`
+
+
+class _CandidateGeneratorWithStats:
+    """Counts the draft tokens and the accepted tokens of the candidate generator of assisted generation."""
+
+    def __init__(self, candidate_generator, generation_info: Dict[str, Any]) -> None:
+        self.candidate_generator = candidate_generator
+        self.generation_info = generation_info
+
+    def get_candidates(self, input_ids: torch.Tensor):
+        candidate_ids, candidate_logits = self.candidate_generator.get_candidates(input_ids)
+        self.generation_info['num_draft_tokens'] += candidate_ids.shape[1] - input_ids.shape[1]
+        return candidate_ids, candidate_logits
+
+    def update_candidate_strategy(self, input_ids: torch.Tensor, scores: torch.Tensor, num_matches: int) -> None:
+        self.generation_info['num_accepted_tokens'] += int(num_matches)
+        _speculative_local.num_matches_list.append(int(num_matches))
+        return self.candidate_generator.update_candidate_strategy(input_ids, scores, num_matches)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.candidate_generator, name)
+
+
+@contextmanager
+def _patch_candidate_generator(generation_info: Dict[str, Any]):
+    """Count the draft/accepted tokens of the assisted generation of the current thread.
+
+    `GenerationMixin._get_candidate_generator` is patched only while a call is running, and only wraps the
+    candidate generators of the calls in this context (the other threads and models are unaffected).
+    """
+    global _speculative_count
+    from transformers.generation.utils import GenerationMixin
+    with _speculative_lock:
+        if _speculative_count == 0:
+            get_candidate_generator_origin = GenerationMixin._get_candidate_generator
+
+            @wraps(get_candidate_generator_origin)
+            def _get_candidate_generator(self, *args, **kwargs):
+                candidate_generator = get_candidate_generator_origin(self, *args, **kwargs)
+                generation_info = getattr(_speculative_local, 'generation_info', None)
+                if generation_info is not None:
+                    candidate_generator = _CandidateGeneratorWithStats(candidate_generator, generation_info)
+                return candidate_generator
+
+            _get_candidate_generator.origin = get_candidate_generator_origin
+            GenerationMixin._get_candidate_generator = _get_candidate_generator
+        _speculative_count += 1
+    _speculative_local.generation_info = generation_info
+    _speculative_local.num_matches_list = []
+    try:
+        yield
+    finally:
+        _speculative_local.generation_info = None
+        with _speculative_lock:
+            _speculative_count -= 1
+            if _speculative_count == 0:
+                GenerationMixin._get_candidate_generator = GenerationMixin._get_candidate_generator.origin
+
+
+def _speculative_generate(model: PreTrainedModel, generation_info: Dict[str, Any], *args, **generation_kwargs):
+    """`model.generate` with assisted generation (a draft model or prompt lookup), i.e. speculative decoding.
+
+    The tokens proposed by the drafter are verified by one forward of the model. With `do_sample`, the
+    speculative sampling (or the comparison with the tokens sampled from the model) keeps the distribution of the
+    model unchanged. The number of the draft tokens and the accepted tokens are recorded in `generation_info`.
+    """
+    generation_info['num_draft_tokens'] = 0
+    generation_info['num_accepted_tokens'] = 0
+    try:
+        with _patch_candidate_generator(generation_info):
+            res = model.generate(*args, **generation_kwargs)
+            num_matches_list = _speculative_local.num_matches_list
+        logits_list = res.get('logits') if isinstance(res, ModelOutput) else None
+        if logits_list is not None and len(logits_list) == len(num_matches_list) and all(
+                logits.dim() == 3 and logits.shape[1] > num_matches
+                for logits, num_matches in zip(logits_list, num_matches_list)):
+            # The raw logits of each step contain all the candidate positions (e.g. transformers 4.45), keep the
+            # accepted ones. Otherwise (one position per token), the logits are kept as they are.
+            res['logits'] = tuple(logits[:, i] for logits, num_matches in zip(logits_list, num_matches_list)
+                                  for i in range(num_matches + 1))
+        return res
+    finally:
+        num_draft_tokens = generation_info['num_draft_tokens']
+        generation_info['acceptance_rate'] = (
+            generation_info['num_accepted_tokens'] / num_draft_tokens if num_draft_tokens > 0 else 0.)
+
+
+def _is_speculative(generation_config: GenerationConfig, assistant_model: Optional[PreTrainedModel]) -> bool:
+    return assistant_model is not None or generation_config.prompt_lookup_num_tokens is not None
+
+
+class _SpeculativeTruncator:
+    """The tokens accepted together by speculative decoding can go beyond the stop words (or `max_new_tokens`),
+    truncate the generated ids after the first stop word. The ids are fed incrementally."""
+
+    def __init__(self, stopping_criteria: StoppingCriteriaList, tokenizer_kwargs: Dict[str, Any],
+                 max_new_tokens: Optional[int]) -> None:
+        self.automaton = stopping_criteria[0].automaton
+        self.state = self.automaton.new_state(**tokenizer_kwargs)
+        self.num_checked = 0
+        self.stop_len: Optional[int] = max_new_tokens
+
+    def __call__(self, generate_ids: List[int]) -> List[int]:
+        end = len(generate_ids) if self.stop_len is None else min(len(generate_ids), self.stop_len)
+        for i in range(self.num_checked, end):
+            if self.automaton.step(self.state, [generate_ids[i]]):
+                self.stop_len = i + 1
+                break
+        self.num_checked = max(self.num_checked, end)
+        return generate_ids if self.stop_len is None else generate_ids[:self.stop_len]
+
+
 def _prepare_inputs(model: PreTrainedModel,
                     template: Template,
                     query: str,
@@ -615,6 +1146,7 @@ def _prepare_inputs(model: PreTrainedModel,
                     generation_info: Dict[str, Any],
                     stop_words: Optional[StopWords] = None,
                     adapter_names: Optional[List[str]] = None,
+                    stopping_criteria: Optional[List[StoppingCriteria]] = None,
                     **kwargs) -> Tuple[Dict[str, Any], Dict[str, Any], int, Dict[str, Any]]:
     if stop_words is None:
         stop_words = []
@@ -678,8 +1210,10 @@ def _prepare_inputs(model: PreTrainedModel,
     if adapter_names is not None:
         inputs['adapter_names'] = adapter_names
 
-    stopping_criteria = StoppingCriteriaList([StopWordsCriteria(tokenizer, stop_words, **tokenizer_kwargs)])
-    inputs['stopping_criteria'] = stopping_criteria
+    # The stop words criteria goes first, see `_SpeculativeTruncator`.
+    stop_words_criteria = StopWordsCriteria(
+        tokenizer, stop_words, incremental=generation_config.num_beams == 1, **tokenizer_kwargs)
+    inputs['stopping_criteria'] = StoppingCriteriaList([stop_words_criteria] + list(stopping_criteria or []))
     generation_info['num_prompt_tokens'] = token_len
     return inputs, tokenizer_kwargs, token_len, example
 
@@ -696,9 +1230,14 @@ def inference_stream(model: PreTrainedModel,
                      stop_words: Optional[StopWords] = None,
                      generation_info: Optional[Dict[str, Any]] = None,
                      adapter_names: Optional[List[str]] = None,
+                     assistant_model: Optional[PreTrainedModel] = None,
+                     stopping_criteria: Optional[List[StoppingCriteria]] = None,
                      **kwargs) -> Iterator[Union[Tuple[str, History], Dict[str, Any]]]:
     """
     generation_config: Priority: generation_config > model.generation_config.
+    assistant_model: The draft model of speculative decoding. `generation_config.prompt_lookup_num_tokens`
+        enables the draft-free prompt lookup decoding.
+    stopping_criteria: The extra stopping criteria besides the stop words, e.g. cancelling the generation.
     """
     start_runtime = time.perf_counter()
     if history is None:
@@ -723,6 +1262,7 @@ def inference_stream(model: PreTrainedModel,
         generation_info=generation_info,
         stop_words=stop_words,
         adapter_names=adapter_names,
+        stopping_criteria=stopping_criteria,
         **kwargs)
     if len(inputs) == 0:
         return '', history
@@ -741,12 +1281,21 @@ def inference_stream(model: PreTrainedModel,
     streamer = TokenListIteratorStreamer()
     return_dict = generation_config.return_dict_in_generate
     generation_kwargs = {'streamer': streamer, 'generation_config': generation_config, **inputs}
+    is_speculative = _is_speculative(generation_config, assistant_model)
+    truncator = None
+    if is_speculative:
+        generation_kwargs['assistant_model'] = assistant_model
+        truncator = _SpeculativeTruncator(inputs['stopping_criteria'], tokenizer_kwargs,
+                                          generation_config.max_new_tokens)
     result_queue = Queue()
 
     def _model_generate(*args, **kwargs):
         if is_torch_npu_available():
             torch.npu.set_device(model.device)
-        res = model.generate(*args, **kwargs)
+        if is_speculative:
+            res = _speculative_generate(model, generation_info, *args, **kwargs)
+        else:
+            res = model.generate(*args, **kwargs)
         result_queue.put(res)
         return res
 
@@ -757,8 +1306,8 @@ def inference_stream(model: PreTrainedModel,
     if not is_observation:
         history.append(None)  # dummy
 
-    print_idx = [0]
-    first_num_space = [-1]
+    detokenizer = IncrementalDetokenizer(template, tokenizer_kwargs)
+    response = ''
 
     is_finished = False
     while not is_finished:
@@ -768,18 +1317,16 @@ def inference_stream(model: PreTrainedModel,
         except StopIteration:
             is_finished = True
         res = {}
-        generate_ids = template.get_generate_ids(torch.tensor(raw_generate_ids)[None], token_len)
+        generate_ids = template.get_generate_ids(raw_generate_ids, token_len)
+        if truncator is not None:
+            generate_ids = truncator(generate_ids)
+        if is_finished and (return_dict or is_speculative):
+            thread.join()  # is_speculative: the statistics in generation_info
         if return_dict and is_finished:
-            thread.join()
             res = dict(result_queue.get())
             res['sequences'] = generate_ids
         generation_info['num_generated_tokens'] = len(generate_ids)
-        response = template.generate_ids_to_response(
-            generate_ids,
-            is_finished,
-            tokenizer_kwargs=tokenizer_kwargs,
-            print_idx=print_idx,
-            first_num_space=first_num_space)
+        response += detokenizer.step(generate_ids, is_finished)
         if not is_observation:
             history[-1] = [query, response]
         else:
@@ -810,11 +1357,16 @@ def inference(model: PreTrainedModel,
               stream: bool = False,
               verbose: bool = False,
               adapter_names: Optional[List[str]] = None,
+              assistant_model: Optional[PreTrainedModel] = None,
+              stopping_criteria: Optional[List[StoppingCriteria]] = None,
               prompt_prefix: str = '[PROMPT]',
               output_prefix: str = '[OUTPUT]',
               **kwargs) -> Union[Tuple[str, History], Dict[str, Any]]:
     """
     generation_config: Priority: generation_config > model.generation_config.
+    assistant_model: The draft model of speculative decoding. `generation_config.prompt_lookup_num_tokens`
+        enables the draft-free prompt lookup decoding.
+    stopping_criteria: The extra stopping criteria besides the stop words, e.g. cancelling the generation.
     """
     runtime = time.perf_counter()
     if history is None:
@@ -839,6 +1391,7 @@ def inference(model: PreTrainedModel,
         generation_info=generation_info,
         stop_words=stop_words,
         adapter_names=adapter_names,
+        stopping_criteria=stopping_criteria,
         **kwargs)
     if len(inputs) == 0:
         return '', history
@@ -866,11 +1419,24 @@ def inference(model: PreTrainedModel,
             print(f'[QUERY]{query}\n{output_prefix}', end='')
 
     return_dict = generation_config.return_dict_in_generate
-    generate_ids = model.generate(streamer=streamer, generation_config=generation_config, **inputs)
+    if _is_speculative(generation_config, assistant_model):
+        generate_ids = _speculative_generate(
+            model,
+            generation_info,
+            streamer=streamer,
+            generation_config=generation_config,
+            assistant_model=assistant_model,
+            **inputs)
+    else:
+        generate_ids = model.generate(streamer=streamer, generation_config=generation_config, **inputs)
     if return_dict:
         res = dict(generate_ids)
         generate_ids = generate_ids['sequences']
     generate_ids = template.get_generate_ids(generate_ids, token_len)
+    if _is_speculative(generation_config, assistant_model):
+        generate_ids = _SpeculativeTruncator(inputs['stopping_criteria'], tokenizer_kwargs,
+                                             generation_config.max_new_tokens)(
+                                                 generate_ids)
     generation_info['num_generated_tokens'] = len(generate_ids)
     if verbose and stream is False:
         response = tokenizer.decode(generate_ids, **tokenizer_kwargs)
@@ -893,6 +1459,174 @@ def inference(model: PreTrainedModel,
         return response, history
 
 
+def _get_finish_len(generate_ids: List[int], eos_token_id: Set[int], stop_words_state: Any,
+                    stop_words_automaton: Any) -> int:
+    """The length of the sequence when it was finished in the batch, the rest is padding."""
+    for i, token_id in enumerate(generate_ids):
+        if token_id in eos_token_id or stop_words_automaton.step(stop_words_state, [token_id]):
+            return i + 1
+    return len(generate_ids)
+
+
+def _get_pt_batches(token_len_list: List[int], max_new_tokens_list: List[int], max_batch_size: int,
+                    max_tokens_per_batch: Optional[int]) -> List[List[int]]:
+    """Sort the requests by the prompt length (descending), and split them into batches of the same max_new_tokens."""
+    batches = []
+    for i in sorted(range(len(token_len_list)), key=lambda i: token_len_list[i], reverse=True):
+        if batches:
+            batch = batches[-1]
+            num_tokens = token_len_list[batch[0]] * (len(batch) + 1)  # padded
+            if (len(batch) < max_batch_size and max_new_tokens_list[batch[0]] == max_new_tokens_list[i]
+                    and (max_tokens_per_batch is None or num_tokens <= max_tokens_per_batch)):
+                batch.append(i)
+                continue
+        batches.append([i])
+    return batches
+
+
+@torch.inference_mode()
+def inference_pt(model: PreTrainedModel,
+                 template: Template,
+                 request_list: List[Dict[str, Any]],
+                 *,
+                 generation_config: Optional[GenerationConfig] = None,
+                 generation_info: Optional[Dict[str, Any]] = None,
+                 stop_words: Optional[StopWords] = None,
+                 max_batch_size: int = 16,
+                 max_tokens_per_batch: Optional[int] = None,
+                 adapter_names: Optional[List[str]] = None,
+                 use_tqdm: bool = False,
+                 **kwargs) -> List[Dict[str, Any]]:
+    """Batched inference of the pt backend.
+
+    The text requests are sorted by the prompt length and generated in batches (left padding) of at most
+    `max_batch_size` requests and `max_tokens_per_batch` padded prompt tokens. The other requests
+    (e.g. multimodal) use `inference` one by one. The response of each request is the same as `inference`.
+
+    request_list: e.g. [{'query': 'hello!'}].
+        The keys that can be included are: 'query', 'history', 'system', 'images', 'tools', 'objects'
+            and 'truncation_strategy'.
+    generation_config: Priority: generation_config > model.generation_config.
+    return: e.g. [{'response': 'hi!', 'history': [('hello!', 'hi!')]}], in the order of `request_list`.
+    """
+    runtime = time.perf_counter()
+    if generation_config is None:
+        generation_config = getattr(model, 'generation_config')
+    if generation_info is None:
+        generation_info = {}
+    else:
+        generation_info.clear()
+    generation_info.update({'num_prompt_tokens': 0, 'num_generated_tokens': 0, 'num_samples': len(request_list)})
+    tokenizer = template.tokenizer
+    resp_list: List[Optional[Dict[str, Any]]] = [None] * len(request_list)
+    prog_bar = tqdm(total=len(request_list), dynamic_ncols=True, disable=not use_tqdm)
+
+    def _inference(i: int) -> None:
+        info = {}
+        request = deepcopy(request_list[i])
+        response, history = inference(
+            model,
+            template,
+            generation_config=generation_config,
+            generation_info=info,
+            stop_words=deepcopy(stop_words),
+            adapter_names=adapter_names,
+            **request,
+            **kwargs)
+        generation_info['num_prompt_tokens'] += info.get('num_prompt_tokens', 0)
+        generation_info['num_generated_tokens'] += info.get('num_generated_tokens', 0)
+        resp_list[i] = {'response': response, 'history': history}
+        prog_bar.update()
+
+    # Encode
+    row_list = []
+    for i, request in enumerate(request_list):
+        if any(request.get(media_key) for media_key in ['images', 'audios', 'videos']):
+            _inference(i)
+            continue
+        request = deepcopy(request)
+        history = request.pop('history', None) or []
+        query = request.pop('query')
+        row_generation_config = deepcopy(generation_config)
+        row_stop_words = deepcopy(stop_words) or []
+        inputs, tokenizer_kwargs, token_len, example = _prepare_inputs(
+            model,
+            template,
+            query,
+            history,
+            request.pop('system', None),
+            generation_config=row_generation_config,
+            generation_info={},
+            stop_words=row_stop_words,
+            **request,
+            **kwargs)
+        if len(inputs) == 0:
+            resp_list[i] = {'response': '', 'history': history}
+            prog_bar.update()
+            continue
+        inputs.pop('stopping_criteria')
+        if set(inputs.keys()) != {'input_ids', 'attention_mask'} or model.config.is_encoder_decoder:
+            _inference(i)
+            continue
+        row_list.append((i, query, history, inputs['input_ids'][0], tokenizer_kwargs, example, row_generation_config,
+                         row_stop_words))
+
+    # Generate
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    batches = _get_pt_batches([len(row[3]) for row in row_list], [row[6].max_new_tokens for row in row_list],
+                              max_batch_size, max_tokens_per_batch)
+    for batch in batches:
+        rows = [row_list[idx] for idx in batch]
+        row_generation_config, row_stop_words = rows[0][6], rows[0][7]
+        tokenizer_kwargs = rows[0][4]
+        input_ids = template.pad_sequence([row[3] for row in rows], pad_token_id, 'left')
+        attention_mask = template.pad_sequence([torch.ones_like(row[3]) for row in rows], 0, 'left')
+        generate_kwargs = {}
+        if adapter_names is not None:
+            generate_kwargs['adapter_names'] = adapter_names * len(rows)
+        stopping_criteria = StoppingCriteriaList([
+            StopWordsCriteria(
+                tokenizer, row_stop_words, incremental=row_generation_config.num_beams == 1, **tokenizer_kwargs)
+        ])
+        generate_ids = model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            generation_config=row_generation_config,
+            stopping_criteria=stopping_criteria,
+            **generate_kwargs)
+        if row_generation_config.return_dict_in_generate:
+            generate_ids = generate_ids['sequences']
+        generate_ids = generate_ids[:, input_ids.shape[1]:].tolist()
+        eos_token_id = row_generation_config.eos_token_id
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        eos_token_id = set(eos_token_id or [])
+        stop_words_automaton = stopping_criteria[0].automaton
+        for (i, query, history, row_input_ids, tokenizer_kwargs, example, _,
+             _), row_generate_ids in zip(rows, generate_ids):
+            finish_len = _get_finish_len(row_generate_ids, eos_token_id,
+                                         stop_words_automaton.new_state(**tokenizer_kwargs), stop_words_automaton)
+            row_generate_ids = row_generate_ids[:finish_len]
+            response = template.generate_ids_to_response(row_generate_ids, tokenizer_kwargs=tokenizer_kwargs)
+            response = template.post_process_generate_response(response=response, example=example)
+            # agent support
+            is_observation = history[-1][-1].endswith('Observation:') if history and history[-1][-1] else False
+            if not is_observation:
+                history.append([query, response])
+            else:
+                history[-1][-1] = history[-1][-1] + query + response
+            resp_list[i] = {'response': response, 'history': history}
+            generation_info['num_prompt_tokens'] += len(row_input_ids)
+            generation_info['num_generated_tokens'] += len(row_generate_ids)
+            prog_bar.update()
+    prog_bar.close()
+    runtime = time.perf_counter() - runtime
+    generation_info['runtime'] = runtime
+    generation_info['samples/s'] = generation_info['num_samples'] / runtime
+    generation_info['tokens/s'] = generation_info['num_generated_tokens'] / runtime
+    return resp_list
+
+
 def limit_history_length(template: Template, query: str, history: Optional[History],
                          max_length: Optional[int]) -> Tuple[History, History]:
     """binary search"""
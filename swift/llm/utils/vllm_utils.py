@@ -1,4 +1,3 @@
-import concurrent.futures
 import inspect
 import os
 import time
@@ -16,8 +15,9 @@ from vllm import AsyncEngineArgs, AsyncLLMEngine, EngineArgs, LLMEngine, Samplin
 
 from swift.utils import get_logger
 from .argument import InferArguments
+from .encode_pool import get_encode_thread_pool
 from .model import get_model_tokenizer
-from .template import Template, get_template
+from .template import IncrementalDetokenizer, Template, get_template
 
 try:
     from vllm.lora.request import LoRARequest
@@ -348,16 +348,14 @@ def _prepare_vllm_request(llm_engine: LLMEngine,
             'The current version of VLLM does not support `lora_request`. Please upgrade VLLM.')
 
     resp_list: List[Optional[Dict[str, Any]]] = [None] * len(request_list)
-    agent_state = []
+    agent_state: List[Optional[Tuple[bool, int]]] = [None] * len(request_list)
     is_multimodal = getattr(llm_engine, 'is_multimodal', False)
-    max_workers = os.cpu_count()
     if not is_multimodal:
         use_tqdm = False
-        max_workers = 1
 
     prog_bar = tqdm(request_list, dynamic_ncols=True, disable=not use_tqdm)
 
-    def _prepare_inputs(request: Dict[str, Any]) -> Dict[str, Any]:
+    def _prepare_inputs(i: int, request: Dict[str, Any]) -> Dict[str, Any]:
         history = request.get('history') or []
         # agent support
         is_observation = history[-1][-1].endswith('Observation:') if history and history[-1][-1] else False
@@ -366,18 +364,20 @@ def _prepare_vllm_request(llm_engine: LLMEngine,
             history[-1][-1] = history[-1][-1] + request['query']
             act_length = len(history[-1][-1])
             request['query'] = None
-        agent_state.append((is_observation, act_length))
+        agent_state[i] = (is_observation, act_length)
         request['history'] = history
 
         inputs = template.encode(request)[0]
         prog_bar.update()
         return inputs
 
-    with template.vllm_context(), concurrent.futures.ThreadPoolExecutor(
-            max_workers=min(max_workers, len(request_list))) as executor:
-        futures = [executor.submit(_prepare_inputs, request) for request in request_list]
-        concurrent.futures.wait(futures)
-        inputs_list = [future.result() for future in futures]
+    with template.vllm_context():
+        if is_multimodal:
+            # Load the medias in the shared encode threads.
+            executor = get_encode_thread_pool()
+            inputs_list = list(executor.map(_prepare_inputs, range(len(request_list)), request_list))
+        else:
+            inputs_list = [_prepare_inputs(i, request) for i, request in enumerate(request_list)]
     prog_bar.close()
 
     for i, (inputs, request) in enumerate(zip(inputs_list, request_list)):
@@ -443,7 +443,7 @@ def inference_stream_vllm(
     n_steps = 0
     if flush_steps is None:
         flush_steps = min(10, generation_info['num_samples'])
-    print_idx_list = [[0] for _ in range(len(request_list))]
+    detokenizer_list = [IncrementalDetokenizer(template) for _ in range(len(request_list))]
     num_generated_tokens = [0] * len(request_list)
     prog_bar = tqdm(total=generation_info['num_samples'], dynamic_ncols=True, disable=not use_tqdm)
     while llm_engine.has_unfinished_requests():
@@ -458,8 +458,8 @@ def inference_stream_vllm(
             request = request_list[i]
             generate_ids = output.outputs[0].token_ids
             logprobs = output.outputs[0].logprobs
-            safe_response = template.generate_ids_to_response(
-                generate_ids, output.finished, print_idx=print_idx_list[i])
+            detokenizer_list[i].step(generate_ids, output.finished)
+            safe_response = detokenizer_list[i].response
             query = request['query']
             history = request['history']
             if resp_list[i] is None and not agent_state[i][0]:
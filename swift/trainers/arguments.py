@@ -17,9 +17,15 @@ from .loss import LOSS_MAPPING
 class SwiftArgumentsMixin:
     # ckpt only save model
     save_only_model: bool = False
+    # Write the checkpoints on the background threads (see `AsyncCheckpointWriter`)
+    async_save: bool = False
     acc_strategy: str = field(default='token', metadata={'choices': ['token', 'sentence']})
     loss_name: Optional[str] = field(default=None, metadata={'help': f'loss_func choices: {list(LOSS_MAPPING.keys())}'})
+    # Compute lm_head + cross entropy over the chunks of this many tokens, without the full logits
+    ce_chunk_size: Optional[int] = None
     additional_saved_files: Optional[List[str]] = None
+    # Build the batches up to the padded token budget (see `LengthGroupedBatchSampler`)
+    max_tokens_per_batch: Optional[int] = None
     # torchacc
     train_sampler_random: bool = True
     metric_warmup_step: Optional[float] = 0
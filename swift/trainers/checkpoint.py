@@ -0,0 +1,97 @@
+# Copyright (c) Alibaba, Inc. and its affiliates.
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import torch
+
+from swift.utils import get_logger
+
+logger = get_logger()
+
+STAGING_PREFIX = 'tmp-'
+
+
+class AsyncCheckpointWriter:
+    """Write the checkpoints on the background threads.
+
+    The training thread only copies the states into the host memory (`snapshot`), the files of a checkpoint are
+    written in parallel into `tmp-checkpoint-xxx`, which is renamed to `checkpoint-xxx` after all the files are
+    written. The rename is atomic, so the rotation and the resuming never see a partial checkpoint.
+    At most one checkpoint is in flight, its host buffers are reused by the next snapshot.
+
+    Args:
+        num_workers: The number of the threads writing the files of a checkpoint.
+    """
+
+    def __init__(self, num_workers: int = 4) -> None:
+        self._executor = ThreadPoolExecutor(num_workers, thread_name_prefix='checkpoint_writer')
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+        self._buffers: Dict[str, torch.Tensor] = {}
+
+    def snapshot(self, state: Any, key: str = '') -> Any:
+        """Copy the tensors in the (nested) state into the host buffers, keeping the shared tensors shared."""
+        self.wait()
+        res = self._snapshot(state, key, {})
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()  # non_blocking copies
+        return res
+
+    def _snapshot(self, state: Any, key: str, memo: Dict[Tuple, str]) -> Any:
+        if isinstance(state, torch.Tensor):
+            state = state.detach()
+            memo_key = (state.device, state.data_ptr(), state.dtype, state.shape, state.stride())
+            if memo_key in memo:
+                return self._buffers[memo[memo_key]]
+            buffer = self._buffers.get(key)
+            if buffer is None or buffer.shape != state.shape or buffer.dtype != state.dtype:
+                buffer = torch.empty(state.shape, dtype=state.dtype, pin_memory=state.is_cuda)
+                self._buffers[key] = buffer
+            buffer.copy_(state, non_blocking=True)
+            memo[memo_key] = key
+            return buffer
+        elif isinstance(state, dict):
+            return {k: self._snapshot(v, f'{key}.{k}', memo) for k, v in state.items()}
+        elif isinstance(state, (list, tuple)):
+            return type(state)(self._snapshot(v, f'{key}.{i}', memo) for i, v in enumerate(state))
+        else:
+            return deepcopy(state)
+
+    def submit(self, staging_dir: str, output_dir: str, write_funcs: List[Callable[[], None]]) -> None:
+        """Run `write_funcs` in parallel, then rename `staging_dir` to `output_dir`."""
+        self.wait()
+        self._thread = threading.Thread(target=self._write, args=(staging_dir, output_dir, write_funcs), daemon=True)
+        self._thread.start()
+
+    def _write(self, staging_dir: str, output_dir: str, write_funcs: List[Callable[[], None]]) -> None:
+        try:
+            futures = [self._executor.submit(func) for func in write_funcs]
+            for future in futures:
+                future.result()
+            if os.path.exists(output_dir):
+                shutil.rmtree(output_dir)
+            os.rename(staging_dir, output_dir)
+            logger.info(f'The checkpoint has been saved to {output_dir}')
+        except BaseException as e:
+            self._error = e
+
+    @property
+    def is_pending(self) -> bool:
+        return self._thread is not None
+
+    def wait(self) -> None:
+        """Wait for the checkpoint in flight, re-raise its error on the calling thread."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Failed to save the checkpoint asynchronously.') from error
+
+    def close(self) -> None:
+        self.wait()
+        self._buffers = {}
@@ -1,6 +1,9 @@
-from typing import Callable, Optional
+from contextlib import contextmanager
+from typing import Callable, Optional, Tuple
 
 import torch
+import torch.nn.functional as F
+from torch import nn
 from torch.nn import CrossEntropyLoss
 
 
@@ -29,6 +32,9 @@ def register_loss_func(loss_name: str, loss_func: Optional[Callable] = None):
 
 
 def ce_loss_func(outputs, labels):
+    if 'ce_loss' in outputs:
+        # computed by `chunked_ce_loss_func`
+        return outputs['ce_loss'], outputs['ce_masks']
     logits = outputs.logits
     device = logits.device
     # Shift so that tokens < n predict n
@@ -44,6 +50,96 @@ def ce_loss_func(outputs, labels):
     return loss, masks
 
 
+class _ChunkedLinearCrossEntropy(torch.autograd.Function):
+    """lm_head + cross entropy over the chunks of the tokens. Only the logits of a chunk ([chunk_size, vocab_size])
+    exist at a time, they are recomputed in backward."""
+
+    @staticmethod
+    def forward(ctx, hidden_states: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor],
+                labels: torch.Tensor, chunk_size: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        num_tokens = hidden_states.shape[0]
+        float_dtype = torch.promote_types(weight.dtype, torch.float32)
+        loss = hidden_states.new_empty(num_tokens, dtype=float_dtype)
+        lse = hidden_states.new_empty(num_tokens, dtype=float_dtype)
+        correct = hidden_states.new_empty(num_tokens, dtype=torch.bool)
+        compute_dtype = weight.dtype
+        for i in range(0, num_tokens, chunk_size):
+            logits = F.linear(hidden_states[i:i + chunk_size], weight, bias)
+            compute_dtype = logits.dtype  # The dtype of autocast
+            logits = logits.to(float_dtype)
+            chunk_labels = labels[i:i + chunk_size]
+            lse[i:i + chunk_size] = logits.logsumexp(dim=-1)
+            loss[i:i + chunk_size] = lse[i:i + chunk_size] - logits.gather(1, chunk_labels[:, None])[:, 0]
+            correct[i:i + chunk_size] = logits.argmax(dim=-1) == chunk_labels
+        ctx.save_for_backward(hidden_states, weight, bias, labels, lse)
+        ctx.chunk_size = chunk_size
+        ctx.compute_dtype = compute_dtype
+        ctx.mark_non_differentiable(correct)
+        return loss, correct
+
+    @staticmethod
+    def backward(ctx, grad_loss: torch.Tensor, grad_correct: Optional[torch.Tensor]):
+        hidden_states, weight, bias, labels, lse = ctx.saved_tensors
+        chunk_size, dtype = ctx.chunk_size, ctx.compute_dtype
+        float_dtype = lse.dtype
+        weight_ = weight.to(dtype)
+        bias_ = None if bias is None else bias.to(dtype)
+        grad_hidden_states = grad_weight = grad_bias = None
+        if ctx.needs_input_grad[0]:
+            grad_hidden_states = torch.zeros_like(hidden_states)
+        if ctx.needs_input_grad[1]:
+            grad_weight = torch.zeros(weight.shape, dtype=float_dtype, device=weight.device)
+        if bias is not None and ctx.needs_input_grad[2]:
+            grad_bias = torch.zeros(bias.shape, dtype=float_dtype, device=bias.device)
+        for i in range(0, hidden_states.shape[0], chunk_size):
+            chunk_hidden_states = hidden_states[i:i + chunk_size].to(dtype)
+            logits = F.linear(chunk_hidden_states, weight_, bias_).to(float_dtype)
+            # d(loss)/d(logits) = softmax(logits) - one_hot(labels)
+            grad_logits = torch.exp(logits - lse[i:i + chunk_size, None])
+            grad_logits[torch.arange(logits.shape[0], device=logits.device), labels[i:i + chunk_size]] -= 1
+            grad_logits *= grad_loss[i:i + chunk_size, None]
+            if grad_bias is not None:
+                grad_bias += grad_logits.sum(dim=0)
+            grad_logits = grad_logits.to(dtype)
+            if grad_hidden_states is not None:
+                grad_hidden_states[i:i + chunk_size] = grad_logits @ weight_
+            if grad_weight is not None:
+                grad_weight += grad_logits.t() @ chunk_hidden_states
+        if grad_weight is not None:
+            grad_weight = grad_weight.to(weight.dtype)
+        if grad_bias is not None:
+            grad_bias = grad_bias.to(bias.dtype)
+        return grad_hidden_states, grad_weight, grad_bias, None, None
+
+
+@contextmanager
+def lm_head_output_hidden_states(lm_head: nn.Linear):
+    """The `logits` of the model outputs are the hidden states before lm_head, see `chunked_ce_loss_func`."""
+    lm_head.forward = lambda hidden_states: hidden_states
+    try:
+        yield
+    finally:
+        del lm_head.forward
+
+
+def chunked_ce_loss_func(hidden_states: torch.Tensor, lm_head: nn.Linear, labels: torch.Tensor,
+                         chunk_size: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """The same as `ce_loss_func`, without the full logits ([batch, seq_len, vocab_size]).
+
+    Returns:
+        The loss and the correctness of the argmax prediction of the tokens, and the masks of the tokens.
+    """
+    assert hidden_states.shape[-1] == lm_head.in_features, (
+        f'hidden_states.shape: {hidden_states.shape}, lm_head.in_features: {lm_head.in_features}')
+    device = hidden_states.device
+    shift_hidden_states = hidden_states[..., :-1, :].to(lm_head.weight.dtype)
+    shift_labels = labels[..., 1:].to(device)
+    masks = shift_labels != -100
+    loss, correct = _ChunkedLinearCrossEntropy.apply(shift_hidden_states[masks], lm_head.weight, lm_head.bias,
+                                                     shift_labels[masks], chunk_size)
+    return loss, masks, correct
+
+
 class LongCrossEntropy:
     """Assign higher weight to long text."""
 
@@ -7,7 +7,8 @@ import shutil
 import time
 from collections import defaultdict
 from contextlib import contextmanager, nullcontext
-from copy import copy
+from copy import copy, deepcopy
+from functools import partial
 from pathlib import Path
 from types import MethodType
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
@@ -22,12 +23,14 @@ from datasets import Dataset as HfDataset
 from packaging import version
 from peft import PeftModel
 from torch.nn import Module
+from torch.utils.data import DataLoader
 from transformers import PreTrainedModel, PreTrainedTokenizerBase, trainer
 from transformers.data.data_collator import DataCollator
 from transformers.integrations import is_deepspeed_zero3_enabled
 from transformers.modeling_utils import unwrap_model
-from transformers.trainer import PREFIX_CHECKPOINT_DIR, TRAINER_STATE_NAME, Trainer, TrainerCallback
-from transformers.trainer_utils import EvalPrediction
+from transformers.trainer import (OPTIMIZER_NAME, PREFIX_CHECKPOINT_DIR, SCHEDULER_NAME, TRAINER_STATE_NAME, Trainer,
+                                  TrainerCallback)
+from transformers.trainer_utils import EvalPrediction, get_last_checkpoint, seed_worker
 from transformers.training_args import TrainingArguments
 from transformers.utils import is_sagemaker_mp_enabled, is_torch_npu_available
 
@@ -39,11 +42,24 @@ from swift.tuners import SwiftModel
 from swift.utils import check_json_format, get_logger, use_torchacc
 from swift.utils.constants import Invoke
 from .callback import DefaultFlowCallbackNew, PrinterCallbackNew, ProgressCallbackNew
+from .checkpoint import STAGING_PREFIX, AsyncCheckpointWriter
 from .optimizers.galore import create_optimizer_and_scheduler
+from .sampler import SAMPLER_STATE_NAME, LengthGroupedBatchSampler, get_dataset_lengths
+from .step_timer import StepTimer, get_device_peak_flops
 from .utils import can_return_loss, find_labels, get_function, is_instance_of_ms_model
 
 logger = get_logger()
 
+try:
+    from transformers.trainer_callback import ExportableState
+except ImportError:  # transformers<4.41
+    ExportableState = None
+
+
+def _save_file(obj: Any, output_dir: str, file_name: str) -> None:
+    os.makedirs(output_dir, exist_ok=True)
+    torch.save(obj, os.path.join(output_dir, file_name))
+
 
 class SwiftMixin:
 
@@ -114,6 +130,25 @@ class SwiftMixin:
         self.perf: Dict[str, Any] = {'memory': {}}
         if hasattr(self.model, 'get_trainable_parameters'):
             self.perf['model'] = self.model.get_trainable_parameters()
+        self._checkpoint_writer = None
+        self._checkpoint_run_dir = None
+        self._sampler_state = None
+        # The time breakdown and the throughput of the steps, see `_get_step_metrics`
+        self._step_timer = StepTimer()
+        self._last_step_time = None
+        self._last_log_time = None
+        self._num_tokens = 0
+        self._num_padded_tokens = 0
+        self._flops_per_token = None
+        if getattr(self.args, 'async_save', False):
+            # SwiftModel without the additional modules saves the base model itself, ignoring the snapshot.
+            if (self.is_deepspeed_enabled or self.is_fsdp_enabled or use_torchacc() or self.args.push_to_hub
+                    or is_sagemaker_mp_enabled()
+                    or isinstance(self.model, SwiftModel) and not self.model.has_additional_modules):
+                logger.warning('`async_save` does not support deepspeed, fsdp, torchacc and push_to_hub, '
+                               'the checkpoints will be saved synchronously.')
+            else:
+                self._checkpoint_writer = AsyncCheckpointWriter()
 
     @staticmethod
     def _create_configuration_file(model: Module, output_dir: str) -> None:
@@ -337,7 +372,19 @@ class SwiftMixin:
                         shutil.copytree(src_path, dst_path)
         self._save_converted_model(output_dir)
 
+    def _save_rng_state(self, output_dir):
+        super()._save_rng_state(output_dir)
+        batch_sampler = self._get_length_grouped_sampler()
+        if self.args.should_save and batch_sampler is not None:
+            with open(os.path.join(output_dir, SAMPLER_STATE_NAME), 'w') as f:
+                json.dump(batch_sampler.state_dict(), f)
+
+    def _get_length_grouped_sampler(self) -> Optional[LengthGroupedBatchSampler]:
+        batch_sampler = getattr(self.callback_handler.train_dataloader, 'batch_sampler', None)
+        return batch_sampler if isinstance(batch_sampler, LengthGroupedBatchSampler) else None
+
     def _save_checkpoint(self, model, trial, metrics=None):
+        start_time = time.perf_counter()
         self.state.last_model_checkpoint = os.path.join(self.args.output_dir, f'checkpoint-{self.state.global_step}')
         if is_deepspeed_zero3_enabled() and not hasattr(self.deepspeed, '_zero3_consolidated_16bit_state_dict_origin'):
             parameters = inspect.signature(self.deepspeed._zero3_consolidated_16bit_state_dict).parameters
@@ -356,13 +403,96 @@ class SwiftMixin:
                     self.deepspeed._zero3_consolidated_16bit_state_dict)
                 self.deepspeed._zero3_consolidated_16bit_state_dict = MethodType(_zero3_consolidated_16bit_state_dict,
                                                                                  self.deepspeed)
-        if version.parse(transformers.__version__) >= version.parse('4.36') or not self.args.save_only_model:
+        if self._checkpoint_writer is not None:
+            result = self._save_checkpoint_async(model, trial, metrics)
+        elif version.parse(transformers.__version__) >= version.parse('4.36') or not self.args.save_only_model:
             result = super()._save_checkpoint(model, trial, metrics)
         else:
             result = self._save_only_model(model, trial, metrics)
         logger.info(f'Saving model checkpoint to {self.state.last_model_checkpoint}')
+        self._step_timer.add('checkpoint', time.perf_counter() - start_time)
         return result
 
+    def _get_checkpoint_state_dict(self) -> Dict[str, torch.Tensor]:
+        model = self.model
+        if isinstance(model, PeftModel) or isinstance(model, SwiftModel) and model.has_additional_modules:
+            # save_pretrained filters the adapter weights out of the trainable parameters.
+            return {n: p for n, p in model.named_parameters() if p.requires_grad}
+        return model.state_dict()
+
+    def _wait_for_checkpoint(self) -> None:
+        if self._checkpoint_writer is None or not self._checkpoint_writer.is_pending:
+            return
+        self._checkpoint_writer.wait()
+        if self.args.should_save:
+            self._rotate_checkpoints(use_mtime=False, output_dir=self._checkpoint_run_dir)
+
+    def _save_checkpoint_async(self, model, trial, metrics=None):
+        """Snapshot the states into the host memory, and write the checkpoint on the background threads.
+
+        The files are written into `tmp-checkpoint-xxx`, which is renamed to `checkpoint-xxx` when complete.
+        """
+        checkpoint_folder = f'{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}'
+
+        if self.hp_search_backend is None and trial is None:
+            self.store_flos()
+
+        self._wait_for_checkpoint()
+        run_dir = self._get_output_dir(trial=trial)
+        output_dir = os.path.join(run_dir, checkpoint_folder)
+        staging_dir = os.path.join(run_dir, f'{STAGING_PREFIX}{checkpoint_folder}')
+        if self.args.should_save:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        self.accelerator.wait_for_everyone()
+
+        writer = self._checkpoint_writer
+        write_funcs = []
+        if self.args.should_save:
+            state_dict = writer.snapshot(self._get_checkpoint_state_dict(), 'model')
+            write_funcs.append(partial(self._save, staging_dir, state_dict=state_dict))
+        if not self.args.save_only_model:
+            if self.args.should_save:
+                optimizer_state = writer.snapshot(self.optimizer.state_dict(), 'optimizer')
+                scheduler_state = deepcopy(self.lr_scheduler.state_dict())
+                write_funcs.append(partial(_save_file, optimizer_state, staging_dir, OPTIMIZER_NAME))
+                write_funcs.append(partial(_save_file, scheduler_state, staging_dir, SCHEDULER_NAME))
+            # Small, written by every process.
+            self._save_rng_state(staging_dir)
+
+        # Determine the new best metric / best model checkpoint
+        if metrics is not None and self.args.metric_for_best_model is not None:
+            metric_to_check = self.args.metric_for_best_model
+            if not metric_to_check.startswith('eval_'):
+                metric_to_check = f'eval_{metric_to_check}'
+            metric_value = metrics[metric_to_check]
+
+            operator = np.greater if self.args.greater_is_better else np.less
+            if (self.state.best_metric is None or self.state.best_model_checkpoint is None
+                    or operator(metric_value, self.state.best_metric)):
+                self.state.best_metric = metric_value
+                self.state.best_model_checkpoint = output_dir
+
+        # Save the Trainer state
+        if self.args.should_save:
+            if ExportableState is not None:
+                for cb in self.callback_handler.callbacks + [self.control]:
+                    if not isinstance(cb, ExportableState):
+                        continue
+                    cb_name = cb.__class__.__name__
+                    cb_state = cb.state()
+                    if isinstance(self.state.stateful_callbacks[cb_name], list):
+                        self.state.stateful_callbacks[cb_name].append(cb_state)
+                    else:
+                        self.state.stateful_callbacks[cb_name] = cb_state
+            write_funcs.append(
+                partial(deepcopy(self.state).save_to_json, os.path.join(staging_dir, TRAINER_STATE_NAME)))
+
+        # The rng states of all the processes are in staging_dir before the rename.
+        self.accelerator.wait_for_everyone()
+        if self.args.should_save:
+            self._checkpoint_run_dir = run_dir
+            writer.submit(staging_dir, output_dir, write_funcs)
+
     def _save_only_model(self, model, trial, metrics=None):
         # Save model checkpoint
         checkpoint_folder = f'{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}'
@@ -426,6 +556,8 @@ class SwiftMixin:
                             output_dir=None,
                             checkpoint_prefix=PREFIX_CHECKPOINT_DIR,
                             use_mtime=False) -> List[str]:
+        self._wait_for_checkpoint()
+        # The checkpoints in flight (`tmp-checkpoint-xxx`, see `async_save`) are not matched.
         ordering_and_checkpoint_path = []
 
         glob_checkpoints = [str(x) for x in Path(output_dir).glob(f'{checkpoint_prefix}-*') if os.path.isdir(x)]
@@ -457,15 +589,51 @@ class SwiftMixin:
             resume_from_checkpoint = None
         if self._resume_from_checkpoint is not None and not is_sagemaker_mp_enabled() and not self.is_fsdp_enabled:
             self._load_from_checkpoint(self._resume_from_checkpoint)
+        self._sampler_state = None
+        if resume_from_checkpoint and not self.args.ignore_data_skip:
+            checkpoint = resume_from_checkpoint
+            if isinstance(checkpoint, bool):
+                checkpoint = get_last_checkpoint(self.args.output_dir)
+            sampler_state_path = os.path.join(checkpoint or '', SAMPLER_STATE_NAME)
+            if os.path.isfile(sampler_state_path):
+                with open(sampler_state_path, 'r') as f:
+                    self._sampler_state = json.load(f)
 
         self._save_initial_model(self.args.output_dir)
-        res = super().train(resume_from_checkpoint, *args, **kwargs)
+        try:
+            with self._patch_skip_first_batches():
+                res = super().train(resume_from_checkpoint, *args, **kwargs)
+        finally:
+            self._wait_for_checkpoint()
         self._resume_from_checkpoint = None
         if self.max_memory != 0:
             self.perf['memory']['cuda'] = f'{self.max_memory:.2f}GiB'
         return res
 
+    @staticmethod
+    @contextmanager
+    def _patch_skip_first_batches():
+        """Resume from the sampler state in O(1), instead of iterating over the skipped batches."""
+        origin_skip_first_batches = getattr(trainer, 'skip_first_batches', None)
+        if origin_skip_first_batches is None:
+            yield
+            return
+
+        def skip_first_batches(dataloader, num_batches=0):
+            batch_sampler = getattr(dataloader, 'batch_sampler', None)
+            if isinstance(batch_sampler, LengthGroupedBatchSampler):
+                batch_sampler.skip(num_batches)
+                return dataloader
+            return origin_skip_first_batches(dataloader, num_batches)
+
+        trainer.skip_first_batches = skip_first_batches
+        try:
+            yield
+        finally:
+            trainer.skip_first_batches = origin_skip_first_batches
+
     def _load_best_model(self):
+        self._wait_for_checkpoint()
         # Compatible with transformers>=4.35 (deepspeed)
         try:
             model = self.model
@@ -498,7 +666,81 @@ class SwiftMixin:
             torch.cuda.reset_peak_memory_stats()
         return mem
 
+    def training_step(self, model, inputs, *args, **kwargs):
+        now = time.perf_counter()
+        if self._last_step_time is not None:
+            # Between the steps, the training loop only waits for the dataloader.
+            self._step_timer.add('dataloader', now - self._last_step_time)
+        if self._last_log_time is None:
+            self._last_log_time = now
+        input_ids = inputs.get('input_ids')
+        if isinstance(input_ids, torch.Tensor):
+            attention_mask = inputs.get('attention_mask')
+            if isinstance(attention_mask, torch.Tensor) and attention_mask.shape == input_ids.shape:
+                self._num_tokens = self._num_tokens + attention_mask.sum()  # no synchronization until logging
+            else:
+                self._num_tokens = self._num_tokens + input_ids.numel()
+            self._num_padded_tokens += input_ids.numel()
+        batch_sampler = self._get_length_grouped_sampler()
+        if batch_sampler is not None:
+            # The dataloader prefetches the batches, count the ones consumed by the training loop.
+            batch_sampler.num_consumed += 1
+        with self._step_timer.timer('forward_backward'):
+            loss = super().training_step(model, inputs, *args, **kwargs)
+        # From the last micro batch to `_maybe_log_save_evaluate`: clip_grad_norm, optimizer and lr_scheduler
+        self._step_timer.start('optimizer')
+        self._last_step_time = time.perf_counter()
+        return loss
+
+    @contextmanager
+    def compute_loss_context_manager(self):
+        with super().compute_loss_context_manager():
+            if self.model.training:
+                with self._step_timer.timer('forward'):
+                    yield
+            else:
+                yield
+
+    def _get_flops_per_token(self) -> int:
+        """Forward 2N, backward 2N for the activations and 2N for the trainable weights (the 6N of MFU)."""
+        if self._flops_per_token is None:
+            num_params, num_trainable_params = 0, 0
+            for p in self.model.parameters():
+                numel = getattr(p, 'ds_numel', p.numel())  # deepspeed zero3
+                num_params += numel
+                if p.requires_grad:
+                    num_trainable_params += numel
+            self._flops_per_token = 4 * num_params + 2 * num_trainable_params
+        return self._flops_per_token
+
+    def _get_step_metrics(self) -> Dict[str, float]:
+        """The time breakdown (mean of the processes), tokens/s, padding ratio and MFU since the last log."""
+        times = self._step_timer.pop_times()
+        times['backward'] = times.pop('forward_backward', 0.) - times.get('forward', 0.)
+        names = ['dataloader', 'forward', 'backward', 'optimizer', 'checkpoint']
+        now = time.perf_counter()
+        elapse_time = now - (self._last_log_time or now)
+        self._last_log_time = now
+        values = [times.get(name, 0.) for name in names] + [float(self._num_tokens), float(self._num_padded_tokens)]
+        self._num_tokens, self._num_padded_tokens = 0, 0
+        values = self._nested_gather(torch.tensor(values, device=self.args.device)).view(-1, len(values))
+        num_tokens, num_padded_tokens = values[:, -2:].sum(dim=0).tolist()
+        values = values[:, :-2].mean(dim=0).tolist()
+        num_steps = max(self.state.global_step - self._globalstep_last_logged, 1)
+        logs = {f'{name}_time(s)': round(value / num_steps, 6) for name, value in zip(names, values)}
+        if num_padded_tokens > 0:
+            logs['padding_ratio'] = round(1 - num_tokens / num_padded_tokens, 6)
+        if elapse_time > 0:
+            tokens_per_second = num_tokens / elapse_time
+            logs['train_speed(tokens/s)'] = round(tokens_per_second, 2)
+            peak_flops = get_device_peak_flops()
+            if peak_flops is not None:
+                flops = tokens_per_second * self._get_flops_per_token()
+                logs['mfu'] = round(flops / (peak_flops * self.args.world_size), 6)
+        return logs
+
     def _maybe_log_save_evaluate(self, tr_loss, *args, **kwargs):
+        self._step_timer.stop('optimizer')
         if self.control.should_log:
             if use_torchacc():
                 ta_trim_graph()
@@ -527,15 +769,16 @@ class SwiftMixin:
             logs['learning_rate'] = self._get_learning_rate()
             if not is_torch_npu_available():
                 logs['memory(GiB)'] = round(self.get_max_cuda_memory(), 2)
-            import time
             time_now = time.time()
             elapse_time = time_now - self.start_time
             logs['train_speed(iter/s)'] = round(self.state.global_step / elapse_time, 6)
+            logs.update(self._get_step_metrics())
             tr_loss -= tr_loss
             self._globalstep_last_logged = self.state.global_step
             self.store_flos()
             self.log(logs)
         super()._maybe_log_save_evaluate(tr_loss, *args, **kwargs)
+        self._last_step_time = time.perf_counter()
 
     def create_optimizer_and_scheduler(self, num_training_steps: int):
         if hasattr(self.args, 'galore_config'):
@@ -610,9 +853,52 @@ class SwiftMixin:
 
             return ta_train_dataloader(train_dataset, data_collator, self._get_train_sampler(), self.args,
                                        self._train_batch_size)
+        elif self.args.group_by_length or self.args.max_tokens_per_batch is not None:
+            return self._get_length_grouped_dataloader()
         else:
             return super().get_train_dataloader()
 
+    def _get_length_grouped_dataloader(self) -> DataLoader:
+        from accelerate.data_loader import prepare_data_loader
+        if self.train_dataset is None:
+            raise ValueError('Trainer: training requires a train_dataset.')
+        args = self.args
+        train_dataset = self.train_dataset
+        data_collator = self.data_collator
+        if isinstance(train_dataset, HfDataset):
+            train_dataset = self._remove_unused_columns(train_dataset, description='training')
+        else:
+            data_collator = self._get_collator_with_removed_columns(data_collator, description='training')
+        batch_sampler = LengthGroupedBatchSampler(
+            get_dataset_lengths(train_dataset),
+            self._train_batch_size,
+            args.max_tokens_per_batch,
+            shuffle=args.train_sampler_random,
+            seed=args.data_seed if args.data_seed is not None else args.seed,
+            num_replicas=args.world_size,
+            rank=args.process_index,
+            drop_last=args.dataloader_drop_last)
+        if self._sampler_state is not None:
+            batch_sampler.load_state_dict(self._sampler_state)
+            self._sampler_state = None
+        dataloader_params = {
+            'batch_sampler': batch_sampler,
+            'collate_fn': data_collator,
+            'num_workers': args.dataloader_num_workers,
+            'pin_memory': args.dataloader_pin_memory,
+            'persistent_workers': args.dataloader_persistent_workers,
+            'worker_init_fn': seed_worker,
+        }
+        if args.dataloader_num_workers > 0:
+            dataloader_params['prefetch_factor'] = args.dataloader_prefetch_factor
+        # The batches are already split among the processes by the batch sampler.
+        return prepare_data_loader(
+            DataLoader(train_dataset, **dataloader_params),
+            args.device,
+            num_processes=1,
+            process_index=0,
+            put_on_device=True)
+
     def get_eval_dataloader(self, eval_dataset=None):
         if not use_torchacc():
             return super().get_eval_dataloader(eval_dataset)
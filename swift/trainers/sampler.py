@@ -0,0 +1,168 @@
+# Copyright (c) Alibaba, Inc. and its affiliates.
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+from datasets import Dataset as HfDataset
+from torch.utils.data import Dataset, Sampler
+
+from swift.utils import get_logger
+
+logger = get_logger()
+
+SAMPLER_STATE_NAME = 'sampler_state.json'
+
+
+def get_dataset_lengths(dataset: Dataset) -> np.ndarray:
+    """The token lengths of the encoded dataset (the sum of `input_ids` and `*_input_ids`)."""
+    from swift.llm.utils.utils import LazyLLMDataset, _get_token_len
+    if isinstance(dataset, LazyLLMDataset):
+        raise ValueError('The length grouped sampler needs the encoded dataset, please set `--lazy_tokenize false`.')
+    if isinstance(dataset, HfDataset) and 'input_ids' not in dataset.features:
+        raise ValueError('The length grouped sampler needs the `input_ids` of the dataset.')
+    return np.array(_get_token_len(dataset), dtype=np.int64)
+
+
+class LengthGroupedBatchSampler(Sampler[List[int]]):
+    """Batch the samples of similar lengths together to reduce the padding.
+
+    Every epoch, the shuffled indices are split into chunks of `group_size` batches (of all the processes),
+    which are sorted by length and split into batches of `batch_size` samples, or of at most
+    `max_tokens_per_batch` padded tokens (`max_length_in_batch * num_samples`). Then the consecutive
+    `num_replicas` batches (of similar lengths) make a step, the steps are shuffled and each process takes
+    its batch of each step. The result only depends on `seed` and the epoch, so the position is saved as
+    (epoch, seed, offset) in the checkpoints, and resuming skips `offset` steps in O(1).
+
+    With `max_tokens_per_batch`, the number of steps changes with the epochs, so the trainer cannot derive the
+    position from `global_step`. The trainer counts the consumed steps in `num_consumed` (the dataloader
+    prefetches the batches), and after `load_state_dict`, the epoch and the offset of the trainer's arithmetic
+    are ignored in favor of the loaded ones.
+
+    Args:
+        lengths: The token length of each sample.
+        batch_size: The batch size per process, ignored if `max_tokens_per_batch` is set.
+        max_tokens_per_batch: The padded token budget of a batch.
+        num_replicas/rank: The world size and the rank of the current process.
+        drop_last: Drop the last steps that cannot be split for all the processes, else pad them
+            with the batches from the beginning.
+    """
+
+    def __init__(self,
+                 lengths: np.ndarray,
+                 batch_size: int = 1,
+                 max_tokens_per_batch: Optional[int] = None,
+                 *,
+                 shuffle: bool = True,
+                 seed: int = 42,
+                 num_replicas: int = 1,
+                 rank: int = 0,
+                 drop_last: bool = False,
+                 group_size: int = 50) -> None:
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.drop_last = drop_last
+        self.group_size = group_size
+        self.epoch = 0
+        self.offset = 0  # The steps skipped by the next iteration
+        self.num_consumed = 0  # The steps of the current epoch consumed by the training loop
+        self._resuming = False
+        self._epoch_shift = 0
+        self._steps = None
+        if max_tokens_per_batch is not None:
+            num_too_long = int((self.lengths > max_tokens_per_batch).sum())
+            if num_too_long > 0:
+                logger.warning(f'{num_too_long} samples are longer than max_tokens_per_batch: {max_tokens_per_batch}, '
+                               'each of them is put into a batch alone.')
+
+    def set_epoch(self, epoch: int) -> None:
+        if self._resuming:
+            # The epoch to resume from is loaded, the following epochs are shifted accordingly.
+            self._epoch_shift = self.epoch - epoch
+            return
+        epoch += self._epoch_shift
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.offset = 0
+            self.num_consumed = 0
+            self._steps = None
+
+    def skip(self, num_steps: int) -> None:
+        """Skip the first `num_steps` steps of the next iteration."""
+        if not self._resuming:
+            self.offset = num_steps
+
+    def state_dict(self) -> Dict[str, Any]:
+        if self.num_consumed >= len(self):
+            return {'epoch': self.epoch + 1, 'seed': self.seed, 'offset': 0}
+        return {'epoch': self.epoch, 'seed': self.seed, 'offset': self.num_consumed}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        if state_dict['seed'] != self.seed:
+            self.seed = state_dict['seed']
+            self._steps = None
+        self._resuming = False
+        self._epoch_shift = 0
+        self.set_epoch(state_dict['epoch'])
+        self.skip(state_dict['offset'])
+        self._resuming = True
+
+    def _get_chunk_size(self) -> int:
+        if self.max_tokens_per_batch is None:
+            batch_size = self.batch_size
+        else:
+            batch_size = max(self.max_tokens_per_batch // max(int(self.lengths.mean()), 1), 1)
+        return batch_size * self.num_replicas * self.group_size
+
+    def _split_batches(self, indices: np.ndarray) -> List[List[int]]:
+        lengths = self.lengths[indices]
+        if self.max_tokens_per_batch is None:
+            return [indices[i:i + self.batch_size].tolist() for i in range(0, len(indices), self.batch_size)]
+        # sorted by length (descending), the first sample of the batch has the max length.
+        batches = []
+        start = 0
+        for i in range(1, len(indices) + 1):
+            if i == len(indices) or lengths[start] * (i + 1 - start) > self.max_tokens_per_batch:
+                batches.append(indices[start:i].tolist())
+                start = i
+        return batches
+
+    def _get_steps(self) -> List[List[List[int]]]:
+        if self._steps is not None:
+            return self._steps
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        chunk_size = self._get_chunk_size()
+        batches = []
+        for i in range(0, len(indices), chunk_size):
+            chunk = indices[i:i + chunk_size]
+            chunk = chunk[np.argsort(-self.lengths[chunk], kind='stable')]
+            batches += self._split_batches(chunk)
+        num_replicas = self.num_replicas
+        if len(batches) % num_replicas != 0:
+            if self.drop_last:
+                batches = batches[:len(batches) - len(batches) % num_replicas]
+            else:
+                batches += batches[:num_replicas - len(batches) % num_replicas]
+        steps = [batches[i:i + num_replicas] for i in range(0, len(batches), num_replicas)]
+        if self.shuffle and len(steps) > 0:
+            # The step with the most tokens comes first, so that OOM is found early.
+            max_idx = int(np.argmax([max(self.lengths[b].max() * len(b) for b in step) for step in steps]))
+            steps[0], steps[max_idx] = steps[max_idx], steps[0]
+            order = np.concatenate([[0], rng.permutation(np.arange(1, len(steps)))]).tolist()
+            steps = [steps[i] for i in order]
+        self._steps = steps
+        return steps
+
+    def __iter__(self) -> Iterator[List[int]]:
+        offset, self.offset = self.offset, 0
+        self.num_consumed = offset
+        self._resuming = False
+        for step in self._get_steps()[offset:]:
+            yield step[self.rank]
+
+    def __len__(self) -> int:
+        return len(self._get_steps())
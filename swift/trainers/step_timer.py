@@ -0,0 +1,98 @@
+# Copyright (c) Alibaba, Inc. and its affiliates.
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+
+# The dense bf16/fp16 peak FLOPS, the longer names first.
+_PEAK_FLOPS = [
+    ('H100 PCIe', 756e12),
+    ('H100', 989e12),
+    ('H800', 989e12),
+    ('H20', 148e12),
+    ('A100', 312e12),
+    ('A800', 312e12),
+    ('L40S', 362e12),
+    ('L40', 181e12),
+    ('A10', 125e12),
+    ('A6000', 155e12),
+    ('4090', 165e12),
+    ('3090', 71e12),
+    ('V100', 125e12),
+    ('T4', 65e12),
+]
+
+
+def get_device_peak_flops() -> Optional[float]:
+    """The peak FLOPS of the current cuda device, None if unknown."""
+    if not torch.cuda.is_available():
+        return None
+    device_name = torch.cuda.get_device_name()
+    for name, flops in _PEAK_FLOPS:
+        if name in device_name:
+            return flops
+
+
+class StepTimer:
+    """Accumulate the time of the training phases between two logs.
+
+    On cuda, the phases are timed with the cuda events, which are read after they complete, so the timing does not
+    synchronize the device. Otherwise, the wall time is used.
+    """
+
+    def __init__(self) -> None:
+        self.use_cuda_event = torch.cuda.is_available()
+        self.times: Dict[str, float] = defaultdict(float)
+        self._starts: Dict[str, Any] = {}
+        self._pending: List[Tuple[str, Any, Any]] = []  # (name, start_event, end_event)
+
+    def _now(self) -> Any:
+        if self.use_cuda_event:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def start(self, name: str) -> None:
+        self._starts[name] = self._now()
+
+    def stop(self, name: str) -> None:
+        start = self._starts.pop(name, None)
+        if start is None:
+            return
+        end = self._now()
+        if self.use_cuda_event:
+            self._pending.append((name, start, end))
+            self._update()
+        else:
+            self.times[name] += end - start
+
+    @contextmanager
+    def timer(self, name: str):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def add(self, name: str, seconds: float) -> None:
+        """Add the wall time of a phase on the host, e.g. waiting for the dataloader."""
+        self.times[name] += seconds
+
+    def _update(self, block: bool = False) -> None:
+        while self._pending:
+            name, start, end = self._pending[0]
+            if block:
+                end.synchronize()
+            elif not end.query():
+                break
+            self.times[name] += start.elapsed_time(end) / 1000
+            self._pending.pop(0)
+
+    def pop_times(self) -> Dict[str, float]:
+        """The seconds of each phase since the last call."""
+        self._update(block=True)
+        times, self.times = dict(self.times), defaultdict(float)
+        return times
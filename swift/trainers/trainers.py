@@ -13,11 +13,13 @@ from transformers.models.auto.modeling_auto import MODEL_FOR_CAUSAL_LM_MAPPING_N
 from transformers.utils import is_peft_available
 
 from swift.torchacc_utils import patch_clip_grad_norm, ta_trim_graph
-from swift.utils import use_torchacc
-from .loss import get_loss_func
+from swift.utils import get_logger, use_torchacc
+from .loss import chunked_ce_loss_func, get_loss_func, lm_head_output_hidden_states
 from .mixin import SwiftMixin
 from .push_to_ms import PushToMsHubMixin
 
+logger = get_logger()
+
 
 class Trainer(PushToMsHubMixin, SwiftMixin, HfTrainer):
     pass
@@ -93,7 +95,8 @@ class Seq2SeqTrainer(PushToMsHubMixin, SwiftMixin, HfSeq2SeqTrainer):
                     break
 
             for k in ['input_ids', 'attention_mask']:
-                generate_inputs[k] = generate_inputs[k][:, :n_mask]
+                if k in generate_inputs:  # packing: no attention_mask
+                    generate_inputs[k] = generate_inputs[k][:, :n_mask]
             generate_inputs['labels'] = generate_inputs['labels'][:, n_mask:]
 
         generated_tokens = self.model.generate(**generate_inputs, **gen_kwargs)
@@ -154,11 +157,23 @@ class Seq2SeqTrainer(PushToMsHubMixin, SwiftMixin, HfSeq2SeqTrainer):
         if loss_name == 'loss-scale':
             loss_kwargs['loss_scale'] = inputs.pop('loss_scale')
 
+        lm_head = self._get_chunked_ce_lm_head(model) if model.training and 'labels' in inputs else None
+        if lm_head is not None and loss_name is None:
+            loss_name = 'loss-scale'  # the mean of the cross entropy
+
         if loss_name is not None or self.label_smoother is not None and 'labels' in inputs:
             labels = inputs.pop('labels')
 
         loss_kwargs['labels'] = labels
-        outputs = model(**inputs)
+        if lm_head is None:
+            outputs = model(**inputs)
+        else:
+            with lm_head_output_hidden_states(lm_head):
+                outputs = model(**inputs)
+            ce_loss, ce_masks, ce_correct = chunked_ce_loss_func(outputs.logits, lm_head, labels,
+                                                                 self.args.ce_chunk_size)
+            outputs['logits'] = None
+            outputs['ce_loss'], outputs['ce_masks'] = ce_loss, ce_masks
         if loss_name is not None:
             loss_func = get_loss_func(loss_name)
             outputs['loss'] = loss_func(outputs, **loss_kwargs)
@@ -188,7 +203,10 @@ class Seq2SeqTrainer(PushToMsHubMixin, SwiftMixin, HfSeq2SeqTrainer):
             from swift.trainers.xtuner import reduce_xtuner_sequence_parallel_loss
             loss = reduce_xtuner_sequence_parallel_loss(loss, labels)
 
-        if self.is_encoder_decoder:
+        if lm_head is not None:
+            preds = None
+            labels = labels[..., 1:]
+        elif self.is_encoder_decoder:
             preds = outputs.logits.argmax(dim=2)[..., :] if outputs.logits is not None else None
             labels = labels[..., :]
         else:
@@ -200,6 +218,13 @@ class Seq2SeqTrainer(PushToMsHubMixin, SwiftMixin, HfSeq2SeqTrainer):
         acc: Optional[torch.Tensor] = None
         sft_args = getattr(self, 'sft_args', None)
         acc_steps = 1 if sft_args is None else sft_args.acc_steps
+        if self.state.global_step % acc_steps == 0 and lm_head is not None:
+            if acc_strategy == 'sentence':
+                correct = torch.ones_like(masks)
+                correct[masks] = ce_correct
+                acc = correct.all(dim=1).float().mean()
+            else:
+                acc = ce_correct.float().mean()
         if self.state.global_step % acc_steps == 0 and preds is not None:
             if preds.shape != labels.shape:
                 pass
@@ -215,8 +240,33 @@ class Seq2SeqTrainer(PushToMsHubMixin, SwiftMixin, HfSeq2SeqTrainer):
                     masks = masks.to('cpu')
                     labels = labels.to('cpu')
                 acc = (torch.masked_select(preds, masks) == torch.masked_select(labels, masks)).float().mean()
-            if model.training and acc is not None:
-                if 'acc' not in self._custom_metrics:
-                    self._custom_metrics['acc'] = self._acc
-                self._custom_metrics['acc'] = self._custom_metrics['acc'] + acc / self.args.gradient_accumulation_steps
+        if model.training and acc is not None:
+            if 'acc' not in self._custom_metrics:
+                self._custom_metrics['acc'] = self._acc
+            self._custom_metrics['acc'] = self._custom_metrics['acc'] + acc / self.args.gradient_accumulation_steps
         return (loss, outputs) if return_outputs else loss
+
+    def _get_chunked_ce_lm_head(self, model) -> Optional[nn.Linear]:
+        """The lm_head of the model if `ce_chunk_size` is used, else None."""
+        if self.args.ce_chunk_size is None or self.is_encoder_decoder:
+            return None
+        if hasattr(self, '_chunked_ce_lm_head'):
+            return self._chunked_ce_lm_head
+        unwrapped_model = unwrap_model(model)
+        lm_head = unwrapped_model.get_output_embeddings()
+        config = getattr(unwrapped_model, 'config', None)
+        logits_post_process_keys = ['final_logit_softcapping', 'logit_scale', 'logits_scaling']
+        error_msg = None
+        if not isinstance(lm_head, nn.Linear):
+            error_msg = f'the lm_head is {type(lm_head)}, not nn.Linear'
+        elif any(getattr(config, k, None) is not None for k in logits_post_process_keys):
+            error_msg = 'the logits are post-processed'
+        elif self.label_smoother is not None:
+            error_msg = 'label smoothing is used'
+        elif is_deepspeed_zero3_enabled() or self.sequence_parallel_size > 1:
+            error_msg = 'DeepSpeed ZeRO-3 or sequence parallel is used'
+        if error_msg is not None:
+            logger.warning(f'ce_chunk_size is ignored: {error_msg}.')
+            lm_head = None
+        self._chunked_ce_lm_head = lm_head
+        return lm_head
@@ -7,7 +7,7 @@ from copy import copy
 from functools import partial
 from inspect import Parameter, Signature, signature
 from types import MethodType
-from typing import Dict, List, Literal, Optional, Union
+from typing import Dict, List, Literal, Optional, Tuple, Union
 
 import json
 import torch
@@ -84,6 +84,8 @@ class SwiftModel(nn.Module):
 
         self.extra_state_keys = extra_state_keys or []
         self.has_additional_modules = any([c.config.has_additional_modules for c in self.adapters.values()])
+        # {adapter_name: (keys, modules_to_save keys)}, None: the extra states, see `_get_state_dict_index`
+        self._state_dict_index = None
 
         def forward(self, *args, **kwargs):
             return self.base_model(*args, **kwargs)
@@ -186,6 +188,9 @@ class SwiftModel(nn.Module):
             The state dict to be saved.
         """
         state_dict = kwargs.get('state_dict')
+        if state_dict is None and destination is None and not prefix and self.has_additional_modules:
+            state_dict = self._get_indexed_state_dict(adapter_name, keep_vars, kwargs.get('save_adapter', True),
+                                                      kwargs.get('save_extra_states', True))
         if state_dict is None:
             state_dict = self.base_model.state_dict(destination=destination, prefix=prefix, keep_vars=keep_vars)
         state_dict = {
@@ -200,13 +205,9 @@ class SwiftModel(nn.Module):
             for name, output in self.adapters.items():
                 if (adapter_name == name or adapter_name is None) and output.config.has_additional_modules:  # noqa
                     state_dicts.update(output.state_dict_callback(state_dict, name))
-                    modules_to_save_names = [
-                        sub_name for sub_name, _ in self.base_model.named_parameters()
-                        if f'modules_to_save.{name}' in sub_name
-                    ]
+                    modules_to_save_names = self._get_state_dict_index()[name][1]
                     for module_name in modules_to_save_names:
-                        if f'modules_to_save.{name}' in module_name:
-                            state_dicts[module_name.replace(f'modules_to_save.{name}.', '')] = state_dict[module_name]
+                        state_dicts[module_name.replace(f'modules_to_save.{name}.', '')] = state_dict[module_name]
         if kwargs.get('save_extra_states', True):
             state_dicts.update({
                 k: v
@@ -226,6 +227,64 @@ class SwiftModel(nn.Module):
             state_dicts = new_state_dict
         return state_dicts
 
+    def _get_state_dict_index(self) -> Dict[Optional[str], Tuple[List[Tuple[str, nn.Module, str]], List[str]]]:
+        """The state_dict keys of each adapter with their modules, indexed once at the first save after the injection.
+
+        The `state_dict_callback` of the tuners only filter the keys, so they are called on the keys here, and the
+        later saves only touch the tensors of the adapters instead of the whole base model.
+        """
+        adapter_names = [name for name, output in self.adapters.items() if output.config.has_additional_modules]
+        if self._state_dict_index is None or set(self._state_dict_index) != {None, *adapter_names}:
+            keys = list(self.base_model.state_dict(keep_vars=True).keys())
+            key_dict = {key: key for key in keys}
+            modules = dict(self.base_model.named_modules(remove_duplicate=False))
+
+            def _resolve(key):
+                module_name, _, tensor_name = key.rpartition('.')
+                return key, modules.get(module_name), tensor_name
+
+            index = {}
+            for name in adapter_names:
+                adapter_keys = set(self.adapters[name].state_dict_callback(key_dict, name).values())
+                modules_to_save_keys = [
+                    sub_name for sub_name, _ in self.base_model.named_parameters()
+                    if f'modules_to_save.{name}' in sub_name
+                ]
+                adapter_keys.update(modules_to_save_keys)
+                index[name] = ([_resolve(key) for key in keys if key in adapter_keys], modules_to_save_keys)
+            extra_keys = [
+                _resolve(key) for key in keys if any(
+                    re.fullmatch(extra_key, key) for extra_key in self.extra_state_keys)
+            ]
+            index[None] = (extra_keys, [])
+            self._state_dict_index = index
+        return self._state_dict_index
+
+    def _get_indexed_state_dict(self, adapter_name: Optional[str], keep_vars: bool, save_adapter: bool,
+                                save_extra_states: bool) -> Optional[Dict[str, torch.Tensor]]:
+        """The part of the base model state_dict needed by the adapters, None if it is not indexable."""
+        index = self._get_state_dict_index()
+        keys = []
+        if save_adapter:
+            for name, (adapter_keys, _) in index.items():
+                if name is not None and (adapter_name == name or adapter_name is None):
+                    keys += adapter_keys
+        if save_extra_states:
+            keys += index[None][0]
+        state_dict = {}
+        for key, module, tensor_name in keys:
+            tensor = None
+            if module is not None:
+                tensor = module._parameters.get(tensor_name)
+                if tensor is None and tensor_name not in module._non_persistent_buffers_set:
+                    tensor = module._buffers.get(tensor_name)
+            if tensor is None:
+                # e.g. the quantization states, or the model has been changed after the indexing
+                self._state_dict_index = None
+                return None
+            state_dict[key] = tensor if keep_vars else tensor.detach()
+        return state_dict
+
     def __getattr__(self, name: str):
         """Forward missing attributes to the wrapped module."""
         try:
@@ -6,6 +6,7 @@ import math
 import re
 import warnings
 from itertools import chain
+from types import MethodType
 from typing import Any, Dict, List, Optional
 
 import importlib_metadata
@@ -105,6 +106,69 @@ class LoRAActivationMixin(ActivationMixin):
         return super().merge(*args, **kwargs)
 
 
+def _get_lora_stack(layer: LoraLayer, adapters: List[str]):
+    """Stack the lora weights of `adapters` (padded to the max rank, with the scaling folded into B).
+
+    The last slot is all zeros for the rows without an adapter. The stack is cached in the layer until the
+    adapters (or their weights, including the in-place updates) change.
+    """
+    key = tuple((adapter, id(w_A), w_A._version, id(w_B), w_B._version)
+                for adapter, w_A, w_B in ((adapter, layer.lora_A[adapter].weight, layer.lora_B[adapter].weight)
+                                          for adapter in adapters))
+    cache = getattr(layer, '_lora_stack_cache', None)
+    if cache is not None and cache[0] == key:
+        return cache[1], cache[2]
+    weight_A = [layer.lora_A[adapter].weight for adapter in adapters]
+    weight_B = [layer.lora_B[adapter].weight * layer.scaling[adapter] for adapter in adapters]
+    max_rank = max(w.shape[0] for w in weight_A)
+    w = weight_A[0]
+    stack_A = w.new_zeros((len(adapters) + 1, max_rank, w.shape[1]))
+    stack_B = w.new_zeros((len(adapters) + 1, weight_B[0].shape[0], max_rank))
+    for i, (w_A, w_B) in enumerate(zip(weight_A, weight_B)):
+        stack_A[i, :w_A.shape[0]] = w_A
+        stack_B[i, :, :w_B.shape[1]] = w_B
+    layer._lora_stack_cache = (key, stack_A, stack_B)
+    return stack_A, stack_B
+
+
+def lora_mixed_batch_forward(self, x: torch.Tensor, *args: Any, adapter_names: List[str],
+                             **kwargs: Any) -> torch.Tensor:
+    """The forward of a batch in which each row uses its own adapter (`adapter_names[i]`).
+
+    The low-rank products of all the adapters are computed by two batched matmuls over the per-row gathered
+    weights, instead of a loop over the adapters. Rows whose adapter does not exist in the layer use the base layer.
+    """
+    adapters = sorted(set(name for name in adapter_names if name in self.lora_A))
+    if (self.training or x.dim() not in {2, 3} or any(self.use_dora.get(adapter) for adapter in adapters)
+            or any(self.lora_A[adapter].weight.dim() != 2 for adapter in adapters)):
+        return LoraLayer._mixed_batch_forward(self, x, *args, adapter_names=adapter_names, **kwargs)
+    result = self.base_layer(x, *args, **kwargs)
+    if not adapters:
+        return result
+    stack_A, stack_B = _get_lora_stack(self, adapters)
+    slot_mapping = {adapter: i for i, adapter in enumerate(adapters)}
+    slots = torch.tensor([slot_mapping.get(name, len(adapters)) for name in adapter_names], device=stack_A.device)
+    lora_x = x.to(device=stack_A.device, dtype=stack_A.dtype)
+    if x.dim() == 2:
+        lora_x = lora_x[:, None]
+    lora_output = torch.bmm(torch.bmm(lora_x, stack_A[slots].transpose(1, 2)), stack_B[slots].transpose(1, 2))
+    if x.dim() == 2:
+        lora_output = lora_output[:, 0]
+    return result + lora_output.to(device=result.device, dtype=result.dtype)
+
+
+def enable_lora_mixed_batch_forward(model: nn.Module) -> None:
+    """Use `lora_mixed_batch_forward` in the LoRA linear layers of `model` only, instead of patching peft.
+
+    Call it again after loading or deleting adapters: the new layers are enabled and the cached stacks are dropped
+    (a new weight can reuse the id of a deleted one).
+    """
+    for module in model.modules():
+        if isinstance(module, _Linear):
+            module._mixed_batch_forward = MethodType(lora_mixed_batch_forward, module)
+            module._lora_stack_cache = None
+
+
 if is_bnb_available():
     import bitsandbytes as bnb
     from peft.tuners.lora.bnb import Linear8bitLt as _Linear8bitLt
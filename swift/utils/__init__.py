@@ -1,7 +1,7 @@
 # Copyright (c) Alibaba, Inc. and its affiliates.
 
 from .hub import create_ms_repo, push_to_ms_hub
-from .io_utils import append_to_jsonl, read_from_jsonl, write_to_jsonl
+from .io_utils import JsonlWriter, append_to_jsonl, read_from_jsonl, write_to_jsonl
 from .logger import get_logger
 from .metric import compute_acc_metrics, compute_nlg_metrics, preprocess_logits_for_metrics
 from .np_utils import get_seed, stat_array, transform_jsonl_to_df
@@ -1,5 +1,10 @@
 # Copyright (c) Alibaba, Inc. and its affiliates.
-from typing import Any, List
+import atexit
+import os
+import time
+from queue import Empty, Queue
+from threading import Thread
+from typing import Any, Dict, List, Optional
 
 import json
 
@@ -34,3 +39,140 @@ def append_to_jsonl(fpath: str, obj: Any, encoding: str = 'utf-8') -> None:
     except Exception as e:
         logger.error(f'Cannot write content to jsonl file:{obj}')
         logger.error(e)
+
+
+class JsonlWriter:
+    """Buffered jsonl writer that flushes in a background thread.
+
+    With `resume`, the indices of the rows are recorded in a side file (`{fpath}.index`, one index per row), so
+    that an interrupted job can be resumed: `completed` maps the recorded indices to their rows. The rows of a
+    file should either all have an index or none. The rows are serialized by `write` (in the caller thread), so
+    that a row which cannot be serialized raises there.
+
+    Args:
+        fpath: The jsonl file path.
+        resume: Whether to load the existing rows of `fpath` and their indices, and record the indices.
+        append: Whether to append the rows (without an index) to the existing `fpath`.
+            If neither `resume` nor `append` is set, the file is overwritten.
+        flush_interval: The maximum seconds a row stays in the buffer.
+    """
+
+    def __init__(self,
+                 fpath: str,
+                 *,
+                 resume: bool = False,
+                 append: bool = False,
+                 flush_interval: float = 1.,
+                 encoding: str = 'utf-8') -> None:
+        assert not (resume and append), 'Please set only one of `resume` and `append`.'
+        self.fpath = fpath
+        self.index_path = f'{fpath}.index'
+        self.resume = resume
+        self.flush_interval = flush_interval
+        self.encoding = encoding
+        self.completed: Dict[int, Any] = {}
+        if resume:
+            self._load()
+        elif append:
+            if os.path.exists(self.index_path):
+                raise ValueError(f'`{self.fpath}` has the indexed rows of `{self.index_path}`, appending rows without '
+                                 'an index would break resuming it. Please use another path.')
+        else:
+            for path in [self.fpath, self.index_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+        self._queue = Queue()
+        self._closed = False
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        # Rows in the buffer are also written if the main thread exits with an exception.
+        atexit.register(self.close)
+
+    def _load(self) -> None:
+        if not os.path.exists(self.fpath) or os.path.getsize(self.fpath) == 0:
+            return
+        if not os.path.exists(self.index_path):
+            raise ValueError(f'`{self.fpath}` exists but its index file `{self.index_path}` does not, so the '
+                             'completed rows are unknown. Please remove the file or use another path.')
+        # Only the rows ending with a newline were completely written.
+        is_complete = True
+        obj_list = []
+        with open(self.fpath, 'r', encoding=self.encoding) as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    is_complete = False
+                    break
+                obj_list.append(json.loads(line))
+        index_list = []
+        with open(self.index_path, 'r', encoding=self.encoding) as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    is_complete = False
+                    break
+                index_list.append(int(line))
+        n = min(len(obj_list), len(index_list))
+        if not is_complete or n < len(obj_list) or n < len(index_list):
+            # Drop the rows without a recorded index (and vice versa).
+            obj_list, index_list = obj_list[:n], index_list[:n]
+            with open(self.fpath, 'w', encoding=self.encoding) as f:
+                f.write(''.join(f'{json.dumps(obj, ensure_ascii=False)}\n' for obj in obj_list))
+            with open(self.index_path, 'w', encoding=self.encoding) as f:
+                f.write(''.join(f'{index}\n' for index in index_list))
+        self.completed = dict(zip(index_list, obj_list))
+        logger.info(f'Loaded {n} completed rows from `{self.fpath}`.')
+
+    def write(self, obj: Any, index: Optional[int] = None) -> None:
+        assert not self._closed, 'The writer has been closed.'
+        obj_text = f'{json.dumps(check_json_format(obj), ensure_ascii=False)}\n'
+        self._queue.put((obj_text, index if self.resume else None))
+
+    def _run(self) -> None:
+        while True:
+            item_list = [self._queue.get()]
+            deadline = time.time() + self.flush_interval
+            while item_list[-1] is not None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item_list.append(self._queue.get(timeout=timeout))
+                except Empty:
+                    break
+            stop = item_list[-1] is None
+            if stop:
+                item_list.pop()
+            self._write(item_list)
+            if stop:
+                return
+
+    def _write(self, item_list: List[Any]) -> None:
+        obj_text_list, index_text_list = [], []
+        for obj_text, index in item_list:
+            obj_text_list.append(obj_text)
+            if index is not None:
+                index_text_list.append(f'{index}\n')
+        if len(obj_text_list) == 0:
+            return
+        try:
+            with open(self.fpath, 'a', encoding=self.encoding) as f:
+                f.write(''.join(obj_text_list))
+            if len(index_text_list) > 0:
+                with open(self.index_path, 'a', encoding=self.encoding) as f:
+                    f.write(''.join(index_text_list))
+        except Exception as e:
+            logger.error(f'Cannot write content to jsonl file: {self.fpath}')
+            logger.error(e)
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self) -> 'JsonlWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
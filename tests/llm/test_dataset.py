@@ -1,9 +1,13 @@
+import copy
 import tempfile
 import unittest
 
+import json
 from datasets import Dataset as HfDataset
+from tokenizers import Tokenizer
 
-from swift.llm import DatasetName, get_dataset
+from swift.llm import (DatasetName, LazyLLMDataset, ModelType, dataset_map, get_dataset, get_dataset_cache_path,
+                       get_model_tokenizer, get_template, load_dataset_cache, save_dataset_cache)
 
 
 class TestDataset(unittest.TestCase):
@@ -17,6 +21,52 @@ class TestDataset(unittest.TestCase):
             ds = get_dataset(ds)
             assert len(ds[0]) > 800
 
+    def test_dataset_cache(self):
+        _, tokenizer = get_model_tokenizer(ModelType.qwen2_0_5b_instruct, load_model=False)
+        template = get_template('qwen', tokenizer, max_length=128)
+        dataset = HfDataset.from_list([{'query': f'hello {i}', 'response': 'world ' * (i + 1)} for i in range(10)])
+        llm_dataset = dataset_map(dataset, template.encode)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_path = get_dataset_cache_path(dataset, template, tmp_dir)
+            self.assertTrue(load_dataset_cache(cache_path) is None)
+            self.assertTrue(save_dataset_cache(llm_dataset, cache_path))
+            cached_dataset = load_dataset_cache(cache_path)
+            self.assertTrue(len(cached_dataset) == len(llm_dataset))
+            for i in range(len(llm_dataset)):
+                for k, v in llm_dataset[i].items():
+                    self.assertTrue(cached_dataset[i][k] == v)
+            selected = cached_dataset.select([3, 1])
+            self.assertTrue(selected[0]['input_ids'] == llm_dataset[3]['input_ids'])
+            # a tokenizer edited at the same path, with the same vocab size
+            tokenizer2 = copy.deepcopy(tokenizer)
+            tokenizer_json = json.loads(tokenizer2.backend_tokenizer.to_str())
+            vocab = tokenizer_json['model']['vocab']
+            (token_a, id_a), (token_b, id_b) = list(vocab.items())[:2]
+            vocab[token_a], vocab[token_b] = id_b, id_a
+            tokenizer2._tokenizer = Tokenizer.from_str(json.dumps(tokenizer_json))
+            template2 = get_template('qwen', tokenizer2, max_length=128)
+            self.assertTrue(len(tokenizer2) == len(tokenizer))
+            self.assertTrue(get_dataset_cache_path(dataset, template2, tmp_dir) != cache_path)
+
+    def test_lazy_dataset_cache(self):
+        _, tokenizer = get_model_tokenizer(ModelType.qwen2_0_5b_instruct, load_model=False)
+        template = get_template('qwen', tokenizer, max_length=128)
+        dataset = HfDataset.from_list([{'query': f'hello {i}', 'response': 'world ' * (i + 1)} for i in range(10)])
+        encoded = [template.encode(dataset[i])[0] for i in range(len(dataset))]
+        num_calls = [0]
+
+        def encode_func(example):
+            num_calls[0] += 1
+            return template.encode(example)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for kwargs in [{'cache_max_mb': 1}, {'cache_dir': tmp_dir}]:
+                num_calls[0] = 0
+                lazy_dataset = LazyLLMDataset(dataset, encode_func, **kwargs)
+                for _ in range(2):
+                    self.assertTrue([lazy_dataset[i] for i in range(len(dataset))] == encoded)
+                self.assertTrue(num_calls[0] == len(dataset))
+
 
 if __name__ == '__main__':
     unittest.main()
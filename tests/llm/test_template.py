@@ -4,8 +4,8 @@ import json
 import torch
 from modelscope import GenerationConfig
 
-from swift.llm import (TEMPLATE_MAPPING, ModelType, Template, get_default_template_type, get_model_tokenizer,
-                       get_template, inference, messages_to_history)
+from swift.llm import (TEMPLATE_MAPPING, IncrementalDetokenizer, ModelType, Template, get_default_template_type,
+                       get_model_tokenizer, get_template, inference, messages_to_history)
 
 if __name__ == '__main__':
     import os
@@ -48,6 +48,80 @@ you are a helpful assistant!<|im_end|>
 浙江的省会是杭州。<|im_end|>"""
             self.assertTrue(result == text)
 
+    def test_token_cache(self):
+        _, tokenizer = get_model_tokenizer(ModelType.qwen2_0_5b_instruct, load_model=False)
+        data = {
+            'system': 'you are a helpful assistant!',
+            'query': '浙江的省会在哪？<|im_end|>\n',
+            'response': '浙江的省会是杭州。',
+            'history': [('你好，你是谁？', ' 我是通义千问。\n')]
+        }
+        for template_type in TEMPLATE_MAPPING.keys():
+            try:
+                template = get_template(template_type, tokenizer)
+                template_no_cache = get_template(template_type, tokenizer)
+                template_no_cache.use_token_cache = False
+                inputs_no_cache = template_no_cache.encode(data.copy())[0]
+            except Exception:
+                continue  # multimodal templates
+            self.assertTrue(template.encode(data.copy())[0] == inputs_no_cache, template_type)
+
+    def test_batch_encode(self):
+        _, tokenizer = get_model_tokenizer(ModelType.qwen2_0_5b_instruct, load_model=False)
+        examples = [{
+            'system': None if i % 2 == 0 else f'you are a helpful assistant! {i}',
+            'query': f'浙江的省会在哪？{i}',
+            'response': '浙江的省会是杭州。' * (i % 3 + 1),
+            'history': [('你好，你是谁？', '我是通义千问。')] * (i % 2)
+        } for i in range(10)]
+        for template_type in TEMPLATE_MAPPING.keys():
+            try:
+                template = get_template(template_type, tokenizer)
+                res = [template.encode(example.copy()) for example in examples]
+            except Exception:
+                continue  # multimodal templates
+            self.assertTrue(template.batch_encode([example.copy() for example in examples]) == res, template_type)
+
+    def test_incremental_detokenizer(self):
+        _, tokenizer = get_model_tokenizer(ModelType.qwen2_0_5b_instruct, load_model=False)
+        template = get_template(get_default_template_type(ModelType.qwen2_0_5b_instruct), tokenizer)
+        generate_ids = tokenizer.encode('浙江的省会是杭州。Hello world! 😀\n') + [tokenizer.eos_token_id]
+        detokenizer = IncrementalDetokenizer(template)
+        response = ''
+        for i in range(1, len(generate_ids) + 1):
+            delta = detokenizer.step(generate_ids[:i], i == len(generate_ids))
+            self.assertTrue('\ufffd' not in delta)
+            response += delta
+        self.assertTrue(response == detokenizer.response == template.generate_ids_to_response(generate_ids))
+
+    def test_stop_words_criteria(self):
+        from swift.llm.utils.template import StopWordsCriteria
+        _, tokenizer = get_model_tokenizer(ModelType.qwen2_0_5b_instruct, load_model=False)
+        im_end_id = tokenizer.convert_tokens_to_ids('<|im_end|>')
+        input_ids = [
+            tokenizer.encode('Thought: I need to search.\nAction: search\nObservation:'),
+            tokenizer.encode('浙江的省会是杭州。') + [im_end_id],
+            tokenizer.encode('1 2 3 4 5 6'),
+        ]
+        criteria = StopWordsCriteria(tokenizer, ['Observation:', '<|im_end|>', tokenizer.encode(' 4 5')])
+        seq_len = max(len(ids) for ids in input_ids)
+        input_ids = torch.tensor([[0] + ids + [0] * (seq_len - len(ids)) for ids in input_ids])
+        stop_idx = [-1] * len(input_ids)
+        for i in range(2, seq_len + 2):
+            is_done = criteria(input_ids[:, :i], None)
+            for j, done in enumerate(is_done.tolist()):
+                if done and stop_idx[j] == -1:
+                    stop_idx[j] = i - 1
+        for ids, idx, text in zip(input_ids.tolist(), stop_idx, ['Observation:', '<|im_end|>', ' 4 5']):
+            self.assertTrue(tokenizer.decode(ids[1:idx + 1]).endswith(text))
+        # beam search reorders the rows between the steps
+        criteria = StopWordsCriteria(
+            tokenizer, ['Observation:', '<|im_end|>', tokenizer.encode(' 4 5')], incremental=False)
+        for i in range(2, seq_len + 2):
+            perm = torch.randperm(len(input_ids))
+            is_done = criteria(input_ids[perm, :i], None)
+            self.assertTrue(is_done.tolist() == [stop_idx[j] != -1 and stop_idx[j] < i for j in perm.tolist()])
+
     @unittest.skipIf(SKPT_TEST, 'To avoid excessive testing time caused by downloading models and '
                      'to prevent OOM (Out of Memory) errors.')
     def test_chatglm3_template(self):
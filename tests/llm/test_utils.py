@@ -1,8 +1,8 @@
 import os
 import unittest
 
-from swift.llm import (ModelType, get_default_template_type, get_model_tokenizer, get_template, inference,
-                       inference_stream, limit_history_length, print_example)
+from swift.llm import (ColumnarLLMDataset, ModelType, get_default_template_type, get_model_tokenizer, get_template,
+                       inference, inference_stream, limit_history_length, print_example)
 from swift.utils import lower_bound, seed_everything
 
 
@@ -82,6 +82,231 @@ class TestLlmUtils(unittest.TestCase):
                                                         600)
         self.assertTrue(len(old_history) == 3 and len(new_history) == 2)
 
+    def test_columnar_dataset(self):
+        import pickle
+        data = [{
+            'input_ids': list(range(i + 1)),
+            'labels': [-100] * i + [i],
+            'loss_scale': [0.] * i + [1.]
+        } for i in range(10)]
+        dataset = ColumnarLLMDataset.from_list(data)
+        self.assertTrue(len(dataset) == len(data))
+        for i, d in enumerate(data):
+            for k, v in d.items():
+                self.assertTrue(dataset[i][k] == v)
+        self.assertTrue(isinstance(dataset[0]['labels'], list) and isinstance(dataset[0]['labels'][0], int))
+        selected = pickle.loads(pickle.dumps(dataset.select([5, 2]).select([1])))
+        self.assertTrue(len(selected) == 1 and selected[0]['input_ids'] == data[2]['input_ids'])
+        self.assertTrue(ColumnarLLMDataset.from_list([{'input_ids': [1], 'pixel_values': 'image'}]) is None)
+
+    def test_inference_pt(self):
+        from transformers import GenerationConfig
+        from swift.llm import inference_pt
+        model_type = ModelType.qwen2_0_5b_instruct
+        model, tokenizer = get_model_tokenizer(model_type, use_flash_attn=False)
+        template = get_template(get_default_template_type(model_type), tokenizer)
+        generation_config = GenerationConfig(max_new_tokens=32, do_sample=False)
+        request_list = [{'query': query} for query in ['你好', 'hello', '浙江的省会在哪里?', 'Write a poem about the sea.']]
+        request_list[0]['history'] = [['hi', 'Hello! How can I help you?']]
+        resp_list = inference_pt(model, template, request_list, generation_config=generation_config, max_batch_size=3)
+        for request, resp in zip(request_list, resp_list):
+            response, history = inference(model, template, **request, generation_config=generation_config)
+            self.assertTrue(resp == {'response': response, 'history': history})
+
+    def test_pt_scheduler(self):
+        import asyncio
+        from transformers import GenerationConfig
+        from swift.llm import PtScheduler
+        model_type = ModelType.qwen2_0_5b_instruct
+        model, tokenizer = get_model_tokenizer(model_type, use_flash_attn=False)
+        template = get_template(get_default_template_type(model_type), tokenizer)
+        generation_config = GenerationConfig(max_new_tokens=32, do_sample=False)
+        queries = ['你好', 'hello', '浙江的省会在哪里?', 'Write a poem about the sea.']
+        responses = [inference(model, template, query, generation_config=generation_config)[0] for query in queries]
+        scheduler = PtScheduler(model, template, max_batch_size=2)
+
+        async def _generate(query: str, delay: float) -> str:
+            await asyncio.sleep(delay)
+            input_ids = template.encode({'query': query})[0]['input_ids']
+            generate_ids = []
+            async for output in scheduler.generate(input_ids, generation_config):
+                generate_ids += output['token_ids']
+            return template.generate_ids_to_response(generate_ids)
+
+        async def _main():
+            return await asyncio.gather(*[_generate(query, i * 0.1) for i, query in enumerate(queries)])
+
+        self.assertTrue(asyncio.run(_main()) == responses)
+
+    def test_top_k_top_p_filter(self):
+        import torch
+        from transformers import TopKLogitsWarper, TopPLogitsWarper
+        from swift.llm.utils.pt_scheduler import _top_k_top_p_filter
+        logits = torch.tensor([[3, 2.5, 2, 1.9, 1.8, 1.7, 0]])
+        for top_k, top_p in [(3, 0.8), (7, 0.8), (2, 1.), (5, 0.5)]:
+            hf_logits = TopPLogitsWarper(top_p)(None, TopKLogitsWarper(top_k)(None, logits.clone()))
+            res = _top_k_top_p_filter(logits.clone(), torch.tensor([top_k]), torch.tensor([top_p]))
+            self.assertTrue(torch.equal(res.isinf(), hf_logits.isinf()))
+
+    def test_first_fit_decreasing(self):
+        import numpy as np
+        from swift.llm.utils.utils import _first_fit_decreasing
+        lengths = np.random.RandomState(42).randint(1, 100, size=1000)
+        bins = _first_fit_decreasing(lengths, 128)
+        self.assertTrue(sorted(i for b in bins for i in b) == list(range(1000)))
+        self.assertTrue(all(lengths[b].sum() <= 128 for b in bins))
+        self.assertTrue(lengths.sum() / (len(bins) * 128) > 0.95)
+        self.assertTrue(_first_fit_decreasing(np.array([200, 10]), 128) == [[0], [1]])
+
+    def test_length_grouped_batch_sampler(self):
+        import numpy as np
+        from swift.trainers.sampler import LengthGroupedBatchSampler
+        lengths = np.random.RandomState(42).randint(1, 1000, size=1000)
+        for kwargs in [{'batch_size': 8}, {'max_tokens_per_batch': 4096}]:
+            samplers = [LengthGroupedBatchSampler(lengths, num_replicas=2, rank=rank, **kwargs) for rank in range(2)]
+            batches = [list(sampler) for sampler in samplers]
+            self.assertTrue(len(batches[0]) == len(batches[1]) == len(samplers[0]))
+            self.assertTrue(set(i for b in batches[0] + batches[1] for i in b) == set(range(1000)))
+            self.assertTrue(list(LengthGroupedBatchSampler(lengths, num_replicas=2, **kwargs)) == batches[0])
+            if 'max_tokens_per_batch' in kwargs:
+                self.assertTrue(all(lengths[b].max() * len(b) <= 4096 for b in batches[0]))
+            samplers[0].set_epoch(1)
+            self.assertTrue(list(samplers[0]) != batches[0])
+            # resume
+            sampler = LengthGroupedBatchSampler(lengths, num_replicas=2, seed=0, **kwargs)
+            sampler.load_state_dict({'epoch': 1, 'seed': 42, 'offset': 5})
+            self.assertTrue(list(sampler) == list(samplers[0])[5:])
+            self.assertTrue(list(sampler) == list(samplers[0]))
+            # the epoch and the offset of the trainer are ignored after loading the state
+            sampler.load_state_dict({'epoch': 1, 'seed': 42, 'offset': 5})
+            sampler.set_epoch(0)
+            sampler.skip(3)
+            self.assertTrue(list(sampler) == list(samplers[0])[5:])
+            sampler.set_epoch(1)
+            self.assertTrue(sampler.epoch == 2)
+            sampler.num_consumed = 2
+            self.assertTrue(sampler.state_dict() == {'epoch': 2, 'seed': 42, 'offset': 2})
+            sampler.num_consumed = len(sampler)
+            self.assertTrue(sampler.state_dict() == {'epoch': 3, 'seed': 42, 'offset': 0})
+
+    def test_deploy_metrics(self):
+        from swift.llm import DeployMetrics
+        metrics = DeployMetrics()
+        for model, num_generated_tokens in [('qwen', 10), ('lora1', 1)]:
+            request_stats = metrics.start_request(model)
+            request_stats.submit()
+            request_stats.step(num_generated_tokens)
+            request_stats.set_usage(5, num_generated_tokens)
+            request_stats.speculate(num_generated_tokens, num_generated_tokens - 1)
+            request_stats.finish()
+        metrics.start_request('qwen').finish('aborted')
+        metrics.start_request('qwen').finish('timeout')
+        text = metrics.render()
+        self.assertTrue('swift_requests_total{model="qwen",status="success"} 1.0' in text)
+        self.assertTrue('swift_requests_total{model="qwen",status="aborted"} 1.0' in text)
+        self.assertTrue('swift_requests_total{model="qwen",status="timeout"} 1.0' in text)
+        self.assertTrue('swift_generation_tokens_total{model="lora1"} 1.0' in text)
+        self.assertTrue('swift_requests_in_flight{model="qwen"} 0.0' in text)
+        self.assertTrue('swift_time_to_first_token_seconds_bucket{model="qwen",le="+Inf"} 1.0' in text)
+        self.assertTrue('swift_time_per_output_token_seconds_count{model="qwen"} 1.0' in text)
+        self.assertTrue('swift_time_per_output_token_seconds_count{model="lora1"}' not in text)
+        self.assertTrue('swift_spec_decode_accepted_tokens_total{model="qwen"} 9.0' in text)
+
+    def test_prefix_cache(self):
+        import torch
+        from swift.llm import PrefixCache
+        cache = PrefixCache(max_tokens=11)
+
+        def get_kv_cache(token_ids):  # 2 layers, [head, seq_len, dim]
+            t = torch.tensor(token_ids, dtype=torch.float32)[None, :, None].expand(2, -1, 4)
+            return [(t, -t), (t + 1, t - 1)]
+
+        cache.insert([1, 2, 3, 4, 5], get_kv_cache([1, 2, 3, 4, 5]))
+        cache.insert([1, 2, 3, 6], get_kv_cache([1, 2, 3, 6]), adapter_name=None)
+        self.assertTrue(cache.num_tokens == 6)
+        length, kv_cache = cache.match([1, 2, 3, 6, 7])
+        self.assertTrue(length == 4)
+        self.assertTrue(torch.equal(kv_cache[1][0], get_kv_cache([1, 2, 3, 6])[1][0]))
+        # The last token is not matched.
+        self.assertTrue(cache.match([1, 2, 3, 4, 5])[0] == 4)
+        self.assertTrue(cache.match([1, 2, 3, 6], adapter_name='lora1') == (0, None))
+        cache.insert([1, 2, 8, 9, 10, 11, 12, 13], get_kv_cache([1, 2, 8, 9, 10, 11, 12, 13]))
+        # [6] is the least recently used leaf.
+        self.assertTrue(cache.num_tokens == 11)
+        self.assertTrue(cache.match([1, 2, 3, 6, 7])[0] == 3)
+        self.assertTrue(cache.match([1, 2, 3, 4, 5, 6])[0] == 5)
+        self.assertTrue(cache.match([1, 2, 8, 9, 10, 11, 12, 13, 14])[0] == 8)
+
+    def test_client_from_dict(self):
+        from swift.llm.utils.client_utils import from_dict
+        from swift.llm.utils.protocol import ChatCompletionStreamResponse, ModelList
+        tool_call = {'id': 'toolcall-1', 'function': {'name': 'search', 'arguments': '{}'}}
+        delta = {'role': 'assistant', 'content': 'hi', 'tool_calls': [tool_call]}
+        choice = {'index': 0, 'delta': delta, 'finish_reason': None}
+        chunk = {'model': 'qwen', 'choices': [choice], 'usage': None, 'id': 'chatcmpl-1', 'unknown_key': 0}
+        resp = from_dict(ChatCompletionStreamResponse, chunk)
+        self.assertTrue(resp.choices[0].delta.tool_calls[0].function.name == 'search')
+        self.assertTrue(resp.usage is None and resp.object == 'chat.completion.chunk')
+        model_list = from_dict(ModelList, {'data': [{'id': 'qwen', 'is_chat': False}]})
+        self.assertTrue(model_list.data[0].is_chat is False and model_list.data[0].owned_by == 'swift')
+
+    def test_chunked_ce_loss(self):
+        import torch
+        from transformers.modeling_outputs import CausalLMOutput
+        from swift.trainers.loss import ce_loss_func, chunked_ce_loss_func
+        lm_head = torch.nn.Linear(16, 100)
+        hidden_states = torch.randn(2, 9, 16, requires_grad=True)
+        labels = torch.randint(0, 100, (2, 9))
+        labels[0, :4] = -100
+        loss, masks = ce_loss_func(CausalLMOutput(logits=lm_head(hidden_states)), labels)
+        loss.mean().backward()
+        grads = [hidden_states.grad, lm_head.weight.grad, lm_head.bias.grad]
+        hidden_states.grad = lm_head.weight.grad = lm_head.bias.grad = None
+        loss2, masks2, correct = chunked_ce_loss_func(hidden_states, lm_head, labels, chunk_size=3)
+        loss2.mean().backward()
+        self.assertTrue(torch.equal(masks, masks2) and torch.allclose(loss, loss2, atol=1e-6))
+        for grad, grad2 in zip(grads, [hidden_states.grad, lm_head.weight.grad, lm_head.bias.grad]):
+            self.assertTrue(torch.allclose(grad, grad2, atol=1e-6))
+        preds = lm_head(hidden_states).argmax(dim=-1)[:, :-1]
+        self.assertTrue(torch.equal(preds[masks] == labels[:, 1:][masks], correct))
+
+    def test_async_checkpoint_writer(self):
+        import tempfile
+        from functools import partial
+        import torch
+        from swift.trainers.checkpoint import AsyncCheckpointWriter
+        weight = torch.randn(4, 4)
+        state = {'embed': weight, 'lm_head': weight, 'step': 3}
+        writer = AsyncCheckpointWriter()
+        snapshot = writer.snapshot(state)
+        weight.add_(1)
+        self.assertTrue(snapshot['embed'] is snapshot['lm_head'] and torch.equal(snapshot['embed'] + 1, weight))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            staging_dir, output_dir = os.path.join(tmp_dir, 'tmp-checkpoint-1'), os.path.join(tmp_dir, 'checkpoint-1')
+            os.makedirs(staging_dir)
+            writer.submit(staging_dir, output_dir,
+                          [partial(torch.save, snapshot, os.path.join(staging_dir, f'{i}.pt')) for i in range(3)])
+            writer.wait()
+            self.assertEqual(os.listdir(tmp_dir), ['checkpoint-1'])
+            self.assertEqual(sorted(os.listdir(output_dir)), ['0.pt', '1.pt', '2.pt'])
+            writer.submit(os.path.join(tmp_dir, 'tmp-checkpoint-2'), os.path.join(tmp_dir, 'checkpoint-2'), [])
+            with self.assertRaises(RuntimeError):
+                writer.wait()
+            self.assertEqual(os.listdir(tmp_dir), ['checkpoint-1'])
+
+    def test_step_timer(self):
+        import time
+        from swift.trainers.step_timer import StepTimer
+        timer = StepTimer()
+        timer.use_cuda_event = False
+        for _ in range(2):
+            with timer.timer('forward'):
+                time.sleep(0.01)
+        timer.add('dataloader', 0.5)
+        times = timer.pop_times()
+        self.assertTrue(0.02 <= times['forward'] < 0.2 and times['dataloader'] == 0.5)
+        self.assertEqual(timer.pop_times(), {})
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -5,6 +5,7 @@ import unittest
 
 import torch
 from modelscope import Model
+from modelscope.models.nlp.structbert import SbertConfig, SbertForSequenceClassification
 
 from swift import LoRAConfig, Swift
 from swift.tuners.utils import ModulesToSaveWrapper
@@ -61,3 +62,21 @@ class TestExtraStateDict(unittest.TestCase):
         self.assertTrue(
             torch.allclose(state_dict['classifier.weight'],
                            model.base_model.classifier.modules_to_save['lora2'].weight))
+
+    def test_swift_indexed_state_dict(self):
+        model = SbertForSequenceClassification(SbertConfig())
+        lora_config = LoRAConfig(target_modules=['query', 'key', 'value'], modules_to_save=['classifier'])
+        lora_config2 = LoRAConfig(target_modules=['dense'], modules_to_save=['classifier'])
+        model = Swift.prepare_model(
+            model, {
+                'lora1': lora_config,
+                'lora2': lora_config2
+            }, extra_state_keys=['.*pooler.*'])
+        base_state_dict = model.base_model.state_dict()
+        for kwargs in [{}, {'adapter_name': 'lora1'}, {'adapter_name': 'lora2'}, {'save_adapter': False}]:
+            state_dict = model.state_dict(**kwargs)
+            # The state_dict from the whole base model
+            state_dict2 = model.state_dict(state_dict=base_state_dict, **kwargs)
+            self.assertEqual(state_dict.keys(), state_dict2.keys())
+            self.assertTrue(all(torch.equal(value, state_dict2[key]) for key, value in state_dict.items()))
+        self.assertTrue(any('classifier' in key for key in model.state_dict(adapter_name='lora2')))
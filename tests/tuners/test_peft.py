@@ -15,6 +15,7 @@ from peft.utils import WEIGHTS_NAME
 from torch import nn
 
 from swift import AdaLoraConfig, LoraConfig, LoRAConfig, Swift, get_peft_model
+from swift.tuners.lora_layers import enable_lora_mixed_batch_forward
 
 
 class TestPeft(unittest.TestCase):
@@ -118,6 +119,34 @@ class TestPeft(unittest.TestCase):
             self.assertTrue(key in state_dict2)
             self.assertTrue(all(torch.isclose(state_dict[key], state_dict2[key]).flatten().detach().cpu()))
 
+    def test_lora_mixed_batch(self):
+        from peft.tuners.lora import LoraLayer
+        model = nn.Sequential(nn.Linear(16, 32), nn.ReLU(), nn.Linear(32, 8))
+        model = peft.get_peft_model(
+            model, peft.LoraConfig(target_modules=['0', '2'], r=4, init_lora_weights=False), adapter_name='a')
+        model.add_adapter('b', peft.LoraConfig(target_modules=['0', '2'], r=8, lora_alpha=4, init_lora_weights=False))
+        for name, parameter in model.named_parameters():
+            if 'lora_B' in name:
+                torch.nn.init.normal_(parameter)
+        model.eval()
+        x = torch.randn(5, 3, 16)
+        adapter_names = ['a', 'b', '__base__', 'b', 'a']
+        with torch.no_grad():
+            output = model(x, adapter_names=adapter_names)
+            enable_lora_mixed_batch_forward(model)
+            self.assertTrue(Linear._mixed_batch_forward is LoraLayer._mixed_batch_forward)  # peft is not patched
+            output2 = model(x, adapter_names=adapter_names)
+            self.assertTrue(torch.allclose(output, output2, atol=1e-5))
+            # the weights updated in place are not stale in the cached stacks
+            for name, parameter in model.named_parameters():
+                if 'lora_B.b' in name:
+                    parameter.mul_(2)
+            output2 = model(x, adapter_names=adapter_names)
+            self.assertTrue(not torch.allclose(output, output2, atol=1e-5))
+            del model.base_model.model[0]._mixed_batch_forward, model.base_model.model[2]._mixed_batch_forward
+            output = model(x, adapter_names=adapter_names)
+        self.assertTrue(torch.allclose(output, output2, atol=1e-5))
+
     def test_peft_adalora_injection(self):
         model = SbertForSequenceClassification(SbertConfig())
         model2 = copy.deepcopy(model)
@@ -3,7 +3,7 @@ import shutil
 import tempfile
 import unittest
 
-from swift.utils import append_to_jsonl, get_logger, read_from_jsonl, write_to_jsonl
+from swift.utils import JsonlWriter, append_to_jsonl, get_logger, read_from_jsonl, write_to_jsonl
 
 logger = get_logger()
 
@@ -37,6 +37,40 @@ class TestIOUtils(unittest.TestCase):
         new_obj_list = read_from_jsonl(fpath)
         self.assertTrue(new_obj_list == obj_list)
 
+    def test_jsonl_writer(self):
+        fpath = os.path.join(self.tmp_dir, '1.jsonl')
+        obj_list = [{'aaa': 'bbb'}, 111, [1.1]]
+        with JsonlWriter(fpath) as writer:
+            writer.write(obj_list[0], 0)
+        self.assertTrue(read_from_jsonl(fpath) == obj_list[:1] and not os.path.exists(f'{fpath}.index'))
+        os.remove(fpath)
+        with JsonlWriter(fpath, resume=True) as writer:
+            for i, obj in enumerate(obj_list):
+                writer.write(obj, i * 2)
+                with self.assertRaises(TypeError):
+                    writer.write({'aaa': 1j})  # raises in the caller thread, the other rows are written
+        self.assertTrue(read_from_jsonl(fpath) == obj_list)
+        # a partially written row is dropped when resuming
+        with open(fpath, 'a') as f:
+            f.write('{"bbb": ')
+        writer = JsonlWriter(fpath, resume=True)
+        self.assertTrue(writer.completed == {0: obj_list[0], 2: obj_list[1], 4: obj_list[2]})
+        writer.write({'bbb': 'aaa'}, 1)
+        writer.close()
+        self.assertTrue(read_from_jsonl(fpath) == obj_list + [{'bbb': 'aaa'}])
+        with self.assertRaises(ValueError):
+            JsonlWriter(fpath, append=True)  # the file has an index
+        writer = JsonlWriter(fpath)
+        writer.close()
+        self.assertTrue(writer.completed == {} and not os.path.exists(fpath))
+        # rows without an index are appended, and cannot be resumed
+        append_to_jsonl(fpath, obj_list[0])
+        with JsonlWriter(fpath, append=True) as writer:
+            writer.write(obj_list[1])
+        self.assertTrue(read_from_jsonl(fpath) == obj_list[:2])
+        with self.assertRaises(ValueError):
+            JsonlWriter(fpath, resume=True)
+
 
 if __name__ == '__main__':
     unittest.main()